@@ -0,0 +1,100 @@
+#!/usr/bin/python -S
+"""
+alloc_benchmark.py
+
+Counts the objects that jsontemplate allocates per rendered row of a repeated
+section, e.g. scope stack frames.  Run it before and after a change to the
+runtime:
+
+  python benchmarks/alloc_benchmark.py [num_rows]
+
+An instance of a class without __slots__ is two allocations: the object and its
+__dict__.
+"""
+
+__author__ = 'Andy Chu'
+
+
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'python'))
+
+from jsontemplate import _jsontemplate as jsontemplate
+
+
+TEMPLATE = """\
+<table>
+{.repeated section rows}
+  <tr>
+    <td>{@index}</td>
+    <td>{name}</td>
+    {.section address}<td>{city}, {zip}</td>{.end}
+    <td>{.repeated section tags}{@}{.alternates with}, {.end}</td>
+  </tr>
+{.end}
+</table>
+"""
+
+
+def MakeData(num_rows):
+  return {'rows': [
+      {'name': 'row %d' % i, 'address': {'city': 'SF', 'zip': '94110'},
+       'tags': ['a', 'b', 'c']}
+      for i in xrange(num_rows)]}
+
+
+def CountConstructors(func):
+  """Returns a dict of class name -> number of instances created by func()."""
+  counts = {}
+  module_file = jsontemplate.__file__.replace('.pyc', '.py')
+
+  def Profile(frame, event, arg):
+    code = frame.f_code
+    if (event == 'call' and code.co_name == '__init__' and
+        code.co_filename.replace('.pyc', '.py') == module_file):
+      name = frame.f_locals['self'].__class__.__name__
+      counts[name] = counts.get(name, 0) + 1
+
+  sys.setprofile(Profile)
+  try:
+    func()
+  finally:
+    sys.setprofile(None)
+  return counts
+
+
+def main(argv):
+  try:
+    num_rows = int(argv[1])
+  except IndexError:
+    num_rows = 1000
+
+  t = jsontemplate.Template(TEMPLATE)
+  data = MakeData(num_rows)
+  t.expand(data)  # warm up
+
+  counts = CountConstructors(lambda: t.expand(data))
+  total = 0
+  print 'Objects allocated per row (%d rows):' % num_rows
+  for name in sorted(counts):
+    cls = getattr(jsontemplate, name)
+    per_instance = 1 if hasattr(cls, '__slots__') else 2
+    allocs = counts[name] * per_instance
+    total += allocs
+    print '  %-20s %8.3f  (%d instances, %s)' % (
+        name, float(allocs) / num_rows, counts[name],
+        'slots' if per_instance == 1 else 'with __dict__')
+  print '  %-20s %8.3f' % ('TOTAL', float(total) / num_rows)
+
+  start = time.time()
+  for i in xrange(5):
+    t.expand(data)
+  print 'Expand time per row: %.2f us' % (
+      (time.time() - start) / 5 / num_rows * 1e6)
+  return 0
+
+
+if __name__ == '__main__':
+  sys.exit(main(sys.argv))
@@ -0,0 +1,110 @@
+#!/usr/bin/python -S
+"""
+compile_benchmark.py
+
+Measures compiling a large tree of small templates, like a site with thousands
+of pages and partials, where startup time is dominated by compiling.
+
+  python benchmarks/compile_benchmark.py [--templates N] [--user dict|func|none]
+
+The templates are generated, with a mix of default formatters (some with
+arguments, like strftime and pluralize), user formatters, sections and
+predicates.  It prints the best time to compile all of them, and the time per
+template and per formatter lookup.
+"""
+
+__author__ = 'Andy Chu'
+
+
+import optparse
+import os
+import random
+import sys
+
+REPO_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, os.path.join(REPO_DIR, 'python'))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from jsontemplate import _jsontemplate as jsontemplate
+from run_benchmarks import BestTime
+
+
+_FORMATTERS = [
+    'html', 'html-attr-value', 'url-param-value', 'raw', 'str', 'size',
+    'strftime-gm.%Y-%m-%d', 'strftime.%H:%M', 'pluralize item items',
+    'cycle odd even', 'money', 'html|upper',
+    ]
+
+_PREDICATES = ['test admin', 'singular', 'plural', 'Debug?', 'flagged']
+
+
+def _UserFormatter(value):
+  return '$%.2f' % value
+
+
+_USER_FORMATTERS = {'money': _UserFormatter, 'upper': lambda x: x.upper()}
+_USER_PREDICATES = {'flagged': lambda x: bool(x)}
+
+
+def MakeTemplates(num_templates, seed=0):
+  """Returns a list of template strings, and the number of formatters in them."""
+  r = random.Random(seed)
+  templates = []
+  num_formatters = 0
+  for i in xrange(num_templates):
+    parts = ['<div class="t%d">\n' % i]
+    for j in xrange(r.randint(5, 15)):
+      kind = r.random()
+      if kind < 0.6:
+        formatter = r.choice(_FORMATTERS)
+        num_formatters += formatter.count('|') + 1
+        parts.append('<p>{field%d|%s}</p>\n' % (j, formatter))
+      elif kind < 0.8:
+        num_formatters += 1
+        parts.append('{.repeated section items%d}<li>{name|html}</li>{.end}\n'
+                     % j)
+      else:
+        parts.append('{.if %s}<b>yes</b>{.or}no{.end}\n'
+                     % r.choice(_PREDICATES))
+    parts.append('</div>\n')
+    templates.append(''.join(parts))
+  return templates, num_formatters
+
+
+def main(argv):
+  parser = optparse.OptionParser()
+  parser.add_option('--templates', type='int', default=4000,
+                    help='Number of templates to compile')
+  parser.add_option('--user', default='dict', choices=['dict', 'func', 'none'],
+                    help='How user formatters and predicates are passed')
+  opts, _ = parser.parse_args(argv[1:])
+
+  if opts.user == 'dict':
+    more_formatters, more_predicates = _USER_FORMATTERS, _USER_PREDICATES
+  elif opts.user == 'func':
+    more_formatters = _USER_FORMATTERS.get
+    more_predicates = _USER_PREDICATES.get
+  else:
+    more_formatters = more_predicates = None
+    # Without user functions, use the closest default ones
+    global _FORMATTERS, _PREDICATES
+    _FORMATTERS = [f.replace('money', 'str').replace('upper', 'raw')
+                   for f in _FORMATTERS]
+    _PREDICATES = [p.replace('flagged', 'singular') for p in _PREDICATES]
+
+  templates, num_formatters = MakeTemplates(opts.templates)
+
+  def CompileAll():
+    for template_str in templates:
+      jsontemplate.Template(template_str, more_formatters=more_formatters,
+                            more_predicates=more_predicates)
+
+  elapsed = BestTime(CompileAll, min_batch_time=0.5, num_batches=3)
+  print '%d templates (%d formatters): %.1f ms, %.1f us per template' % (
+      len(templates), num_formatters, elapsed * 1e3,
+      elapsed / len(templates) * 1e6)
+  return 0
+
+
+if __name__ == '__main__':
+  sys.exit(main(sys.argv))
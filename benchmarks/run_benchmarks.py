@@ -0,0 +1,336 @@
+#!/usr/bin/python -S
+"""
+run_benchmarks.py
+
+Measures compiling and expanding templates on a set of workloads, to make
+regressions and speedups in _jsontemplate.py visible.
+
+  python benchmarks/run_benchmarks.py [--output results.json]
+                                      [--baseline old.json] [--tolerance 0.1]
+                                      [--filter SUBSTRING]
+
+For each workload, it measures:
+
+  tokenize_ms  Time to tokenize the template
+  compile_ms   Time to construct the Template (tokenizing, parsing, optimizing)
+  expand_ms    Time to expand it once
+  mb_per_sec   Output throughput, in megabytes of UTF-8 per second
+  peak_rss_kb  How much the peak resident set size grows during one expansion
+
+Times are the best of several batches.  Each workload runs in a fresh process,
+so peak memory isn't hidden by an earlier workload.  (Python 2 doesn't have
+tracemalloc, so the resident set size from getrusage() is used.)
+
+With --baseline, results are compared against an earlier --output file, and it
+exits with status 1 if any time or memory measurement is worse by more than the
+tolerance.  Timings on a busy or single-core machine can vary by 20% or so; use
+a larger --tolerance there.  A typical workflow:
+
+  python benchmarks/run_benchmarks.py --output /tmp/before.json
+  # ... change _jsontemplate.py ...
+  python benchmarks/run_benchmarks.py --baseline /tmp/before.json
+"""
+
+__author__ = 'Andy Chu'
+
+
+import json
+import optparse
+import os
+import resource
+import subprocess
+import sys
+import timeit
+
+REPO_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, os.path.join(REPO_DIR, 'python'))
+
+from jsontemplate import _jsontemplate as jsontemplate
+
+
+# Measurements to compare against a baseline, and whether bigger is better
+_METRICS = [
+    ('tokenize_ms', False),
+    ('compile_ms', False),
+    ('expand_ms', False),
+    ('mb_per_sec', True),
+    ('peak_rss_kb', False),
+    ]
+
+# Smaller changes in peak RSS are noise from the allocator
+_MIN_RSS_CHANGE_KB = 1024
+
+
+#
+# Workloads.  Each function returns (template file contents, data).  The
+# template may have a header, as accepted by FromString().
+#
+
+def _DocTemplate(filename, make_data):
+  def Workload():
+    with open(os.path.join(REPO_DIR, 'doc', filename)) as f:
+      return f.read(), make_data()
+  return Workload
+
+
+def _HtmlPage():
+  # The data that makedocs.py uses, with a large body
+  body = ''.join('<p>Paragraph %d of the page, with <b>markup</b>.</p>\n' % i
+                 for i in xrange(2000))
+  return {
+      'title': 'Introducing JSON Template',
+      'include-js': ['prettify.js', 'jquery.js'],
+      'include-css': ['prettify.css'],
+      'fancy-css': [{'href': 'print.css', 'media': 'print'}],
+      'onload-js': 'prettyPrint()',
+      'body': body,
+      'img-right': {'href': 'http://example.com/', 'src': 'thagomizer.jpg'},
+      'google-analytics-id': 'UA-12345',
+      }
+
+
+def _PythonExample():
+  code = ''.join('def f%d(x):\n  return x < %d and "a" or \'b\'\n' % (i, i)
+                 for i in xrange(2000))
+  return {'live': 'http://example.com/cgi', 'raw': 'http://example.com/raw',
+          'code': code}
+
+
+def HtmlTable():
+  template = """\
+default-formatter: html
+
+<table>
+{.repeated section rows}
+  <tr class="{.if test odd}odd{.or}even{.end}">
+    <td>{@index}</td>
+    <td><a href="{url|html-attr-value}">{name}</a></td>
+    <td>{email}</td>
+    <td>{city}, {state} {zip}</td>
+    <td>{score}</td>
+    <td>{.section note}{@}{.or}&nbsp;{.end}</td>
+    <td>{.repeated section tags}{@}{.alternates with}, {.end}</td>
+  </tr>
+{.end}
+</table>
+"""
+  rows = [
+      {'odd': i % 2, 'url': '/user?id=%d&x="y"' % i, 'name': 'User <%d>' % i,
+       'email': 'user%d@example.com' % i, 'city': 'San Francisco',
+       'state': 'CA', 'zip': '94110', 'score': i * 1.5,
+       'note': 'A & B' if i % 3 == 0 else None, 'tags': ['a', 'b', 'c']}
+      for i in xrange(5000)]
+  return template, {'rows': rows}
+
+
+def _Tree(depth, fanout):
+  if depth == 0:
+    return {'name': 'leaf', 'children': []}
+  return {'name': 'node %d' % depth,
+          'children': [_Tree(depth - 1, fanout) for i in xrange(fanout)]}
+
+
+def DefineRecursion():
+  template = """\
+{.define NODE}
+<li>{name}
+{.section children}<ul>{.repeated section @}{@|template NODE}{.end}</ul>{.end}
+</li>
+{.end}
+<ul>{@|template NODE}</ul>
+"""
+  return template, _Tree(10, 2)
+
+
+def SelfRecursion():
+  template = """\
+<li>{name}
+{.section children}<ul>{.repeated section @}{@|template SELF}{.end}</ul>{.end}
+</li>
+"""
+  return template, _Tree(10, 2)
+
+
+def FormatterChains():
+  template = """\
+{.repeated section items}
+{name|html|upper|lower|html-attr-value} {name|raw|str|html} {url|url-param-value|html}
+{count|str|html|upper} {tags|size} {.section meta}{@|str|html-attr-value}{.end}
+{.end}
+"""
+  items = [{'name': 'Item <%d> & "friends"' % i, 'url': 'a b/c?d=%d' % i,
+            'count': i, 'tags': ['x'] * (i % 5), 'meta': {'id': i}}
+           for i in xrange(5000)]
+  return template, {'items': items}
+
+
+def PairsAndReverse():
+  template = """\
+{.repeated section counts | pairs}
+{@key}: {@value}
+{.end}
+{.repeated section items | reverse}
+{@index} {@}
+{.alternates with}
+--
+{.end}
+"""
+  counts = dict(('key%05d' % i, i) for i in xrange(5000))
+  return template, {'counts': counts, 'items': range(5000)}
+
+
+def TimestampTable():
+  # An activity feed: a row every 10 seconds or so, for about a week
+  template = """\
+{.repeated section events}
+<tr><td>{time|strftime-gm.%Y-%m-%d}</td><td>{time|strftime-gm.%H:%M}</td>
+<td>{time|strftime.%a %b %d %H:%M:%S %Y}</td><td>{what}</td></tr>
+{.end}
+"""
+  events = [{'time': 1316546771.5 + i * 10.25, 'what': 'Event %d' % i}
+            for i in xrange(5000)]
+  return template, {'events': events}
+
+
+WORKLOADS = [
+    ('doc/introducing', _DocTemplate('Introducing-JSON-Template.html.jsont',
+                                     lambda: {'example1': '<pre>...</pre>'})),
+    ('doc/minimalism', _DocTemplate('On-Design-Minimalism.html.jsont',
+                                    lambda: {'table-of-contents': '<ul></ul>'})),
+    ('doc/html', _DocTemplate('html.jsont', _HtmlPage)),
+    ('doc/python-examples', _DocTemplate('python-examples.jsont', _PythonExample)),
+    ('html-table', HtmlTable),
+    ('define-recursion', DefineRecursion),
+    ('self-recursion', SelfRecursion),
+    ('formatter-chains', FormatterChains),
+    ('pairs-reverse', PairsAndReverse),
+    ('timestamp-table', TimestampTable),
+    ]
+
+
+def BestTime(func, min_batch_time=0.05, num_batches=5):
+  """Returns the best time per call of func, in seconds."""
+  number = 1
+  while True:
+    elapsed = timeit.timeit(func, number=number)
+    if elapsed >= min_batch_time:
+      break
+    number *= 2
+  best = elapsed
+  for i in xrange(num_batches - 1):
+    best = min(best, timeit.timeit(func, number=number))
+  return best / number
+
+
+def RunWorkload(name):
+  """Returns a dictionary of measurements."""
+  workload = dict(WORKLOADS)[name]
+  template_file, data = workload()
+
+  # Split off the header, like FromString()
+  body, options = jsontemplate.FromString(
+      template_file, _constructor=lambda body, **kwargs: (body, kwargs))
+  meta_left, meta_right = jsontemplate.SplitMeta(options.get('meta', '{}'))
+  whitespace = options.get('whitespace', 'smart')
+  t = jsontemplate.Template(body, **options)
+
+  # First, since the peak RSS only goes up
+  rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+  output = t.expand(data)
+  rss_after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+  if isinstance(output, unicode):
+    output = output.encode('utf-8')
+
+  tokenize = BestTime(
+      lambda: list(jsontemplate._Tokenize(body, meta_left, meta_right,
+                                          whitespace)))
+  compile_ = BestTime(lambda: jsontemplate.Template(body, **options))
+  expand = BestTime(lambda: t.expand(data))
+
+  return {
+      'tokenize_ms': tokenize * 1e3,
+      'compile_ms': compile_ * 1e3,
+      'expand_ms': expand * 1e3,
+      'output_bytes': len(output),
+      'mb_per_sec': len(output) / expand / 1e6,
+      'peak_rss_kb': rss_after - rss_before,
+      }
+
+
+def Compare(results, baseline, tolerance):
+  """Prints a comparison.
+
+  Returns:
+    The number of regressions.
+  """
+  num_regressions = 0
+  print '%-22s %-12s %12s %12s %8s' % (
+      'workload', 'metric', 'baseline', 'new', 'change')
+  for name in sorted(results):
+    if name not in baseline:
+      continue
+    for metric, bigger_is_better in _METRICS:
+      old = baseline[name][metric]
+      new = results[name][metric]
+      if metric == 'peak_rss_kb' and abs(new - old) < _MIN_RSS_CHANGE_KB:
+        change = 0.0
+      elif old:
+        change = float(new - old) / old
+      else:
+        change = 0.0 if new == old else float('inf')
+      worse = -change if bigger_is_better else change
+      if worse > tolerance:
+        note = 'REGRESSION'
+        num_regressions += 1
+      elif worse < -tolerance:
+        note = 'better'
+      else:
+        note = ''
+      print '%-22s %-12s %12.3f %12.3f %+7.1f%% %s' % (
+          name, metric, old, new, change * 100, note)
+  return num_regressions
+
+
+def main(argv):
+  parser = optparse.OptionParser()
+  parser.add_option('--output', help='Write results to this JSON file')
+  parser.add_option('--baseline', help='Compare against this JSON file')
+  parser.add_option('--tolerance', type='float', default=0.1,
+                    help='Fractional change that counts as a regression')
+  parser.add_option('--filter', default='',
+                    help='Only run workloads whose names contain this')
+  parser.add_option('--run-one', help=optparse.SUPPRESS_HELP)
+  opts, _ = parser.parse_args(argv[1:])
+
+  if opts.run_one:  # In the child process
+    print json.dumps(RunWorkload(opts.run_one))
+    return 0
+
+  results = {}
+  for name, _ in WORKLOADS:
+    if opts.filter not in name:
+      continue
+    output = subprocess.check_output(
+        [sys.executable, os.path.abspath(__file__), '--run-one', name])
+    r = results[name] = json.loads(output)
+    print >>sys.stderr, (
+        '%-22s tokenize %8.3f ms  compile %8.3f ms  expand %9.3f ms  '
+        '%7.1f MB/s  peak +%d KB' % (
+            name, r['tokenize_ms'], r['compile_ms'], r['expand_ms'],
+            r['mb_per_sec'], r['peak_rss_kb']))
+
+  if opts.output:
+    with open(opts.output, 'w') as f:
+      json.dump({'python': sys.version.split()[0], 'results': results}, f,
+                indent=2, sort_keys=True)
+
+  if opts.baseline:
+    with open(opts.baseline) as f:
+      baseline = json.load(f)['results']
+    if Compare(results, baseline, opts.tolerance):
+      return 1
+  return 0
+
+
+if __name__ == '__main__':
+  sys.exit(main(sys.argv))
@@ -15,4 +15,24 @@ test-formatter() {
   echo '{"num": 0.0000012345}' | jsont --template '[{num|printf %.3f}]'
 }
 
+test-stream() {
+  echo '{"title": "t", "items": [1, 2, 3], "end": "e"}' |
+    jsont --stream-path items \
+      --template '{title} {.repeated section items}{@}{.alternates with},{.end} {end}'
+}
+
+test-ndjson() {
+  printf '{"foo": 1}\n{"foo": 2}\n{"foo": 3}\n' |
+    jsont --ndjson --jobs 2 --record-separator '|' --template '[{foo}]'
+}
+
+test-serve() {
+  local sock=/tmp/jsont-test.sock
+  jsont serve --socket $sock &
+  local pid=$!
+  sleep 1
+  echo '{"foo": "bar"}' | jsont --socket $sock --template '[{foo}]'
+  kill $pid
+}
+
 "$@"
@@ -3,6 +3,7 @@
 
 Usage:
   jsont [options] [<template-file>]
+  jsont serve --socket=PATH [--cache-size=N]
   jsont -h | --help
   jsont --version
 
@@ -11,8 +12,33 @@ Options:
       Read input as either JSON or TNET.  (TODO: autodetect it?)
   --template=TEMPLATE
       Inline template, rather than reading it from a file.
+  --optimizer-stats
+      Print the number of statements in the program before and after
+      optimization to stderr.
+  --stream
+      Parse the input incrementally.  The top-level array, or the array at
+      --stream-path, is expanded as it's read, so the input doesn't have to fit
+      in memory.
+  --stream-path=PATH
+      The path of the array to stream, like 'results.items'.  Implies --stream.
+  --ndjson
+      Read newline-delimited JSON, and expand the template once for each
+      record.  Blank lines are ignored.
+  --jobs=N
+      With --ndjson, expand records in N worker processes.  Output is in the
+      same order as the input.  [default: 1]
+  --record-separator=SEP
+      With --ndjson, a string to write after each record.
+  --socket=PATH
+      With 'serve', listen on this Unix socket and expand templates for
+      clients.  Otherwise, have the server listening on it do the expansion,
+      which avoids compiling the template in this process.
+  --cache-size=N
+      Number of compiled templates the server keeps.  [default: 100]
 """
 
+import itertools
+import os
 import sys
 try:
   import json
@@ -21,6 +47,7 @@ except ImportError:
 
 import jsontemplate
 from jsontemplate import formatters
+from jsontemplate import jsonstream
 
 import docopt
 
@@ -28,11 +55,150 @@ class UsageError(Exception):
   pass
 
 
+def MakeTemplate(template_str):
+  # TODO: add more?
+  more_formatters = formatters.PythonPercentFormat
+  return jsontemplate.FromString(template_str,
+                                 more_formatters=more_formatters,
+                                 # TODO: add more?
+                                 more_predicates=None)
+
+
+# The template for --ndjson, set in each worker process
+_template = None
+
+
+def _InitWorker(template_str):
+  global _template
+  _template = MakeTemplate(template_str)
+
+
+def _ExpandRecord(args):
+  """Returns the expansion of one line of --ndjson input."""
+  line_num, line = args
+  try:
+    return _template.expand(json.loads(line))
+  except ValueError, e:
+    raise RuntimeError('Line %d: Invalid JSON input: %s' % (line_num, e))
+  except jsontemplate.EvaluationError, e:
+    raise RuntimeError('Line %d: %s' % (line_num, e))
+
+
+def _ExpandRecordInWorker(args):
+  """Returns the error instead of raising it.
+
+  Pool.imap() drops a whole chunk of results when one of them raises, but the
+  records before the error should still be written.
+  """
+  try:
+    return _ExpandRecord(args)
+  except RuntimeError, e:
+    return e
+
+
+def _ReadRecords(f):
+  """Yields (line number, line) for non-blank lines."""
+  for line_num, line in enumerate(f, 1):
+    if line.strip():
+      yield line_num, line
+
+
+def ExpandNdjson(template_str, f, out, jobs=1, separator='', template=None):
+  """Expands a template for each line of newline-delimited JSON.
+
+  Args:
+    template: The template compiled from template_str, if the caller has it.
+        With jobs > 1, each worker compiles its own.
+  """
+  global _template
+  buf = jsontemplate.ByteBuffer(out)
+  records = _ReadRecords(f)
+
+  try:
+    if jobs == 1:
+      _template = template or MakeTemplate(template_str)
+      for record in records:
+        buf.write(_ExpandRecord(record))
+        buf.write(separator)
+    else:
+      # Imported here since it's slow to import
+      import multiprocessing
+      pool = multiprocessing.Pool(jobs, _InitWorker, (template_str,))
+      try:
+        # Pool.imap() would read all the input at once, so hand it a batch of
+        # records at a time.
+        batch_size = jobs * 256
+        while True:
+          batch = list(itertools.islice(records, batch_size))
+          if not batch:
+            break
+          for expanded in pool.imap(_ExpandRecordInWorker, batch,
+                                    chunksize=32):
+            if isinstance(expanded, RuntimeError):
+              raise expanded
+            buf.write(expanded)
+            buf.write(separator)
+      finally:
+        pool.terminate()
+        pool.join()
+  finally:
+    # Records before a failing one are still written
+    buf.flush()
+
+
+def Serve(socket_path, cache_size):
+  # Imported here since the socket modules are slow to import
+  from jsontemplate import server
+  s = server.Server(socket_path, MakeTemplate, cache_size=cache_size)
+  try:
+    s.serve_forever()
+  except KeyboardInterrupt:
+    pass
+  finally:
+    s.server_close()
+
+
+def RunClient(socket_path, opts):
+  """Sends the template reference and input to a server."""
+  import socket
+  from jsontemplate import server
+
+  if opts['--ndjson'] or opts['--stream'] or opts['--stream-path']:
+    raise UsageError('--socket only works with a single JSON document')
+
+  if opts['--template']:
+    header = {'template': opts['--template'] + '\n'}
+  elif opts['<template-file>']:
+    # The server's working directory may be different
+    header = {'path': os.path.abspath(opts['<template-file>'])}
+  else:
+    raise UsageError("A template file or inline template is required.")
+
+  try:
+    result = server.Request(socket_path, header, sys.stdin.read())
+  except (socket.error, EOFError), e:
+    raise RuntimeError("Couldn't get a response from %s: %s" % (socket_path, e))
+  sys.stdout.write(result)
+
+
 def main(argv):
   """Returns an exit code."""
 
   opts = docopt.docopt(__doc__, version='jsont 0.1')
 
+  if opts['serve']:
+    try:
+      cache_size = int(opts['--cache-size'])
+    except ValueError:
+      raise UsageError(
+          '--cache-size should be an integer, got %r' % opts['--cache-size'])
+    Serve(opts['--socket'], cache_size)
+    return 0
+
+  if opts['--socket']:
+    RunClient(opts['--socket'], opts)
+    return 0
+
   if opts['--template']:
     # TODO: Could provide an option to suppress this newline.
     template_str = opts['--template'] + '\n'
@@ -47,16 +213,33 @@ def main(argv):
     else:
       raise UsageError("A template file or inline template is required.")
 
-  # TODO: add more?
-  more_formatters = formatters.PythonPercentFormat
-  t = jsontemplate.FromString(template_str,
-                              more_formatters=more_formatters,
-                              # TODO: add more?
-                              more_predicates=None)
-
-  dictionary = json.load(sys.stdin)
-  s = t.expand(dictionary)
-  sys.stdout.write(s.encode('utf-8'))
+  t = MakeTemplate(template_str)
+
+  if opts['--optimizer-stats']:
+    stats = t.optimizer_stats
+    for name in sorted(stats):
+      print >>sys.stderr, '%s: %d' % (name, stats[name])
+
+  if opts['--ndjson']:
+    try:
+      jobs = int(opts['--jobs'])
+    except ValueError:
+      raise UsageError('--jobs should be an integer, got %r' % opts['--jobs'])
+    if jobs < 1:
+      raise UsageError('--jobs should be at least 1')
+    ExpandNdjson(template_str, sys.stdin, sys.stdout, jobs=jobs,
+                 separator=opts['--record-separator'] or '', template=t)
+    return 0
+
+  try:
+    if opts['--stream'] or opts['--stream-path']:
+      # Output is written as the array is parsed
+      dictionary = jsonstream.Load(sys.stdin, path=opts['--stream-path'])
+    else:
+      dictionary = json.load(sys.stdin)
+    t.execute_to(dictionary, sys.stdout, encoding='utf-8')
+  except jsonstream.ParseError, e:
+    raise RuntimeError('Invalid JSON input: %s' % e)
   return 0
 
 
@@ -1582,6 +1582,8 @@ def main(argv):
   options = cmdapp.ParseArgv(argv, run_params)
 
   int_py_verifier = python_verifier.InternalTemplateVerifier()
+  codegen_verifier = python_verifier.CodeGenVerifier()
+  streaming_verifier = python_verifier.StreamingVerifier()
 
   python_impl = os.path.join(this_dir, 'python', 'expand.py')
   py_verifier = python_verifier.ExternalVerifier(python_impl)
@@ -1611,6 +1613,8 @@ def main(argv):
   multi_tests = taste.GetTestClasses(__import__(__name__), filt)
 
   internal_tests = [m(int_py_verifier) for m in multi_tests]
+  internal_tests.extend(m(codegen_verifier) for m in multi_tests)
+  internal_tests.extend(m(streaming_verifier) for m in multi_tests)
 
   # External versions
   if options.all_tests:
@@ -61,20 +61,23 @@ __all__ = [
     'TemplateSyntaxError', 'UndefinedVariable',
     # API
     'FromString', 'FromFile', 'Template', 'expand', 'Trace', 'FunctionRegistry',
-    'MakeTemplateGroup',
+    'MakeTemplateGroup', 'TokenBuffer', 'ByteBuffer', 'AsyncValue', 'LazyValue',
+    'StreamedList', 'SafeStr', 'SafeUnicode', 'MarkSafe', 'PureFunction',
+    'BatchFunction', 'ViewCache',
     # Function API
     'SIMPLE_FUNC', 'ENHANCED_FUNC']
 
 import StringIO
+import itertools
+import operator
 import pprint
 import re
 import sys
 
-# For formatters
-import cgi  # cgi.escape
+# For formatters.  urllib and urlparse are slow to import and only used by a few
+# formatters, so they're imported the first time they're used; see _Urllib().
+# cgi is also slow, so we don't use cgi.escape.
 import time  # for strftime
-import urllib  # for urllib.encode
-import urlparse  # for urljoin
 
 
 class Error(Exception):
@@ -88,12 +91,15 @@ class Error(Exception):
     """This helps people debug their templates.
 
     If a variable isn't defined, then some context is shown in the traceback.
-    TODO: Attach context for other errors.
+    Compilation errors show the position of the offending token.
     """
+    msg = self.args[0]
+    if getattr(self, 'line', None) is not None:
+      msg = '%s (line %d, column %d)' % (msg, self.line, self.column)
     if hasattr(self, 'near'):
-      return '%s\n\nNear: %s' % (self.args[0], pprint.pformat(self.near))
+      return '%s\n\nNear: %s' % (msg, pprint.pformat(self.near))
     else:
-      return self.args[0]
+      return msg
 
 
 class UsageError(Error):
@@ -166,7 +172,9 @@ class FunctionRegistry(object):
 
     Returns:
       A 2-tuple of (function, args)
-        function: Callable that formats data as a string
+        function: Callable that formats data as a string.  A formatter may be
+          wrapped in PureFunction to cache its results, or in BatchFunction
+          to format columns of repeated sections at once.
         args: Extra arguments to be passed to the function at expansion time
           Should be None to pass NO arguments, since it can pass a 0-tuple too.
     """
@@ -223,11 +231,29 @@ class PrefixRegistry(FunctionRegistry):
     Args:
       functions: List of 2-tuples (prefix, function), e.g.
       [('pluralize', _Pluralize), ('cycle', _Cycle)]
+
+      A 3-tuple (prefix, function, parse_args) may be used to parse the
+      arguments once at compile time.  parse_args is passed the list of
+      arguments, and returns the args that the function is called with.
     """
     self.functions = functions
+    # First character -> entries whose prefix starts with it, in order.  None
+    # if there's an empty prefix, which matches everything.
+    self.index = {}
+    for entry in functions:
+      prefix = entry[0]
+      if not prefix:
+        self.index = None
+        break
+      self.index.setdefault(prefix[0], []).append(entry)
 
   def Lookup(self, user_str):
-    for prefix, func in self.functions:
+    if self.index is None:
+      entries = self.functions
+    else:
+      entries = self.index.get(user_str[:1], ())
+    for entry in entries:
+      prefix, func = entry[:2]
       if user_str.startswith(prefix):
         i = len(prefix)
 
@@ -239,6 +265,8 @@ class PrefixRegistry(FunctionRegistry):
         else:
           args = user_str.split(splitchar)[1:]
 
+        if len(entry) == 3:
+          args = entry[2](args)
         return func, args
     return None, ()
 
@@ -249,6 +277,8 @@ class _TemplateRef(object):
   The _TemplateRef sits statically in the program tree as one of the formatters.
   At runtime, _DoSubstitute calls Resolve() with the group being used.
   """
+  __slots__ = ('name', 'template')
+
   def __init__(self, name=None, template=None):
     self.name = name
     self.template = template  # a template that's already been resolved
@@ -313,6 +343,220 @@ class ChainedRegistry(FunctionRegistry):
     return None, None, SIMPLE_FUNC
 
 
+# Returned by _GenerationalCache.Get()
+_NOT_CACHED = object()
+
+
+class _GenerationalCache(object):
+  """A bounded cache that keeps the most recently used entries.
+
+  It approximates an LRU cache with two dictionaries.  New entries go in the
+  young generation; when that's full, it becomes the old generation, and the
+  previous old generation is dropped.  An entry found in the old generation is
+  moved back to the young one.  (collections.OrderedDict is written in Python,
+  and moving an entry to the end costs as much as the formatters we're caching.)
+  """
+
+  __slots__ = ('generation_size', 'young', 'old')
+
+  def __init__(self, max_size):
+    self.generation_size = max_size // 2
+    self.young = {}
+    self.old = {}
+
+  def __len__(self):
+    return len(self.young) + len(self.old)
+
+  def Get(self, key):
+    """
+    Returns:
+      The value, or _NOT_CACHED.
+
+    Raises:
+      TypeError if the key isn't hashable.
+    """
+    value = self.young.get(key, _NOT_CACHED)
+    if value is _NOT_CACHED:
+      value = self.old.pop(key, _NOT_CACHED)
+      if value is not _NOT_CACHED:
+        self.Put(key, value)
+    return value
+
+  def Put(self, key, value):
+    if len(self.young) >= self.generation_size:
+      self.old = self.young
+      self.young = {}
+    self.young[key] = value
+
+  def Clear(self):
+    self.young = {}
+    self.old = {}
+
+
+# Types of formatter arguments that templates can share
+_IMMUTABLE_ARGS = (basestring, int, long, float)
+
+
+class _MemoizedRegistry(FunctionRegistry):
+  """Remembers the lookups of another registry.
+
+  The other registry must always return the same result for the same string.
+  This is used for the default formatters and predicates, which are shared by
+  all templates.  (User registries are looked up every time, since they could
+  change.)
+
+  Only lookups whose arguments are strings or numbers are remembered.  Others,
+  like the _StrftimeFormat of 'strftime', have state of their own, so each
+  template gets a new one.
+  """
+
+  def __init__(self, registry, max_size=1000):
+    self.registry = registry
+    self.memo = _GenerationalCache(max_size)  # user_str -> (func, args, type)
+
+  def LookupWithType(self, user_str):
+    result = self.memo.Get(user_str)
+    if result is _NOT_CACHED:
+      func, args, func_type = self.registry.LookupWithType(user_str)
+      if args is not None:
+        for arg in args:
+          if not isinstance(arg, _IMMUTABLE_ARGS):
+            return func, args, func_type
+        args = tuple(args)  # Not a list that a template could change
+      result = func, args, func_type
+      self.memo.Put(user_str, result)
+    return result
+
+
+class PureFunction(object):
+  """Declares that a formatter's result depends only on its value and arguments.
+
+  Wrap a formatter in PureFunction, and return it from a dictionary, function,
+  or FunctionRegistry of formatters.  Results are then cached, keyed by the
+  value and the formatter's arguments, so a formatter that's applied to the
+  same value in every row of a table is only called once:
+
+    more_formatters={'category-name': PureFunction(LookupCategoryName)}
+
+  Values that aren't hashable, like lists and dictionaries, aren't cached.
+
+  The counters 'hits', 'misses' and 'uncacheable' are public, for monitoring.
+  They're summed over every template and expansion using the formatter, and may
+  be approximate when several threads are expanding.
+  """
+
+  def __init__(self, func, max_size=1000, scope='process'):
+    """
+    Args:
+      func: The formatter.  Whether it takes a context is decided by the
+          registry as usual, e.g. by the case of its name.
+      max_size: The number of results to keep in each cache.
+      scope: 'process' to keep one cache for the life of the process, or
+          'expansion' to use a new cache for each expansion of a template.
+    """
+    if scope not in ('process', 'expansion'):
+      raise ConfigurationError('Invalid scope %r' % scope)
+    if max_size < 2:
+      raise ConfigurationError('max_size should be at least 2')
+    self.func = func
+    self.max_size = max_size
+    self.scope = scope
+    self.cache = _GenerationalCache(max_size)  # For the 'process' scope
+    self.hits = 0
+    self.misses = 0
+    self.uncacheable = 0
+
+  def __call__(self, *args):
+    # Not cached, e.g. if it's used as a predicate
+    return self.func(*args)
+
+  def Clear(self):
+    """Empties the process-wide cache."""
+    self.cache.Clear()
+
+  def Bind(self, func_type):
+    """Returns a formatter with the same result that consults the cache.
+
+    It's called at compile time by _ProgramBuilder.  The returned formatter is
+    always an ENHANCED_FUNC, since 'expansion' caches are kept in the context.
+    """
+    func = self.func
+    simple = func_type == SIMPLE_FUNC
+    process_cache = self.cache if self.scope == 'process' else None
+
+    def CachedFormatter(value, context, args):
+      cache = process_cache
+      if cache is None:
+        cache = context.FormatterCache(self)
+      # 1, 1.0 and True are equal, but they're formatted differently
+      key = (type(value), value, args)
+      try:
+        result = cache.Get(key)
+      except TypeError:  # Unhashable
+        self.uncacheable += 1
+        if simple:
+          return func(value)
+        return func(value, context, args)
+
+      if result is not _NOT_CACHED:
+        self.hits += 1
+        return result
+      self.misses += 1
+      if simple:
+        result = func(value)
+      else:
+        result = func(value, context, args)
+      cache.Put(key, result)
+      return result
+
+    # For analysis.py, since the wrapper always takes a context
+    CachedFormatter.func_type = func_type
+    return CachedFormatter
+
+
+class BatchFunction(object):
+  """Declares that a formatter can also format a whole column at once.
+
+  In a repeated section, a substitution whose formatters can all format columns
+  is formatted once for the whole list, before the rows are expanded:
+
+    more_formatters={'price': BatchFunction(FormatPrice, FormatPrices)}
+
+  column_func is passed a sequence of values and returns a list with what func
+  would return for each one.  The sequence is a list, or a column of the data,
+  like a NumPy array (see _ToColumnTable).  If func takes a context, then
+  column_func is passed the context and args too, but the context is the
+  section's rather than a row's, so formatters like 'cycle' can't be batched.
+
+  If column_func can't format a value, it should return None for it, or raise
+  an exception.  Then the column is formatted a row at a time instead, so
+  errors are reported as usual, in the order of the rows.
+  """
+
+  def __init__(self, func, column_func):
+    self.func = func
+    self.column_func = column_func
+
+  def __call__(self, *args):
+    # Not batched, e.g. if it's used as a predicate
+    return self.func(*args)
+
+
+def _MakeRegistry(functions):
+  """Returns a FunctionRegistry for user formatters or predicates, or None.
+
+  Passing a dictionary or a function is often more convenient than making a
+  FunctionRegistry.  None means there aren't any.
+  """
+  if functions is None:
+    return None
+  if isinstance(functions, dict):
+    return DictRegistry(functions)
+  if callable(functions):
+    return CallableRegistry(functions)
+  return functions
+
+
 class _ProgramBuilder(object):
   """
   Receives method calls from the parser, and constructs a tree of _Section()
@@ -328,46 +572,22 @@ class _ProgramBuilder(object):
     self.current_section = _Section(None)
     self.stack = [self.current_section]
 
-    # Passing a dictionary or a function is often more convenient than making a
-    # FunctionRegistry
-    if isinstance(formatters, dict):
-      formatters = DictRegistry(formatters)
-    elif callable(formatters):
-      formatters = CallableRegistry(formatters)
-
-    # default formatters with arguments
-    default_formatters = PrefixRegistry([
-        ('pluralize', _Pluralize),
-        ('cycle', _Cycle),
-        # These have to go first because 'strftime' is a prefix of
-        # strftime-local/gm!
-        ('strftime-local', _StrftimeLocal),  # local
-        ('strftime-gm', _StrftimeGm),  # world
-        ('strftime', _StrftimeLocal),  # local by default
-        ])
-
     # First consult user formatters, then templates enabled by
     # MakeTemplateGroup, then the default formatters
-    self.formatters = ChainedRegistry([
-        formatters,
-        template_registry,  # returns _TemplateRef instances
-        DictRegistry(_DEFAULT_FORMATTERS),
-        default_formatters])
+    registries = [template_registry,  # returns _TemplateRef instances
+                  _DEFAULT_FORMATTER_REGISTRY]
+    formatters = _MakeRegistry(formatters)
+    if formatters:
+      registries.insert(0, formatters)
+    self.formatters = ChainedRegistry(registries)
 
     # Same for predicates
-    if isinstance(predicates, dict):
-      predicates = DictRegistry(predicates)
-    elif callable(predicates):
-      predicates = CallableRegistry(predicates)
-
-    # default predicates with arguments
-    default_predicates = PrefixRegistry([
-        ('test', _TestAttribute),
-        ('template', _TemplateExists),
-        ])
-
-    self.predicates = ChainedRegistry(
-        [predicates, DictRegistry(_DEFAULT_PREDICATES), default_predicates])
+    predicates = _MakeRegistry(predicates)
+    if predicates:
+      self.predicates = ChainedRegistry(
+          [predicates, _DEFAULT_PREDICATE_REGISTRY])
+    else:
+      self.predicates = _DEFAULT_PREDICATE_REGISTRY
 
   def Append(self, statement):
     """
@@ -380,11 +600,34 @@ class _ProgramBuilder(object):
     """
     The user's formatters are consulted first, then the default formatters.
     """
+    return self._LookupFormatter(format_str)[0]
+
+  def _LookupFormatter(self, format_str):
+    """Like _GetFormatter, but also returns the column version, or None.
+
+    Returns:
+      A 2-tuple (formatter, column formatter).  Each is a (function, args,
+      func_type) tuple, and the column formatter may be None.  See
+      BatchFunction.
+    """
     formatter, args, func_type = self.formatters.LookupWithType(format_str)
-    if formatter:
-      return formatter, args, func_type
+    column_type = func_type  # PureFunction doesn't wrap the column function
+    if isinstance(formatter, BatchFunction):
+      column_func = formatter.column_func
+      formatter = formatter.func
     else:
+      column_func = _COLUMN_FORMATTERS.get(formatter)
+    if isinstance(formatter, PureFunction):
+      formatter = formatter.Bind(func_type)
+      if args is not None:
+        args = tuple(args)  # Part of the cache key, so it must be hashable
+      func_type = ENHANCED_FUNC
+    if not formatter:
       raise BadFormatter('%r is not a valid formatter' % format_str)
+    column_formatter = None
+    if column_func is not None:
+      column_formatter = column_func, args, column_type
+    return (formatter, args, func_type), column_formatter
 
   def _GetPredicate(self, pred_str, test_attr=False):
     """
@@ -406,15 +649,25 @@ class _ProgramBuilder(object):
     return pred
 
   def AppendSubstitution(self, name, formatters):
-    formatters = [self._GetFormatter(f) for f in formatters]
-    self.current_section.Append((_DoSubstitute, (name, formatters)))
+    pairs = [self._LookupFormatter(f) for f in formatters]
+    args = (_ParsePath(name), [formatter for formatter, _ in pairs])
+    column_formatters = [column_formatter for _, column_formatter in pairs]
+
+    # Substitutions that are expanded for every item of a repeated section can
+    # be formatted a column at a time.  See _FormatColumns.
+    section = self.current_section
+    if (isinstance(section, _RepeatedSection) and
+        section.current_clause is section.Statements() and
+        column_formatters and None not in column_formatters):
+      section.batched.append((args, column_formatters))
+
+    section.Append((_DoSubstitute, args))
 
   def AppendTemplateSubstitution(self, name):
     # {.template BODY} is semantically something like {$|template BODY}, where $
     # is the root
     formatters = [self._GetFormatter('template ' + name)]
-    # None as the name indicates we use the context.Root()
-    self.current_section.Append((_DoSubstitute, (None, formatters)))
+    self.current_section.Append((_DoSubstitute, (_ROOT, formatters)))
 
   def _NewSection(self, func, new_block):
     self.current_section.Append((func, new_block))
@@ -427,6 +680,16 @@ class _ProgramBuilder(object):
 
     # TODO: Consider getting rid of this dispatching, and turn _Do* into methods
     if token_type == REPEATED_SECTION_TOKEN:
+      # The result of the last pre-formatters is only iterated over, so they
+      # can return views rather than copying, e.g. for {.repeated section
+      # items|reverse|slice 0 10}.
+      i = num_views = len(pre_formatters)
+      while i and pre_formatters[i - 1][0] in _SECTION_VIEWS:
+        i -= 1
+        func, args, unused_func_type = pre_formatters[i]
+        pre_formatters[i] = (_SECTION_VIEWS[func], args, ENHANCED_FUNC)
+      if i != num_views:
+        pre_formatters.append((_MaterializeView, None, SIMPLE_FUNC))
       new_block = _RepeatedSection(section_name, pre_formatters)
       func = _DoRepeatedSection
     elif token_type == SECTION_TOKEN:
@@ -473,6 +736,8 @@ class _ProgramBuilder(object):
 
 class _AbstractSection(object):
 
+  __slots__ = ('current_clause',)
+
   def __init__(self):
     # Pairs of func, args, or a literal string
     self.current_clause = []
@@ -492,6 +757,8 @@ class _AbstractSection(object):
 class _Section(_AbstractSection):
   """Represents a (repeated) section."""
 
+  __slots__ = ('section_name', 'section_path', 'pre_formatters', 'statements')
+
   def __init__(self, section_name, pre_formatters=[]):
     """
     Args:
@@ -502,6 +769,10 @@ class _Section(_AbstractSection):
     """
     _AbstractSection.__init__(self)
     self.section_name = section_name
+    if section_name is None:
+      self.section_path = None
+    else:
+      self.section_path = _ParseSectionName(section_name)
     self.pre_formatters = pre_formatters
 
     # Clauses is just a string and a list of statements.
@@ -524,14 +795,29 @@ class _Section(_AbstractSection):
 class _RepeatedSection(_Section):
   """Repeated section is like section, but it supports {.alternates with}"""
 
+  __slots__ = ('batched',)
+
+  def __init__(self, section_name, pre_formatters=[]):
+    _Section.__init__(self, section_name, pre_formatters)
+    # Substitutions in the default clause that can be formatted a column at a
+    # time: a list of (args of the _DoSubstitute statement, formatters that
+    # take columns).
+    self.batched = []
+
   def AlternatesWith(self):
     self.current_clause = []
     self.statements['alternates with'] = self.current_clause
 
 
+def _AlwaysTrue(unused_value):
+  return True
+
+
 class _PredicateSection(_AbstractSection):
   """Represents a sequence of predicate clauses."""
 
+  __slots__ = ('clauses',)
+
   def __init__(self):
     _AbstractSection.__init__(self)
     # List of func, statements
@@ -539,18 +825,163 @@ class _PredicateSection(_AbstractSection):
 
   def NewOrClause(self, pred):
     # {.or} always executes if reached
-    pred = pred or (lambda x: True, None, SIMPLE_FUNC)  # 3-tuple
+    pred = pred or (_AlwaysTrue, None, SIMPLE_FUNC)  # 3-tuple
     self.current_clause = []
     self.clauses.append((pred, self.current_clause))
 
 
+class LazyValue(object):
+  """A data value that is computed only if the template uses it.
+
+  Put these in the data dictionary for values that are expensive to compute,
+  like counts and related lists.  When a substitution, section, predicate or
+  dotted name reaches the value, func(*args) is called, and the result is used
+  in its place.  It's called at most once per expansion.
+  """
+
+  def __init__(self, func, *args):
+    self.func = func
+    self.args = args
+
+
+class _VariablePath(object):
+  """A variable name, parsed at compile time.
+
+  Expansion calls Lookup(), so it does no string parsing.  There's a subclass
+  for each kind of name.
+  """
+
+  __slots__ = ('name', 'rest')
+
+  def __init__(self, name, rest=()):
+    self.name = name  # For error messages
+    self.rest = rest  # Names to look up in the value, e.g. ('bar', 'baz')
+
+  def __repr__(self):
+    return '<%s %r>' % (self.__class__.__name__, self.name)
+
+  def _LookUpRest(self, value, context):
+    for part in self.rest:
+      try:
+        value = value[part]
+      except (KeyError, TypeError):  # TypeError for non-dictionaries
+        return context._Undefined(part)
+      if isinstance(value, LazyValue):
+        value = context.Resolve(value)
+    return value
+
+
+class _CursorPath(_VariablePath):
+  """{@}"""
+
+  __slots__ = ()
+
+  def Lookup(self, context):
+    return context.stack[-1].context
+
+
+class _RootPath(_VariablePath):
+  """The data dictionary passed to expand(), for {.template FOO}."""
+
+  __slots__ = ()
+
+  def Lookup(self, context):
+    return context.root
+
+
+class _IndexPath(_VariablePath):
+  """{@index}"""
+
+  __slots__ = ()
+
+  def Lookup(self, context):
+    for frame in reversed(context.stack):
+      if frame.index != -1:  # -1 is undefined
+        return self._LookUpRest(frame.index, context)  # @index is 1-based
+    return context._Undefined('@index')
+
+
+class _NamePath(_VariablePath):
+  """{foo} or {foo.bar.baz}.  'foo' is looked up the stack."""
+
+  __slots__ = ('first',)
+
+  def __init__(self, name, first, rest):
+    _VariablePath.__init__(self, name, rest)
+    self.first = first
+
+  def Lookup(self, context):
+    first = self.first
+    for frame in reversed(context.stack):
+      mapping = frame.mapping
+      if mapping is not None:
+        try:
+          value = mapping[first]
+        except KeyError:
+          continue
+        if isinstance(value, LazyValue):
+          value = context.Resolve(value)
+        if self.rest:
+          return self._LookUpRest(value, context)
+        return value
+    return context._Undefined(first)
+
+
+class _SectionPath(_VariablePath):
+  """{.section foo}.  Unlike substitutions, only the top of the stack is used."""
+
+  __slots__ = ()
+
+  def Lookup(self, context):
+    top = context.stack[-1].context
+    try:
+      value = top.get(self.name)
+    except AttributeError:  # no .get()
+      raise EvaluationError(
+          "Can't get name %r from top value %s" % (self.name, top))
+    if isinstance(value, LazyValue):
+      value = context.Resolve(value)
+    return value
+
+
+_CURSOR = _CursorPath('@')
+_ROOT = _RootPath(None)
+
+
+def _ParsePath(name):
+  """Returns a _VariablePath for a substitution like {foo.bar}."""
+  if name == '@':
+    return _CURSOR
+  parts = name.split('.')
+  if parts[0] == '@index':
+    return _IndexPath(name, tuple(parts[1:]))
+  return _NamePath(name, parts[0], tuple(parts[1:]))
+
+
+def _ParseSectionName(name):
+  """Returns a _VariablePath for a section like {.section foo}."""
+  if name == '@':
+    return _CURSOR
+  return _SectionPath(name)
+
+
 class _Frame(object):
-  """A stack frame."""
+  """A stack frame.
+
+  _ScopedContext reuses frames, so there are no allocations when entering
+  sections and iterating, except the first time.
+  """
+
+  __slots__ = ('context', 'index', 'mapping')
 
   def __init__(self, context, index=-1):
     # Public attributes
     self.context = context
     self.index = index   # An iteration index.  -1 means we're NOT iterating.
+    # The context if names can be looked up in it, i.e. it's not a list or atom
+    self.mapping = None
+    if hasattr(context, 'get'):
+      self.mapping = context
 
   def __str__(self):
     return 'Frame %s (%s)' % (self.context, self.index)
@@ -561,25 +992,91 @@ class _ScopedContext(object):
 
   If the variable isn't in the current context, then we search up the stack.
   This object also stores the group.
+
+  Popped frames are kept in a free list and reused.  Template also reuses
+  these objects across expansions; see Reset() and Release().
   """
 
-  def __init__(self, context, undefined_str, group=None):
+  __slots__ = ('stack', 'free_frames', 'undefined_str', 'group', 'root',
+               'is_async', 'parallel', 'lazy_values', 'formatter_caches',
+               'view_cache')
+
+  def __init__(self, context, undefined_str, group=None, view_cache=None):
     """
     Args:
       context: The root context
       undefined_str: See Template() constructor.
       group: Used by the {.if template FOO} predicate, and _DoSubstitute
           which is passed the context.
+      view_cache: See Template() constructor.
     """
     self.stack = [_Frame(context)]
+    self.free_frames = []
     self.undefined_str = undefined_str
     self.group = group  # used by _DoSubstitute?
     self.root = context
+    self.is_async = False  # Set for execute_async()
+    self.parallel = None  # _ParallelOptions, set for execute_parallel()
+    self.lazy_values = {}  # LazyValue -> value, for this expansion
+    # PureFunction -> _GenerationalCache, for this expansion
+    self.formatter_caches = {}
+    self.view_cache = view_cache
 
   def Root(self):
     """For {.template FOO} substitution."""
     return self.root
 
+  def Reset(self, context, group):
+    """Prepare to expand the same template again, with new data."""
+    stack = self.stack
+    while len(stack) > 1:  # In case the last expansion raised an exception
+      self.free_frames.append(stack.pop())
+    frame = stack[0]
+    frame.context = context
+    frame.index = -1
+    frame.mapping = None
+    if hasattr(context, 'get'):
+      frame.mapping = context
+    self.group = group
+    self.root = context
+
+  def Release(self):
+    """Drop references to the data, so it can be freed while we're unused."""
+    for frame in self.stack:
+      frame.context = frame.mapping = None
+    for frame in self.free_frames:
+      frame.context = frame.mapping = None
+    self.group = self.root = None
+    self.lazy_values.clear()
+    self.formatter_caches.clear()
+
+  def Copy(self):
+    """Returns a copy with its own stack, for expanding in another thread."""
+    context = _ScopedContext(self.root, self.undefined_str, group=self.group,
+                             view_cache=self.view_cache)
+    context.stack = [_Frame(frame.context, frame.index) for frame in self.stack]
+    context.lazy_values = self.lazy_values
+    context.formatter_caches = self.formatter_caches
+    return context
+
+  def Resolve(self, lazy_value):
+    """Returns the value of a LazyValue, computing it once per expansion."""
+    try:
+      return self.lazy_values[lazy_value]
+    except KeyError:
+      value = lazy_value.func(*lazy_value.args)
+      self.lazy_values[lazy_value] = value
+      return value
+
+  def FormatterCache(self, pure_function):
+    """Returns the cache for a PureFunction with the 'expansion' scope."""
+    try:
+      return self.formatter_caches[pure_function]
+    except KeyError:
+      cache = _GenerationalCache(pure_function.max_size)
+      self.formatter_caches[pure_function] = cache
+      return cache
+
   def HasTemplate(self, name):
     if not self.group:  # Could be None?
       return False
@@ -591,16 +1088,14 @@ class _ScopedContext(object):
     Returns:
       The new section, or None if there is no such section.
     """
-    if name == '@':
-      value = self.stack[-1].context
-    else:
-      top = self.stack[-1].context
-      try:
-        value = top.get(name)
-      except AttributeError:  # no .get()
-        raise EvaluationError(
-            "Can't get name %r from top value %s" % (name, top))
+    return self.PushPath(_ParseSectionName(name), pre_formatters)
+
+  def PushPath(self, path, pre_formatters):
+    """Like PushSection, but takes a name parsed by _ParseSectionName."""
+    return self.PushValue(path.Lookup(self), pre_formatters)
 
+  def PushValue(self, value, pre_formatters):
+    """Like PushSection, but takes the value of the section."""
     # Apply pre-formatters
     for i, (f, args, formatter_type) in enumerate(pre_formatters):
       if formatter_type == ENHANCED_FUNC:
@@ -610,11 +1105,21 @@ class _ScopedContext(object):
       else:
         assert False, 'Invalid formatter type %r' % formatter_type
 
-    self.stack.append(_Frame(value))
+    free_frames = self.free_frames
+    if free_frames:
+      frame = free_frames.pop()
+      frame.context = value
+      frame.index = -1
+      frame.mapping = None
+      if hasattr(value, 'get'):
+        frame.mapping = value
+    else:
+      frame = _Frame(value)
+    self.stack.append(frame)
     return value
 
   def Pop(self):
-    self.stack.pop()
+    self.free_frames.append(self.stack.pop())
 
   def Next(self):
     """Advance to the next item in a repeated section.
@@ -626,16 +1131,27 @@ class _ScopedContext(object):
 
     # Now we're iterating -- push a new mutable object onto the stack
     if stacktop.index == -1:
-      stacktop = _Frame(None, index=0)
+      if self.free_frames:
+        stacktop = self.free_frames.pop()
+        stacktop.index = 0
+      else:
+        stacktop = _Frame(None, index=0)
       self.stack.append(stacktop)
 
     context_array = self.stack[-2].context
 
     if stacktop.index == len(context_array):
-      self.stack.pop()
+      self.free_frames.append(self.stack.pop())
       raise StopIteration
 
-    stacktop.context = context_array[stacktop.index]
+    item = context_array[stacktop.index]
+    if isinstance(item, LazyValue):
+      item = self.Resolve(item)
+    stacktop.context = item
+    if hasattr(item, 'get'):
+      stacktop.mapping = item
+    else:
+      stacktop.mapping = None
     stacktop.index += 1
 
     return True  # OK, we mutated the stack
@@ -646,26 +1162,6 @@ class _ScopedContext(object):
     else:
       return self.undefined_str
 
-  def _LookUpStack(self, name):
-    """Look up the stack for the given name."""
-    i = len(self.stack) - 1
-    while 1:
-      frame = self.stack[i]
-      if name == '@index':
-        if frame.index != -1:  # -1 is undefined
-          return frame.index  # @index is 1-based
-      else:
-        context = frame.context
-        if hasattr(context, 'get'):  # Can't look up names in a list or atom
-          try:
-            return context[name]
-          except KeyError:
-            pass
-
-      i -= 1  # Next frame
-      if i <= -1:  # Couldn't find it anywhere
-        return self._Undefined(name)
-
   def Lookup(self, name):
     """Get the value associated with a name in the current context.
 
@@ -681,20 +1177,16 @@ class _ScopedContext(object):
     Raises:
       UndefinedVariable if self.undefined_str is not set
     """
-    if name == '@':
-      return self.stack[-1].context
+    return _ParsePath(name).Lookup(self)
 
-    parts = name.split('.')
-    value = self._LookUpStack(parts[0])
 
-    # Now do simple lookups of the rest of the parts
-    for part in parts[1:]:
-      try:
-        value = value[part]
-      except (KeyError, TypeError):  # TypeError for non-dictionaries
-        return self._Undefined(part)
+# Type -> function for common scalars, so _ToString doesn't call pprint for them.
+# The results are the same as pprint.pformat(), e.g. repr() of a float is 0.1
+# rather than str()'s 12 digits.
+_SCALAR_TO_STRING = {int: str, long: repr, float: repr, bool: str}
 
-    return value
+# pprint.pformat() puts the value on one line if it's shorter than this.
+_PPRINT_WIDTH = 80
 
 
 def _ToString(x):
@@ -703,26 +1195,139 @@ def _ToString(x):
   # jsontemplate_test.py.
   if x is None:
     return 'null'
+  cls = type(x)
+  if cls is str or cls is unicode:
+    return x
+  f = _SCALAR_TO_STRING.get(cls)
+  if f is not None:
+    return f(x)
   if isinstance(x, basestring):
     return x
+  # pformat() starts with saferepr(), and only formats it again if it's too
+  # long.  Doing that here avoids creating a PrettyPrinter for small lists and
+  # dictionaries.
+  s = pprint.saferepr(x)
+  if len(s) < _PPRINT_WIDTH:
+    return s
   return pprint.pformat(x)
 
 
+class SafeStr(str):
+  """A string that's already HTML, so the html formatters don't escape it."""
+  __slots__ = ()
+
+
+class SafeUnicode(unicode):
+  """Unicode version of SafeStr."""
+  __slots__ = ()
+
+
+_SAFE_TYPES = (SafeStr, SafeUnicode)
+
+
+def MarkSafe(s):
+  """Returns the string as a SafeStr or SafeUnicode.
+
+  Use this for HTML you've already generated, e.g. the expansion of another
+  template.  The output of {foo|template bar} is marked this way.
+  """
+  if isinstance(s, _SAFE_TYPES):
+    return s
+  if isinstance(s, unicode):
+    return SafeUnicode(s)
+  return SafeStr(s)
+
+
+# For shorter strings, we check for each special character before replacing it.
+# Most values are short and have nothing to escape, and then this is about 3
+# times faster than calling replace() 3 times.  For long strings it's slower.
+_SHORT_STRING = 100
+
+
 # NOTE: We could consider making formatters act on strings only avoid this
 # repetitiveness.  But I wanted to leave open the possibility of doing stuff
 # like {number|increment-by 1}, where formatters take and return integers.
+def _HtmlEscape(s, quote=False):
+  """Same as cgi.escape(), without importing cgi."""
+  if len(s) < _SHORT_STRING:
+    if '&' in s:
+      s = s.replace('&', '&amp;')
+    if '<' in s:
+      s = s.replace('<', '&lt;')
+    if '>' in s:
+      s = s.replace('>', '&gt;')
+    if quote and '"' in s:
+      s = s.replace('"', '&quot;')
+    return s
+  s = s.replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;')
+  if quote:
+    s = s.replace('"', '&quot;')
+  return s
+
+
+# str() of these never has characters to escape.  (bool is an int.)
+_NUMBER_TYPES = (int, long, float)
+
+
+# _Html and _HtmlAttrValue are the most common formatters, so they check for
+# plain strings first, and _Html inlines _HtmlEscape.
+
 def _Html(x):
-  # If it's not string or unicode, make it a string
-  if not isinstance(x, basestring):
-    x = str(x)
-  return cgi.escape(x)
+  cls = type(x)
+  if cls is not str and cls is not unicode:
+    if isinstance(x, _SAFE_TYPES):
+      return x
+    if isinstance(x, _NUMBER_TYPES):
+      return str(x)
+    # If it's not string or unicode, make it a string
+    if not isinstance(x, basestring):
+      x = str(x)
+  if len(x) < _SHORT_STRING:
+    if '&' in x:
+      x = x.replace('&', '&amp;')
+    if '<' in x:
+      x = x.replace('<', '&lt;')
+    if '>' in x:
+      x = x.replace('>', '&gt;')
+    return x
+  return x.replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;')
 
 
 def _HtmlAttrValue(x):
-  # If it's not string or unicode, make it a string
-  if not isinstance(x, basestring):
-    x = str(x)
-  return cgi.escape(x, quote=True)
+  cls = type(x)
+  if cls is not str and cls is not unicode:
+    if isinstance(x, _SAFE_TYPES):
+      return x
+    if isinstance(x, _NUMBER_TYPES):
+      return str(x)
+    if not isinstance(x, basestring):
+      x = str(x)
+  return _HtmlEscape(x, quote=True)
+
+
+_urllib = None
+_urlparse = None
+
+
+def _Urllib():
+  """Returns the urllib module, importing it the first time.
+
+  (An import statement in a formatter would run for every value.)
+  """
+  global _urllib
+  if _urllib is None:
+    import urllib
+    _urllib = urllib
+  return _urllib
+
+
+def _Urlparse():
+  """Returns the urlparse module, importing it the first time."""
+  global _urlparse
+  if _urlparse is None:
+    import urlparse
+    _urlparse = urlparse
+  return _urlparse
 
 
 def _AbsUrl(relative_url, context, unused_args):
@@ -736,7 +1341,23 @@ def _AbsUrl(relative_url, context, unused_args):
   """
   # urljoin is flexible about trailing/leading slashes -- it will add or de-dupe
   # them
-  return urlparse.urljoin(context.Lookup('base-url'), relative_url)
+  return _Urlparse().urljoin(context.Lookup('base-url'), relative_url)
+
+
+def _UrlParams(x):
+  return _Urllib().urlencode(x, doseq=True)
+
+
+def _UrlParamValue(x):
+  return _Urllib().quote_plus(x)
+
+
+def _Raw(x):
+  return x
+
+
+def _Size(value):
+  return str(len(value))
 
 
 def _Reverse(x):
@@ -753,6 +1374,194 @@ def _Pairs(data):
   return [{'@key': k, '@value': data[k]} for k in keys]
 
 
+def _SortKey(item, name):
+  """Returns the value of a dotted name in an item, or None if it's missing."""
+  for part in name.split('.'):
+    if not hasattr(item, 'get'):
+      return None
+    item = item.get(part)
+  return item
+
+
+def _SortOrder(items, keys):
+  """Returns the indices of items in sorted order.
+
+  Args:
+    keys: Names to sort by, e.g. ['-date', 'title'].  A leading - sorts in
+        descending order.  If empty, the items themselves are compared.
+  """
+  order = range(len(items))
+  if not keys:
+    order.sort(key=items.__getitem__)
+  # Sort by the last key first; the sort is stable
+  for key in reversed(keys):
+    descending = key.startswith('-')
+    name = key[1:] if descending else key
+    order.sort(key=lambda i: _SortKey(items[i], name), reverse=descending)
+  return order
+
+
+def _SortBy(value, unused_context, args):
+  """Formatter for 'sort-by name -date' on a list."""
+  return [value[i] for i in _SortOrder(value, args)]
+
+
+def _SliceArgs(args):
+  """Parses the arguments of 'slice START [STOP [STEP]]' at compile time."""
+  if not 1 <= len(args) <= 3:
+    raise BadFormatter('slice takes 1 to 3 arguments, got %r' % args)
+  try:
+    return tuple(int(a) for a in args)
+  except ValueError:
+    raise BadFormatter('slice arguments should be integers, got %r' % args)
+
+
+def _Slice(value, unused_context, args):
+  """Formatter for 'slice START [STOP [STEP]]', like Python's value[start:stop]."""
+  if len(args) == 1:
+    return value[args[0]:]
+  return value[slice(*args)]
+
+
+class ViewCache(object):
+  """Remembers the sort order of the data in repeated sections.
+
+  Pass the same ViewCache to several templates with Template(...,
+  view_cache=cache), and a dictionary or list that's expanded with 'pairs' or
+  'sort-by' is sorted once, rather than every time it's expanded.
+
+  Entries are keyed by the identity of the data, so the data must not be
+  modified while it's cached.  (A change in its length is noticed.)  The cache
+  keeps references to up to max_size data objects.
+
+  The counters 'hits' and 'misses' are public, for monitoring.
+  """
+
+  def __init__(self, max_size=100):
+    if max_size < 2:
+      raise ConfigurationError('max_size should be at least 2')
+    self.cache = _GenerationalCache(max_size)
+    self.hits = 0
+    self.misses = 0
+
+  def Order(self, data, name, args, compute):
+    """Returns compute(data), the sorted keys or indices, cached by identity."""
+    key = (id(data), name, args)
+    entry = self.cache.Get(key)
+    if (entry is not _NOT_CACHED and entry[0] is data and
+        len(entry[1]) == len(data)):
+      self.hits += 1
+      return entry[1]
+    self.misses += 1
+    order = compute(data)
+    # Keep a reference to the data, so its id() isn't reused
+    self.cache.Put(key, (data, order))
+    return order
+
+  def Clear(self):
+    self.cache.Clear()
+
+
+class _IndexedView(object):
+  """Part of a sequence, possibly reordered, for a repeated section.
+
+  The 'reverse', 'sort-by' and 'slice' pre-formatters at the end of a repeated
+  section's chain return these instead of copying.  Then _MaterializeView
+  makes a list of just the items that will be expanded, with one slice or
+  map() in C.  (Indexing a view from Python for each item would cost more than
+  the copies it saves.)
+  """
+
+  __slots__ = ('items', 'indices')
+
+  def __init__(self, items, indices):
+    """
+    Args:
+      items: A sequence that isn't a view
+      indices: A slice object, or a list of indices into items
+    """
+    self.items = items
+    self.indices = indices
+
+
+def _ComposeSlices(n, inner, outer):
+  """Returns a slice equivalent to x[inner][outer], where len(x) == n."""
+  start, stop, step = inner.indices(n)
+  s, e, st = outer.indices(len(xrange(start, stop, step)))
+  count = len(xrange(s, e, st))
+  if count == 0:
+    return slice(0, 0)
+  new_start = start + s * step
+  new_step = step * st
+  new_stop = new_start + count * new_step
+  if new_stop < 0:  # Through the first item, going backward
+    new_stop = None
+  return slice(new_start, new_stop, new_step)
+
+
+def _SliceOfView(value, sl):
+  """Returns an _IndexedView of value[sl], where value may be a view."""
+  if not isinstance(value, _IndexedView):
+    return _IndexedView(value, sl)
+  items, indices = value.items, value.indices
+  if isinstance(indices, slice):
+    return _IndexedView(items, _ComposeSlices(len(items), indices, sl))
+  return _IndexedView(items, indices[sl])
+
+
+def _MaterializeView(value):
+  """The last pre-formatter of a repeated section that uses views."""
+  if not isinstance(value, _IndexedView):
+    return value
+  items, indices = value.items, value.indices
+  if isinstance(indices, slice):
+    result = items[indices]
+  else:
+    result = map(items.__getitem__, indices)
+  if not isinstance(result, list):  # e.g. a tuple or string
+    result = list(result)
+  return result
+
+
+def _ReverseView(value, unused_context, unused_args):
+  return _SliceOfView(value, slice(None, None, -1))
+
+
+def _SliceView(value, unused_context, args):
+  if len(args) == 1:
+    args = (args[0], None)
+  return _SliceOfView(value, slice(*args))
+
+
+def _PairsView(data, context, unused_args):
+  if context.view_cache is None or isinstance(data, _IndexedView):
+    data = _MaterializeView(data)
+    keys = sorted(data)
+  else:
+    keys = context.view_cache.Order(data, 'pairs', None, sorted)
+  return [{'@key': k, '@value': data[k]} for k in keys]
+
+
+def _SortByView(value, context, args):
+  compute = lambda items: _SortOrder(items, args)
+  if context.view_cache is None or isinstance(value, _IndexedView):
+    # Don't cache the orders of lists made from views
+    value = _MaterializeView(value)
+    order = compute(value)
+  else:
+    order = context.view_cache.Order(value, 'sort-by', tuple(args), compute)
+  return _IndexedView(value, order)
+
+
+# The pre-formatters at the end of a repeated section's chain are replaced with
+# these, followed by _MaterializeView.  See _IndexedView.
+_SECTION_VIEWS = {
+    _Reverse: _ReverseView,
+    _Pairs: _PairsView,
+    _SortBy: _SortByView,
+    _Slice: _SliceView,
+    }
+
 # See http://google-ctemplate.googlecode.com/svn/trunk/doc/howto.html for more
 # escape types.
 #
@@ -772,16 +1581,16 @@ _DEFAULT_FORMATTERS = {
     'html-attr-value': _HtmlAttrValue,
     'htmltag': _HtmlAttrValue,
 
-    'raw': lambda x: x,
+    'raw': _Raw,
     # Used for the length of a list.  Can be used for the size of a dictionary
     # too, though I haven't run into that use case.
-    'size': lambda value: str(len(value)),
+    'size': _Size,
 
     # The argument is a dictionary, and we get a a=1&b=2 string back.
-    'url-params': lambda x: urllib.urlencode(x, doseq=True),
+    'url-params': _UrlParams,
 
     # The argument is an atom, and it takes 'Search query?' -> 'Search+query%3F'
-    'url-param-value': urllib.quote_plus,  # param is an atom
+    'url-param-value': _UrlParamValue,  # param is an atom
 
     # The default formatter, when no other default is specifier.  For debugging,
     # this could be lambda x: json.dumps(x, indent=2), but here we want to be
@@ -796,7 +1605,7 @@ _DEFAULT_FORMATTERS = {
 
     # Just show a plain URL on an HTML page (without anchor text).
     'plain-url': lambda x: '<a href="%s">%s</a>' % (
-        cgi.escape(x, quote=True), cgi.escape(x)),
+        _HtmlEscape(x, quote=True), _HtmlEscape(x)),
 
     # A context formatter
     'AbsUrl': _AbsUrl,
@@ -848,44 +1657,269 @@ def _Cycle(value, unused_context, args):
   return args[(value - 1) % len(args)]
 
 
-def _StrftimeHelper(args, time_tuple):
-  try:
-    format_str = args[0]
-  except IndexError:
-    # If no format string, use some reasonable text format
-    return time.asctime(time_tuple)
-  else:
-    return time.strftime(format_str, time_tuple)
+# strftime directives whose output only depends on the date, and on the date
+# and minute.  %% and whitespace don't depend on anything.
+_DATE_DIRECTIVES = frozenset('aAbBCdDeFgGhjmnUuVwWxyY%t')
+_MINUTE_DIRECTIVES = _DATE_DIRECTIVES | frozenset('HIklMpPR')
 
+# With glibc's flags and modifiers, e.g. %-d and %Ey
+_STRFTIME_DIRECTIVE_RE = re.compile(r'%[-_0^#]*[EO]?(.)')
+
+_TWO_DIGITS = ['%02d' % i for i in xrange(60)]
 
-def _StrftimeGm(value, unused_context, args):
-  """Convert a timestamp in seconds to a string based on the format string.
 
-  Returns GM time.
+def _ParseStrftime(format_str):
+  """Decides how long the output of a strftime format is constant for.
+
+  Returns:
+    (period, pieces)
+    period: 86400 if the format only has a date, 60 if it also has hours,
+        minutes and seconds, and 1 otherwise (including for directives we don't
+        know about).
+    pieces: If the format has %S or %T, a list of formats to expand once per
+        minute, and join with the two-digit second.  Otherwise None.
   """
-  time_tuple = time.gmtime(value)
-  return _StrftimeHelper(args, time_tuple)
+  directives = set()
+  pieces = []
+  pos = 0
+  for m in _STRFTIME_DIRECTIVE_RE.finditer(format_str):
+    directive = m.group(0)
+    if directive == '%S':
+      pieces.append(format_str[pos:m.start()])
+      pos = m.end()
+    elif directive == '%T':
+      pieces.append(format_str[pos:m.start()] + '%H:%M:')
+      pos = m.end()
+      directives.add('M')
+    else:
+      directives.add(m.group(1))
+  if directives <= _DATE_DIRECTIVES and not pieces:
+    return 86400, None
+  if directives <= _MINUTE_DIRECTIVES:
+    if pieces:
+      pieces.append(format_str[pos:])
+      return 60, pieces
+    return 60, None
+  return 1, None
 
 
-def _StrftimeLocal(value, unused_context, args):
-  """Convert a timestamp in seconds to a string based on the format string.
+def _TimeZone():
+  """The local time zone, which time.tzset() can change."""
+  return time.timezone, time.altzone, time.daylight, time.tzname
 
-  Returns local time.
-  """
-  time_tuple = time.localtime(value)
-  return _StrftimeHelper(args, time_tuple)
 
+class _StrftimeFormat(object):
+  """A strftime format string, parsed once at compile time.
 
-def _IsDebugMode(unused_value, context, unused_args):
-  return _TestAttribute(unused_value, context, ('debug',))
+  Timestamps in a table are usually close together, so Format() remembers the
+  range of timestamps its last result is valid for: the minute for '%H:%M' or
+  '%H:%M:%S' (the second is filled in), or the day for '%Y-%m-%d'.  Other recent
+  ranges are kept by the second.
 
+  Results for local time are only valid in the time zone they were computed in,
+  so the caches are cleared when it changes, e.g. with time.tzset().
+  """
 
-def _TestAttribute(unused_value, context, args):
-  """Cycle between various values on consecutive integers."""
-  try:
-    name = args[0]  # can used dotted syntax too, e.g. 'foo.bar'
-  except IndexError:
-    raise EvaluationError('The "test" predicate requires an argument.')
+  def __init__(self, format_str, to_time_tuple):
+    """
+    Args:
+      format_str: The format, or None for time.asctime()
+      to_time_tuple: time.localtime or time.gmtime
+    """
+    self.format_str = format_str
+    self.to_time_tuple = to_time_tuple
+    if format_str is None:
+      self.period, self.pieces = 1, None
+    else:
+      self.period, self.pieces = _ParseStrftime(format_str)
+    # (start, end, pieces), initially empty.  The result for a timestamp in the
+    # range is the pieces joined by its two-digit second.  If there's only one
+    # piece, that's the result.
+    self.last = (0, 0, None)
+    self.by_second = _GenerationalCache(1000)  # second -> (start, end, pieces)
+    self.local = to_time_tuple is time.localtime
+    # tzset() makes a new time.tzname, so checking its identity is cheap.  Then
+    # the whole zone is compared.
+    self.tzname = time.tzname
+    self.zone = _TimeZone()
+
+  def _FormatTuple(self, time_tuple):
+    if self.format_str is None:
+      # If no format string, use some reasonable text format
+      return time.asctime(time_tuple)
+    return time.strftime(self.format_str, time_tuple)
+
+  def _Range(self, second):
+    """Returns (start, end, pieces) for a timestamp in whole seconds."""
+    time_tuple = self.to_time_tuple(second)
+    if self.period == 60:
+      start = second - time_tuple.tm_sec
+      if start >= 0:
+        if self.pieces:
+          pieces = tuple(time.strftime(f, time_tuple) for f in self.pieces)
+        else:
+          pieces = (time.strftime(self.format_str, time_tuple),)
+        return start, start + 60, pieces
+    elif self.period == 86400:
+      start = second - (time_tuple.tm_hour * 3600 + time_tuple.tm_min * 60 +
+                        time_tuple.tm_sec)
+      end = start + 86400
+      # A local day can be 23 or 25 hours long when daylight saving time starts
+      # or ends.  Then just use the second.
+      if start >= 0 and (self.to_time_tuple is time.gmtime or (
+          self.to_time_tuple(start)[:3] == time_tuple[:3] and
+          self.to_time_tuple(end - 1)[:3] == time_tuple[:3])):
+        return start, end, (self._FormatTuple(time_tuple),)
+    return second, second + 1, (self._FormatTuple(time_tuple),)
+
+  def _CheckTimeZone(self):
+    self.tzname = time.tzname
+    zone = _TimeZone()
+    if zone != self.zone:
+      self.zone = zone
+      self.last = (0, 0, None)
+      self.by_second.Clear()
+
+  def Format(self, value):
+    """Formats a timestamp in seconds."""
+    if self.local and time.tzname is not self.tzname:
+      self._CheckTimeZone()
+    start, end, pieces = self.last
+    if not start <= value < end:
+      # Negative timestamps are truncated toward zero, so the ranges don't
+      # apply.  Other types are formatted as before, e.g. None is the current
+      # time.
+      if type(value) not in _NUMBER_TYPES or value < 0:
+        return self._FormatTuple(self.to_time_tuple(value))
+
+      second = int(value)
+      r = self.by_second.Get(second)
+      if r is _NOT_CACHED:
+        r = self._Range(second)
+        self.by_second.Put(second, r)
+      self.last = r
+      start, end, pieces = r
+
+    if len(pieces) == 1:
+      return pieces[0]
+    return _TWO_DIGITS[int(value) - start].join(pieces)
+
+  def FormatColumn(self, values):
+    """Formats a list of timestamps, e.g. a column of a table."""
+    format_ = self.Format
+    return [format_(value) for value in values]
+
+
+def _StrftimeArgs(to_time_tuple):
+  """Returns a function that parses the arguments to a strftime formatter."""
+  def ParseArgs(args):
+    try:
+      format_str = args[0]
+    except IndexError:
+      format_str = None
+    return (_StrftimeFormat(format_str, to_time_tuple),)
+  return ParseArgs
+
+
+def _Strftime(value, unused_context, args):
+  """Convert a timestamp in seconds to a string based on the format string.
+
+  args is a 1-tuple of a _StrftimeFormat, which knows whether it's local or GM
+  time.
+  """
+  return args[0].Format(value)
+
+
+#
+# Versions of the default formatters that take columns.  See BatchFunction.
+#
+
+def _OnlyType(values):
+  """Returns the type of all the values, or None if there's more than one."""
+  types = set(map(type, values))
+  if len(types) == 1:
+    return types.pop()
+  return None
+
+
+def _ToStringColumn(values):
+  cls = _OnlyType(values)
+  if cls is str or cls is unicode:
+    return list(values)
+  f = _SCALAR_TO_STRING.get(cls)
+  if f is not None:
+    return map(f, values)
+  return map(_ToString, values)
+
+
+def _EscapeColumn(values, escape, formatter):
+  """Shared by the column versions of the html formatters.
+
+  Strings of one type are joined with NUL characters and escaped with one call,
+  if they don't contain any.  Like the formatters, numbers aren't escaped.
+  """
+  cls = _OnlyType(values)
+  if cls is str or cls is unicode:
+    joined = '\0'.join(values)
+    if joined.count('\0') == len(values) - 1:
+      return escape(joined).split('\0')
+  elif cls in _SCALAR_TO_STRING:  # int, long, float, bool
+    return map(str, values)
+  return map(formatter, values)
+
+
+def _HtmlColumn(values):
+  return _EscapeColumn(values, _HtmlEscape, _Html)
+
+
+def _HtmlAttrValueColumn(values):
+  return _EscapeColumn(values, lambda s: _HtmlEscape(s, quote=True),
+                       _HtmlAttrValue)
+
+
+def _UrlParamValueColumn(values):
+  urllib = _Urllib()
+  if _OnlyType(values) is str:
+    # quote_plus() quotes each character separately, and a NUL is %00
+    joined = '\0'.join(values)
+    if joined.count('\0') == len(values) - 1:
+      return urllib.quote_plus(joined).split('%00')
+  return map(urllib.quote_plus, values)
+
+
+def _RawColumn(values):
+  return list(values)
+
+
+def _SizeColumn(values):
+  return map(str, map(len, values))
+
+
+def _StrftimeColumn(values, unused_context, args):
+  return args[0].FormatColumn(values)
+
+
+_COLUMN_FORMATTERS = {
+    _ToString: _ToStringColumn,
+    _Html: _HtmlColumn,
+    _HtmlAttrValue: _HtmlAttrValueColumn,
+    _UrlParamValue: _UrlParamValueColumn,
+    _Raw: _RawColumn,
+    _Size: _SizeColumn,
+    _Strftime: _StrftimeColumn,
+    }
+
+
+def _IsDebugMode(unused_value, context, unused_args):
+  return _TestAttribute(unused_value, context, ('debug',))
+
+
+def _TestAttribute(unused_value, context, args):
+  """Cycle between various values on consecutive integers."""
+  try:
+    name = args[0]  # can used dotted syntax too, e.g. 'foo.bar'
+  except IndexError:
+    raise EvaluationError('The "test" predicate requires an argument.')
   try:
     return bool(context.Lookup(name))
   except UndefinedVariable:
@@ -914,6 +1948,34 @@ _DEFAULT_PREDICATES = {
     'plural': _PLURAL,
     }
 
+# The default formatters and predicates are looked up after the user's.  They
+# never change, so they're shared by all templates, and lookups are memoized.
+_DEFAULT_FORMATTER_REGISTRY = _MemoizedRegistry(ChainedRegistry([
+    DictRegistry(_DEFAULT_FORMATTERS),
+    # default formatters with arguments
+    PrefixRegistry([
+        ('pluralize', _Pluralize),
+        ('cycle', _Cycle),
+        # For section pre-formatters, like 'pairs' and 'reverse'
+        ('sort-by', _SortBy),  # e.g. sort-by -date title
+        ('slice', _Slice, _SliceArgs),  # slice START [STOP [STEP]]
+        # These have to go first because 'strftime' is a prefix of
+        # strftime-local/gm!
+        ('strftime-local', _Strftime, _StrftimeArgs(time.localtime)),  # local
+        ('strftime-gm', _Strftime, _StrftimeArgs(time.gmtime)),  # world
+        ('strftime', _Strftime, _StrftimeArgs(time.localtime)),  # local
+        ]),
+    ]))
+
+_DEFAULT_PREDICATE_REGISTRY = _MemoizedRegistry(ChainedRegistry([
+    DictRegistry(_DEFAULT_PREDICATES),
+    # default predicates with arguments
+    PrefixRegistry([
+        ('test', _TestAttribute),
+        ('template', _TemplateExists),
+        ]),
+    ]))
+
 
 def SplitMeta(meta):
   """Split and validate metacharacters.
@@ -1025,99 +2087,215 @@ def _MatchDirective(token):
   return None, None  # no match
 
 
-def _Tokenize(template_str, meta_left, meta_right, whitespace):
-  """Yields tokens, which are 2-tuples (TOKEN_TYPE, token_string)."""
+# Directives that the tokenizer consumes itself; they never reach the compiler.
+( _COMMENT_TOKEN,  # {# comment}
+  _OPTION_STRIP_LINE_TOKEN,  # {.OPTION strip-line}
+  _OPTION_END_TOKEN,  # {.END}
+  ) = range(14, 17)
 
-  trimlen = len(meta_left)
-  token_re = MakeTokenRegex(meta_left, meta_right)
-  do_strip = (whitespace == 'strip-line')  # Do this outside loop
-  do_strip_part = False
+# If a directive of one of these types is alone on a line, then the whitespace
+# around it is omitted.
+_BLOCK_TOKENS = set([
+    COMMENT_BEGIN_TOKEN, COMMENT_END_TOKEN, _COMMENT_TOKEN,
+    _OPTION_STRIP_LINE_TOKEN, _OPTION_END_TOKEN,
+    SECTION_TOKEN, REPEATED_SECTION_TOKEN, PREDICATE_TOKEN, IF_TOKEN,
+    ALTERNATES_TOKEN, OR_TOKEN, END_TOKEN, SUBST_TEMPLATE_TOKEN, DEF_TOKEN])
 
-  for line in template_str.splitlines(True):  # retain newlines
-    if do_strip or do_strip_part:
-      line = line.strip()
 
-    tokens = token_re.split(line)
+def _ClassifyDirective(token, meta_literals):
+  """Returns a 2-tuple (token_type, token) for the text inside metacharacters.
 
-    # Check for a special case first.  If a comment or "block" directive is on a
-    # line by itself (with only space surrounding it), then the space is
-    # omitted.  For simplicity, we don't handle the case where we have 2
-    # directives, say '{.end} # {#comment}' on a line.
-    if len(tokens) == 3:
-      # ''.isspace() == False, so work around that
-      if (tokens[0].isspace() or not tokens[0]) and \
-         (tokens[2].isspace() or not tokens[2]):
-        token = tokens[1][trimlen : -trimlen]
+  token_type is None if the directive should be ignored.
+  """
+  # Check the ones that begin with ## before #
+  if token == COMMENT_BEGIN:
+    return COMMENT_BEGIN_TOKEN, None
+  if token == COMMENT_END:
+    return COMMENT_END_TOKEN, None
+  if token == OPTION_STRIP_LINE:
+    return _OPTION_STRIP_LINE_TOKEN, None
+  if token == OPTION_END:
+    return _OPTION_END_TOKEN, None
+
+  # A single-line comment
+  if token.startswith('#'):
+    return _COMMENT_TOKEN, None
 
-        # Check the ones that begin with ## before #
-        if token == COMMENT_BEGIN:
-          yield COMMENT_BEGIN_TOKEN, None
-          continue
-        if token == COMMENT_END:
-          yield COMMENT_END_TOKEN, None
-          continue
-        if token == OPTION_STRIP_LINE:
-          do_strip_part = True
-          continue
-        if token == OPTION_END:
-          do_strip_part = False
-          continue
+  if token.startswith('.'):
+    literal = meta_literals.get(token)
+    if literal is not None:
+      return META_LITERAL_TOKEN, literal
+    return _MatchDirective(token)
 
-        if token.startswith('#'):
-          continue  # The whole line is omitted
+  # Now we know the directive is a substitution.
+  return SUBST_TOKEN, token
 
-        token_type, token = _MatchDirective(token)
-        if token_type is not None:
-          yield token_type, token  # Only yield the token, not space
-          continue
 
-    # The line isn't special; process it normally.
-    for i, token in enumerate(tokens):
-      if i % 2 == 0:
-        yield LITERAL_TOKEN, token
+# What str.splitlines() and unicode.splitlines() split on.  The tokenizer has
+# to agree with them, since strip-line mode uses splitlines().
+_LINE_BREAKS = ['\r\n', '\r', '\n']
+_UNICODE_LINE_BREAKS = _LINE_BREAKS + [
+    u'\x0b', u'\x0c', u'\x1c', u'\x1d', u'\x1e', u'\x85', u'\u2028', u'\u2029']
 
-      else:  # It's a "directive" in metachracters
-        assert token.startswith(meta_left), repr(token)
-        assert token.endswith(meta_right), repr(token)
-        token = token[trimlen : -trimlen]
+_scanner_cache = {}
 
-        # Check the ones that begin with ## before #
-        if token == COMMENT_BEGIN:
-          yield COMMENT_BEGIN_TOKEN, None
-          continue
-        if token == COMMENT_END:
-          yield COMMENT_END_TOKEN, None
-          continue
-        if token == OPTION_STRIP_LINE:
-          do_strip_part = True
-          continue
-        if token == OPTION_END:
+def _MakeScanner(meta_left, meta_right, is_unicode):
+  """Return (memoized) regular expressions for _Tokenize.
+
+  Returns:
+    directive_re: Matches a directive.  This is like MakeTokenRegex, except
+        that it never matches across a line break.
+    break_re: Matches a line break.
+    last_break_re: Matches text up to and including the last line break.
+  """
+  key = meta_left, meta_right, is_unicode
+  if key not in _scanner_cache:
+    if is_unicode:
+      breaks = _UNICODE_LINE_BREAKS
+    else:
+      breaks = _LINE_BREAKS
+    break_pattern = '|'.join([re.escape(b) for b in breaks])
+    break_chars = ''.join([b for b in breaks if len(b) == 1])
+
+    directive_re = re.compile(
+        re.escape(meta_left) +
+        '[^\\s' + break_chars + '][^' + break_chars + ']*?' +
+        re.escape(meta_right))
+    break_re = re.compile(break_pattern)
+    last_break_re = re.compile('.*(?:' + break_pattern + ')', re.DOTALL)
+
+    _scanner_cache[key] = directive_re, break_re, last_break_re
+  return _scanner_cache[key]
+
+
+def _StripLines(s):
+  """Strip every line in s, for strip-line mode."""
+  return ''.join([line.strip() for line in s.splitlines()])
+
+
+def _Tokenize(template_str, meta_left, meta_right, whitespace):
+  """Yields tokens, which are 4-tuples (TOKEN_TYPE, token_string, line, column).
+
+  Lines and columns are 1-based.  Lines are counted by newline characters.
+
+  This makes a single pass over the template string, and only looks at lines
+  which contain directives.  The text between them is yielded as one literal.
+  """
+  directive_re, break_re, last_break_re = _MakeScanner(
+      meta_left, meta_right, isinstance(template_str, unicode))
+  trimlen = len(meta_left)
+  do_strip = (whitespace == 'strip-line')  # Do this outside loop
+  do_strip_part = False
+
+  meta_literals = {
+      '.meta-left': meta_left,
+      '.meta-right': meta_right,
+      '.space': ' ',
+      '.tab': '\t',
+      '.newline': '\n',
+      }
+  classified = {}  # directive text -> (token_type, token)
+
+  s = template_str
+  pos = 0  # Everything before pos has been tokenized.  It starts a line.
+  line_num = 1  # Line number of pos
+  group = []  # The directives on the current line
+
+  # None marks the end of the template
+  for match in itertools.chain(directive_re.finditer(s), [None]):
+    if match is not None and group and match.start() < line_end:
+      group.append(match)  # Another directive on the current line
+      continue
+
+    if group:
+      # First yield the lines between pos and the current line.  They don't
+      # have any directives.
+      strip = do_strip or do_strip_part
+      if strip:
+        literal = _StripLines(s[pos:line_start])
+      else:
+        literal = s[pos:line_start]
+      if literal:
+        yield LITERAL_TOKEN, literal, line_num, 1
+      line_num += s.count('\n', pos, line_start)
+
+      # Now the current line
+      directives = []
+      for m in group:
+        text = m.group(0)[trimlen : -trimlen]
+        try:
+          token_type, token = classified[text]
+        except KeyError:
+          token_type, token = classified[text] = _ClassifyDirective(
+              text, meta_literals)
+        directives.append((token_type, token, m.start() - line_start + 1))
+
+      pre = s[line_start:group[0].start()]
+      post = s[group[-1].end():next_line]
+      if strip:
+        pre = pre.lstrip()
+        post = post.rstrip()
+
+      # Check for a special case first.  If a comment or "block" directive is
+      # on a line by itself (with only space surrounding it), then the space is
+      # omitted.  For simplicity, we don't handle the case where we have 2
+      # directives, say '{.end} # {#comment}' on a line.
+      #
+      # ''.isspace() == False, so work around that
+      if (len(directives) == 1 and directives[0][0] in _BLOCK_TOKENS and
+          (pre.isspace() or not pre) and (post.isspace() or not post)):
+        literals = [('', 0), ('', 0)]  # Omit the space
+      else:
+        literals = [(pre, group[0].start() - len(pre))]
+        for i in xrange(1, len(group)):
+          start = group[i-1].end()
+          literals.append((s[start:group[i].start()], start))
+        literals.append((post, group[-1].end()))
+
+      for i, (token_type, token, column) in enumerate(directives):
+        literal, start = literals[i]
+        if literal:
+          yield LITERAL_TOKEN, literal, line_num, start - line_start + 1
+
+        if token_type == _OPTION_STRIP_LINE_TOKEN:
+          do_strip_part = True  # Takes effect on the next line
+        elif token_type == _OPTION_END_TOKEN:
           do_strip_part = False
-          continue
+        elif token_type is not None and token_type != _COMMENT_TOKEN:
+          yield token_type, token, line_num, column
 
-        # A single-line comment
-        if token.startswith('#'):
-          continue
+      literal, start = literals[-1]
+      if literal:
+        yield LITERAL_TOKEN, literal, line_num, start - line_start + 1
 
-        if token.startswith('.'):
-          literal = {
-              '.meta-left': meta_left,
-              '.meta-right': meta_right,
-              '.space': ' ',
-              '.tab': '\t',
-              '.newline': '\n',
-              }.get(token)
+      line_num += s.count('\n', line_start, next_line)
+      pos = next_line
+      group = []
 
-          if literal is not None:
-            yield META_LITERAL_TOKEN, literal
-            continue
+    if match is None:
+      break
 
-          token_type, token = _MatchDirective(token)
-          if token_type is not None:
-            yield token_type, token
+    # Start a new line
+    match_start = match.start()
+    m = last_break_re.match(s, pos, match_start)
+    if m:
+      line_start = m.end()
+    else:
+      line_start = pos
+    m = break_re.search(s, match.end())
+    if m:
+      line_end, next_line = m.start(), m.end()
+    else:
+      line_end = next_line = len(s)
+    group.append(match)
 
-        else:  # Now we know the directive is a substitution.
-          yield SUBST_TOKEN, token
+  # The rest of the template doesn't have any directives
+  if do_strip or do_strip_part:
+    literal = _StripLines(s[pos:])
+  else:
+    literal = s[pos:]
+  if literal:
+    yield LITERAL_TOKEN, literal, line_num, 1
 
 
 def _CompileTemplate(
@@ -1174,97 +2352,229 @@ def _CompileTemplate(
 
   has_defines = False
 
-  for token_type, token in _Tokenize(template_str, meta_left, meta_right,
-                                     whitespace):
-    if token_type == COMMENT_BEGIN_TOKEN:
-      comment_counter += 1
-      continue
-    if token_type == COMMENT_END_TOKEN:
-      comment_counter -= 1
-      if comment_counter < 0:
-        raise CompilationError('Got too many ##END markers')
-      continue
-    # Don't process any tokens
-    if comment_counter > 0:
-      continue
+  line = column = None  # Position of the current token, for errors
+  try:
+    for token_type, token, line, column in _Tokenize(
+        template_str, meta_left, meta_right, whitespace):
+      if token_type == COMMENT_BEGIN_TOKEN:
+        comment_counter += 1
+        continue
+      if token_type == COMMENT_END_TOKEN:
+        comment_counter -= 1
+        if comment_counter < 0:
+          raise CompilationError('Got too many ##END markers')
+        continue
+      # Don't process any tokens
+      if comment_counter > 0:
+        continue
+
+      if token_type in (LITERAL_TOKEN, META_LITERAL_TOKEN):
+        if token:
+          builder.Append(token)
+        continue
+
+      if token_type in (SECTION_TOKEN, REPEATED_SECTION_TOKEN, DEF_TOKEN):
+        parts = [p.strip() for p in token.split(format_char)]
+        if len(parts) == 1:
+          name = parts[0]
+          formatters = []
+        else:
+          name = parts[0]
+          formatters = parts[1:]
+        builder.NewSection(token_type, name, formatters)
+        balance_counter += 1
+        if token_type == DEF_TOKEN:
+          has_defines = True
+        continue
+
+      if token_type == PREDICATE_TOKEN:
+        # {.attr?} lookups
+        builder.NewPredicateSection(token, test_attr=True)
+        balance_counter += 1
+        continue
+
+      if token_type == IF_TOKEN:
+        builder.NewPredicateSection(token, test_attr=False)
+        balance_counter += 1
+        continue
+
+      if token_type == OR_TOKEN:
+        builder.NewOrClause(token)
+        continue
+
+      if token_type == ALTERNATES_TOKEN:
+        builder.AlternatesWith()
+        continue
+
+      if token_type == END_TOKEN:
+        balance_counter -= 1
+        if balance_counter < 0:
+          raise TemplateSyntaxError(
+              'Got too many %send%s statements.  You may have mistyped an '
+              "earlier 'section' or 'repeated section' directive."
+              % (meta_left, meta_right))
+        builder.EndSection()
+        continue
+
+      if token_type == SUBST_TOKEN:
+        parts = [p.strip() for p in token.split(format_char)]
+        if len(parts) == 1:
+          if default_formatter is None:
+            raise MissingFormatter(
+                'This template requires explicit formatters.')
+          # If no formatter is specified, the default is the 'str' formatter,
+          # which the user can define however they desire.
+          name = token
+          formatters = [default_formatter]
+        else:
+          name = parts[0]
+          formatters = parts[1:]
+
+        builder.AppendSubstitution(name, formatters)
+        continue
+
+      if token_type == SUBST_TEMPLATE_TOKEN:
+        # no formatters
+        builder.AppendTemplateSubstitution(token)
+        continue
+  except CompilationError, e:
+    # A template compiled while looking up a formatter (e.g. template-file)
+    # may have set it already
+    if not hasattr(e, 'line'):
+      e.line, e.column = line, column
+    raise
 
-    if token_type in (LITERAL_TOKEN, META_LITERAL_TOKEN):
-      if token:
-        builder.Append(token)
-      continue
+  if balance_counter != 0:
+    raise TemplateSyntaxError('Got too few %send%s statements' %
+        (meta_left, meta_right))
+  if comment_counter != 0:
+    raise CompilationError('Got %d more {##BEGIN}s than {##END}s' % comment_counter)
 
-    if token_type in (SECTION_TOKEN, REPEATED_SECTION_TOKEN, DEF_TOKEN):
-      parts = [p.strip() for p in token.split(format_char)]
-      if len(parts) == 1:
-        name = parts[0]
-        formatters = []
+  return builder.Root(), has_defines
+
+
+class _Optimizer(object):
+  """Simplifies a compiled program tree without changing its output.
+
+  - Adjacent literals are merged, so expansion makes fewer callback() calls.
+    Meta-literals like {.space} are already literals at this point, so they're
+    merged too.
+  - {.define} statements are removed.  They do nothing at runtime; by the time
+    we run, the group has been made from them.
+  - Empty {.or} and {.alternates with} clauses are removed.
+
+  The statement counts before and after are available as 'stats'.
+  """
+
+  def __init__(self):
+    self.stats = {
+        'statements_before': 0, 'statements_after': 0,
+        'literals_before': 0, 'literals_after': 0,
+        }
+
+  def Optimize(self, section):
+    """Optimize a _Section or _PredicateSection in place."""
+    if isinstance(section, _PredicateSection):
+      section.clauses = [
+          (pred, self._Statements(statements))
+          for pred, statements in section.clauses]
+    else:
+      for clause, statements in section.statements.items():
+        statements = self._Statements(statements)
+        if statements or clause == 'default':
+          section.statements[clause] = statements
+        else:
+          del section.statements[clause]
+
+  def _Statements(self, statements):
+    stats = self.stats
+    out = []
+    for statement in statements:
+      stats['statements_before'] += 1
+      if isinstance(statement, basestring):
+        stats['literals_before'] += 1
+        if not statement:
+          continue
+        # Only merge literals of the same type.  Mixing unicode and byte
+        # strings is handled by JoinTokens at the end of expansion.
+        if out and type(out[-1]) is type(statement):
+          out[-1] += statement
+          continue
+        stats['literals_after'] += 1
       else:
-        name = parts[0]
-        formatters = parts[1:]
-      builder.NewSection(token_type, name, formatters)
-      balance_counter += 1
-      if token_type == DEF_TOKEN:
-        has_defines = True
-      continue
+        func, args = statement
+        if func is _DoDef:
+          # The body is still referenced by the group, so optimize it
+          self.Optimize(args)
+          continue
+        if isinstance(args, _AbstractSection):
+          self.Optimize(args)
+      stats['statements_after'] += 1
+      out.append(statement)
+    return out
 
-    if token_type == PREDICATE_TOKEN:
-      # {.attr?} lookups
-      builder.NewPredicateSection(token, test_attr=True)
-      balance_counter += 1
-      continue
 
-    if token_type == IF_TOKEN:
-      builder.NewPredicateSection(token, test_attr=False)
-      balance_counter += 1
-      continue
+def _OptimizeProgram(program):
+  """Optimize a program in place.
 
-    if token_type == OR_TOKEN:
-      builder.NewOrClause(token)
-      continue
+  Returns:
+    A dictionary of statement and literal counts before and after.
+  """
+  optimizer = _Optimizer()
+  optimizer.Optimize(program)
+  return optimizer.stats
 
-    if token_type == ALTERNATES_TOKEN:
-      builder.AlternatesWith()
-      continue
 
-    if token_type == END_TOKEN:
-      balance_counter -= 1
-      if balance_counter < 0:
-        # TODO: Show some context for errors
-        raise TemplateSyntaxError(
-            'Got too many %send%s statements.  You may have mistyped an '
-            "earlier 'section' or 'repeated section' directive."
-            % (meta_left, meta_right))
-      builder.EndSection()
-      continue
+class _ProgramRecorder(object):
+  """Records the calls that _CompileTemplate makes on a _ProgramBuilder.
 
-    if token_type == SUBST_TOKEN:
-      parts = [p.strip() for p in token.split(format_char)]
-      if len(parts) == 1:
-        if default_formatter is None:
-          raise MissingFormatter('This template requires explicit formatters.')
-        # If no formatter is specified, the default is the 'str' formatter,
-        # which the user can define however they desire.
-        name = token
-        formatters = [default_formatter]
-      else:
-        name = parts[0]
-        formatters = parts[1:]
+  The recorded calls only contain strings, integers and lists of them, so they
+  can be serialized (e.g. with marshal) and later replayed with _ReplayProgram.
+  Replaying skips tokenizing and parsing, but formatters and predicates are
+  still looked up in the builder's registries, so a record doesn't depend on
+  what functions are registered.
+  """
 
-      builder.AppendSubstitution(name, formatters)
-      continue
+  def __init__(self, builder):
+    self.builder = builder
+    self.calls = []  # list of (method name, args, kwargs)
 
-    if token_type == SUBST_TEMPLATE_TOKEN:
-      # no formatters
-      builder.AppendTemplateSubstitution(token)
-      continue
+  def __getattr__(self, name):
+    method = getattr(self.builder, name)
 
-  if balance_counter != 0:
-    raise TemplateSyntaxError('Got too few %send%s statements' %
-        (meta_left, meta_right))
-  if comment_counter != 0:
-    raise CompilationError('Got %d more {##BEGIN}s than {##END}s' % comment_counter)
+    def Record(*args, **kwargs):
+      self.calls.append((name, args, kwargs))
+      return method(*args, **kwargs)
 
-  return builder.Root(), has_defines
+    return Record
+
+
+def _ReplayProgram(calls, builder):
+  """Replay calls recorded by _ProgramRecorder on a new builder."""
+  for name, args, kwargs in calls:
+    getattr(builder, name)(*args, **kwargs)
+  return builder.Root()
+
+
+def _CompileWithCache(compile_cache, template_str, builder, compile_options):
+  """Like _CompileTemplate, but consult a cache of recorded programs first.
+
+  Args:
+    compile_cache: An object with Get(key) and Put(key, value) methods, e.g.
+        cache.DiskCache.  The key is a tuple of the template string and the
+        sorted compile options.  Get returns None on a miss.
+  """
+  key = (template_str, sorted(compile_options.items()))
+  record = compile_cache.Get(key)
+  if record is not None:
+    has_defines, calls = record
+    return _ReplayProgram(calls, builder), has_defines
+
+  recorder = _ProgramRecorder(builder)
+  program, has_defines = _CompileTemplate(
+      template_str, recorder, **compile_options)
+  compile_cache.Put(key, (has_defines, recorder.calls))
+  return program, has_defines
 
 
 _OPTION_RE = re.compile(r'^([a-zA-Z\-]+):\s*(.*)')
@@ -1279,8 +2589,8 @@ def FromString(s, **kwargs):
   return FromFile(f, **kwargs)
 
 
-def FromFile(f, more_formatters=lambda x: None, more_predicates=lambda x: None,
-             _constructor=None):
+def FromFile(f, more_formatters=None, more_predicates=None, _constructor=None,
+             **kwargs):
   """Parse a template from a file, using a simple file format.
 
   This is useful when you want to include template options in a data file,
@@ -1301,6 +2611,9 @@ def FromFile(f, more_formatters=lambda x: None, more_predicates=lambda x: None,
   Args:
     f: A file handle to read from.  Caller is responsible for opening and
     closing it.
+
+  Other keyword arguments, e.g. engine='codegen', are passed to the Template
+  constructor.  Options in the file take precedence.
   """
   _constructor = _constructor or Template
 
@@ -1340,10 +2653,107 @@ def FromFile(f, more_formatters=lambda x: None, more_predicates=lambda x: None,
     # There were no options, so no blank line is necessary.
     body = line + f.read()
 
+  kwargs.update(options)
   return _constructor(body,
                       more_formatters=more_formatters,
                       more_predicates=more_predicates,
-                      **options)
+                      **kwargs)
+
+
+DEFAULT_BUFFER_SIZE = 64 * 1024
+
+
+class TokenBuffer(object):
+  """Collects tokens from Template.execute(), and writes them in large blocks.
+
+  Writing each token to a file or socket is slow, since there are many small
+  tokens.  This object has the same write() and flush() methods as a file, so
+  you can pass its write method as the callback to execute().
+
+  Example:
+    buf = TokenBuffer(f)
+    t.execute(data, buf.write)
+    buf.flush()
+
+  Nothing is written to the underlying file until there are buffer_size
+  characters, or flush() is called.  flush() doesn't flush the underlying file.
+  """
+
+  def __init__(self, writer, buffer_size=DEFAULT_BUFFER_SIZE):
+    """
+    Args:
+      writer: An object with a write() method, e.g. a file
+      buffer_size: Number of characters to buffer before writing
+    """
+    self.writer = writer
+    self.buffer_size = buffer_size
+    self.tokens = []
+    self.size = 0
+    self.num_writes = 0  # Number of calls to writer.write(), for monitoring
+
+  def write(self, token):
+    self.tokens.append(token)
+    self.size += len(token)
+    if self.size >= self.buffer_size:
+      self.flush()
+
+  def flush(self):
+    if self.tokens:
+      self.writer.write(JoinTokens(self.tokens))
+      self.num_writes += 1
+      del self.tokens[:]
+      self.size = 0
+
+
+class ByteBuffer(TokenBuffer):
+  """Like TokenBuffer, but encodes tokens into a reusable bytearray.
+
+  This is for writing to binary files, sockets, and io.BytesIO.  Unicode tokens
+  are encoded; byte string tokens are assumed to be in the same encoding.
+
+  NOTE: The bytearray is passed to writer.write() and then cleared, so the
+  writer must not hold on to it.  Files and io.BytesIO copy the data.
+  """
+
+  def __init__(self, writer, buffer_size=DEFAULT_BUFFER_SIZE,
+               encoding='utf-8'):
+    TokenBuffer.__init__(self, writer, buffer_size=buffer_size)
+    self.encoding = encoding
+    self.buf = bytearray()
+
+  def write(self, token):
+    if isinstance(token, unicode):
+      token = token.encode(self.encoding)
+    buf = self.buf
+    buf += token
+    if len(buf) >= self.buffer_size:
+      self.flush()
+
+  def flush(self):
+    if self.buf:
+      self.writer.write(self.buf)
+      self.num_writes += 1
+      del self.buf[:]
+
+
+class AsyncValue(object):
+  """A data value that is fetched only if the template reaches it.
+
+  This is for Template.execute_async() and expand_async().  The first time the
+  value is needed, func(*args) is called.  It should return a future, i.e. an
+  object with add_done_callback(), done() and result() methods, like those from
+  concurrent.futures, Tornado and asyncio.
+  """
+
+  def __init__(self, func, *args):
+    self.func = func
+    self.args = args
+    self.future = None
+
+  def Start(self):
+    if self.future is None:
+      self.future = self.func(*self.args)
+    return self.future
 
 
 class Template(object):
@@ -1361,9 +2771,13 @@ class Template(object):
   """
 
   def __init__(self, template_str,
-               more_formatters=lambda x: None,
-               more_predicates=lambda x: None,
+               more_formatters=None,
+               more_predicates=None,
                undefined_str=None,
+               engine='interpreter',
+               compile_cache=None,
+               view_cache=None,
+               optimize=True,
                **compile_options):
     """
     Args:
@@ -1377,6 +2791,7 @@ class Template(object):
             arguments.
           - A FunctionRegistry instance, giving the most control.  This allows
             formatters which takes contexts as well.
+          - None, if there are no user formatters.
 
       more_predicates:
           Like more_formatters, but for predicates.
@@ -1388,21 +2803,62 @@ class Template(object):
           constructor argument rather than an .expand() argument for
           simplicity.)
 
+      engine: How the compiled program is expanded.  'interpreter' walks the
+          program tree on every expansion.  'codegen' translates the program
+          into a Python function the first time it's expanded, which makes
+          subsequent expansions faster.  The output is the same.
+
+      compile_cache: An object with Get() and Put() methods that stores the
+          result of parsing, e.g. cache.DiskCache.  See _CompileWithCache.
+
+      view_cache: A ViewCache shared by templates, so data expanded in
+          repeated sections with 'pairs' or 'sort-by' is sorted only once.
+
+      optimize: Whether to optimize the compiled program (see _Optimizer).
+          The statement counts before and after are stored in the
+          optimizer_stats attribute.
+
     It also accepts all the compile options that _CompileTemplate does.
     """
+    if engine not in ('interpreter', 'codegen'):
+      raise ConfigurationError('Invalid engine %r' % engine)
+
     r = _TemplateRegistry(self)
     self.undefined_str = undefined_str
+    self.engine = engine
+    self.view_cache = view_cache
+    self._render = None  # generated lazily for the 'codegen' engine
+    # If the template doesn't have substitutions or sections, this is a string
+    # with its expansion.
+    self._static_text = None
+    self.optimizer_stats = None
+    self._free_contexts = []  # _ScopedContext instances to reuse in execute()
     self.group = {}  # optionally updated by _UpdateTemplateGroup
     builder = _ProgramBuilder(more_formatters, more_predicates, r)
     # None used by _FromSection
     if template_str is not None:
-      self._program, self.has_defines = _CompileTemplate(
-          template_str, builder, **compile_options)
-      self.group = _MakeGroupFromRootSection(self._program, self.undefined_str)
+      if compile_cache is None:
+        self._program, self.has_defines = _CompileTemplate(
+            template_str, builder, **compile_options)
+      else:
+        self._program, self.has_defines = _CompileWithCache(
+            compile_cache, template_str, builder, compile_options)
+      self.group = _MakeGroupFromRootSection(
+          self._program, self.undefined_str, self.engine, view_cache)
+      # After making the group, since it removes {.define} statements
+      if optimize:
+        self.optimizer_stats = _OptimizeProgram(self._program)
+        statements = self._program.Statements()
+        if not statements:
+          self._static_text = ''
+        elif len(statements) == 1 and isinstance(statements[0], basestring):
+          self._static_text = statements[0]
 
   @staticmethod
-  def _FromSection(section, group, undefined_str):
-    t = Template(None, undefined_str=undefined_str)
+  def _FromSection(section, group, undefined_str, engine='interpreter',
+                   view_cache=None):
+    t = Template(None, undefined_str=undefined_str, engine=engine,
+                 view_cache=view_cache)
     t._program = section
     t.has_defines = False
     # This "subtemplate" needs the group too for its own references
@@ -1454,14 +2910,56 @@ class Template(object):
     Example: You can pass 'f.write' as the callback to write directly to a file
     handle.
     """
+    if self._static_text is not None and not trace:
+      if self._static_text:
+        callback(self._static_text)
+      return
+
     # First try the passed in version, then the one set by _UpdateTemplateGroup.
     # May be None.  Only one of these should be set.
     group = group or self.group
-    context = _ScopedContext(data_dict, self.undefined_str, group=group)
-    _Execute(self._program.Statements(), context, callback, trace)
+    # list.pop() is atomic, so this is safe when several threads (or recursive
+    # templates) expand this template at once.  Each gets its own context.
+    try:
+      context = self._free_contexts.pop()
+    except IndexError:
+      context = _ScopedContext(data_dict, self.undefined_str, group=group,
+                               view_cache=self.view_cache)
+    else:
+      context.Reset(data_dict, group)
+    try:
+      if self.engine == 'codegen':
+        if self._render is None:
+          self._render = _GenerateCode(self._program)
+        self._render(context, callback, trace)
+      else:
+        _Execute(self._program.Statements(), context, callback, trace)
+    finally:
+      context.Release()
+      self._free_contexts.append(context)
 
   render = execute  # Alias for backward compatibility
 
+  def execute_to(self, data_dict, writer, buffer_size=DEFAULT_BUFFER_SIZE,
+                 encoding=None, group=None, trace=None):
+    """Expands the template to a file-like object, writing in large blocks.
+
+    Args:
+      data_dict: The JSON data dictionary.
+      writer: An object with a write() method, e.g. a file or socket file.
+      buffer_size: Write in blocks of about this size.  See TokenBuffer.
+      encoding: If set, the output is encoded and written as bytes, e.g. to a
+          binary file or io.BytesIO.  See ByteBuffer.
+
+    The buffer is flushed at the end, but writer.flush() isn't called.
+    """
+    if encoding is None:
+      buf = TokenBuffer(writer, buffer_size=buffer_size)
+    else:
+      buf = ByteBuffer(writer, buffer_size=buffer_size, encoding=encoding)
+    self.execute(data_dict, buf.write, group=group, trace=trace)
+    buf.flush()
+
   def expand(self, *args, **kwargs):
     """Expands the template with the given data dictionary, returning a string.
 
@@ -1505,18 +3003,112 @@ class Template(object):
 
     return JoinTokens(tokens)
 
-  def tokenstream(self, data_dict):
+  def tokenstream(self, data_dict, chunk_size=None):
     """Yields a list of tokens resulting from expansion.
 
-    This may be useful for WSGI apps.  NOTE: In the current implementation, the
-    entire expanded template must be stored memory.
+    This may be useful for WSGI apps.  Expansion is lazy: it only proceeds as
+    tokens are consumed, so the entire expanded template is never stored in
+    memory.  The output of template formatters and {.template FOO} is streamed
+    too.
+
+    Args:
+      data_dict: The JSON data dictionary.
+      chunk_size: If set, tokens are joined into chunks of at least this many
+          characters, which is better for writing to a socket.
 
     NOTE: This is a generator, but JavaScript doesn't have generators.
     """
+    tokens = self._IterTokens(data_dict)
+    if chunk_size:
+      tokens = _Coalesce(tokens, chunk_size)
+    return iter(tokens)
+
+  def _IterTokens(self, data_dict, group=None, trace=None, is_async=False):
+    """Lazy version of execute().  Always uses the interpreter."""
+    if self._static_text is not None and not trace:
+      if self._static_text:
+        return [self._static_text]
+      return []
+    group = group or self.group
+    context = _ScopedContext(data_dict, self.undefined_str, group=group,
+                             view_cache=self.view_cache)
+    context.is_async = is_async
+    return _Iterate(self._program.Statements(), context, trace)
+
+  def execute_async(self, data_dict, callback, done, group=None, trace=None):
+    """Like execute(), but data values and formatter results can be futures.
+
+    When expansion reaches a future that isn't done, it stops, and continues in
+    whatever thread completes the future (e.g. the event loop thread).  Futures
+    in sections that aren't expanded are never waited on, and if the data
+    contains AsyncValue instances, they're never even started.
+
+    Futures are waited on when a substitution or section reaches them, and when
+    a formatter returns one.  Predicates and dotted names see the future
+    itself.
+
+    Args:
+      data_dict: The JSON data dictionary.
+      callback: A callback which should be called with each expanded token.
+      done: Called with None when expansion is finished, or the sys.exc_info()
+          triple if it failed.
+    """
+    tokens = self._IterTokens(data_dict, group=group, trace=trace,
+                              is_async=True)
+    _RunAsync(tokens, callback, done)
+
+  def execute_parallel(self, data_dict, callback, pool=None, processes=None,
+                       chunk_size=1000, group=None):
+    """Like execute(), but large repeated sections are expanded in parallel.
+
+    A repeated section with more than chunk_size items is split into chunks of
+    that size, which are expanded by a pool of workers and written in order.
+    Nested repeated sections are expanded in the same worker.  This always uses
+    the interpreter, and Trace isn't supported.
+
+    Args:
+      data_dict: The JSON data dictionary.
+      callback: A callback which should be called with each expanded token.
+      pool: An object with a map() method that returns results in order, e.g.
+          multiprocessing.pool.ThreadPool or a concurrent.futures executor.
+          The template and data are shared with the workers, so it should use
+          threads.
+      processes: Instead of a pool, fork this many worker processes for each
+          large repeated section.  The workers inherit the template and the
+          data, and only the output is sent back.  Not available on Windows.
+      chunk_size: Number of items expanded by each task.
+    """
+    if (pool is None) == (processes is None):
+      raise ConfigurationError('Pass exactly one of pool or processes')
+    group = group or self.group
+    context = _ScopedContext(data_dict, self.undefined_str, group=group,
+                             view_cache=self.view_cache)
+    context.parallel = _ParallelOptions(pool, processes, chunk_size)
+    _Execute(self._program.Statements(), context, callback, None)
+
+  def expand_parallel(self, data_dict, **kwargs):
+    """Like expand(), but see execute_parallel() for the arguments."""
     tokens = []
-    self.execute(data_dict, tokens.append)
-    for token in tokens:
-      yield token
+    self.execute_parallel(data_dict, tokens.append, group=self.group, **kwargs)
+    return JoinTokens(tokens)
+
+  def expand_async(self, data_dict, done, style=None, trace=None):
+    """Like expand(), but see execute_async().
+
+    Args:
+      done: Called with (result, None) when expansion is finished, or
+          (None, exc_info) if it failed.
+    """
+    tokens = []
+
+    def Done(exc_info):
+      if exc_info:
+        done(None, exc_info)
+      else:
+        done(JoinTokens(tokens), None)
+
+    (style or self).execute_async(data_dict, tokens.append, Done,
+                                  group=self.group, trace=trace)
 
 
 class Trace(object):
@@ -1543,11 +3135,14 @@ class Trace(object):
     return 'Trace %s %s' % (self.exec_depth, self.template_depth)
 
 
-def _MakeGroupFromRootSection(root_section, undefined_str):
+def _MakeGroupFromRootSection(root_section, undefined_str,
+                              engine='interpreter', view_cache=None):
   """Construct a dictinary { template name -> Template() instance }
 
   Args:
     root_section: _Section instance -- root of the original parse tree
+    engine, view_cache: Options of the template being constructed, which the
+        {.define} templates inherit
   """
   group = {}
   for statement in root_section.Statements():
@@ -1558,7 +3153,8 @@ def _MakeGroupFromRootSection(root_section, undefined_str):
     if func is _DoDef and isinstance(args, _Section):
       section = args
       # Construct a Template instance from a this _Section subtree
-      t = Template._FromSection(section, group, undefined_str)
+      t = Template._FromSection(section, group, undefined_str, engine,
+                                view_cache)
       group[section.section_name] = t
   return group
 
@@ -1606,50 +3202,393 @@ def JoinTokens(tokens):
     return ''.join(t.decode('utf-8') for t in tokens)
 
 
+class _Row(object):
+  """A row of a _ColumnTable.  It looks like a dictionary to lookups."""
+
+  __slots__ = ('columns', 'index')
+
+  def __init__(self, columns, index):
+    self.columns = columns
+    self.index = index
+
+  def __getitem__(self, name):
+    return self.columns[name][self.index]
+
+  def get(self, name, default=None):
+    try:
+      return self[name]
+    except KeyError:
+      return default
+
+  def __repr__(self):
+    return repr(dict((name, column[self.index])
+                     for name, column in self.columns.iteritems()))
+
+
+class _ColumnTable(object):
+  """A table stored as columns, for repeated sections.
+
+  It looks like a list of _Row objects to _ScopedContext.Next(), so a row
+  dictionary is never built.
+  """
+
+  __slots__ = ('columns', 'num_rows')
+
+  def __init__(self, columns, num_rows):
+    self.columns = columns
+    self.num_rows = num_rows
+
+  def __len__(self):
+    return self.num_rows
+
+  def __getitem__(self, index):
+    return _Row(self.columns, index)
+
+
+def _IsColumn(value):
+  return (hasattr(value, '__len__') and hasattr(value, '__getitem__') and
+          not isinstance(value, (basestring, dict)))
+
+
+def _ToColumnTable(items, context):
+  """Handles columnar data in repeated sections.
+
+  If items is a mapping of column name -> sequence, or a NumPy structured array
+  (or record array), it's replaced on top of the stack with a _ColumnTable.
+  Otherwise it's returned unchanged.
+  """
+  # NumPy doesn't have to be imported to check for this
+  names = getattr(getattr(items, 'dtype', None), 'names', None)
+  if names:
+    columns = dict((name, items[name]) for name in names)
+  elif isinstance(items, dict) and items:
+    columns = items
+    for column in columns.itervalues():
+      if not _IsColumn(column):
+        return items
+  else:
+    return items
+
+  lengths = set(len(column) for column in columns.itervalues())
+  if len(lengths) != 1:
+    raise EvaluationError(
+        'Columns in a repeated section must have the same length, got %s'
+        % sorted(lengths))
+  table = _ColumnTable(columns, lengths.pop())
+  frame = context.stack[-1]
+  frame.context = table
+  frame.mapping = None
+  return table
+
+
+class StreamedList(object):
+  """A list whose items come from an iterator, for repeated sections.
+
+  This lets a template expand a list that doesn't fit in memory, e.g. one that's
+  parsed as it's read from a file.  Items must be read once, in order, and
+  they're not kept.
+
+  len() is the number of items read so far, plus 1 if there's another one.
+  That's all _ScopedContext.Next() and {.alternates with} need.
+  """
+
+  __slots__ = ('iterator', 'num_read', 'pending')
+
+  _UNREAD = object()  # We haven't read ahead
+  _END = object()  # No more items
+
+  def __init__(self, iterable):
+    self.iterator = iter(iterable)
+    self.num_read = 0
+    self.pending = self._UNREAD  # The next item, read ahead
+
+  def _ReadAhead(self):
+    if self.pending is self._UNREAD:
+      self.pending = next(self.iterator, self._END)
+
+  def __len__(self):
+    self._ReadAhead()
+    if self.pending is self._END:
+      return self.num_read
+    return self.num_read + 1
+
+  def __getitem__(self, index):
+    if index != self.num_read:
+      raise EvaluationError(
+          'Items of a streamed list must be read once, in order (got index %d, '
+          'expected %d)' % (index, self.num_read))
+    self._ReadAhead()
+    item = self.pending
+    if item is self._END:
+      raise IndexError(index)
+    self.pending = self._UNREAD
+    self.num_read += 1
+    return item
+
+
+# Shorter lists are expanded a row at a time, since formatting columns has a
+# fixed cost
+_MIN_BATCH_ROWS = 4
+
+
+def _HasLazyValues(values):
+  for cls in set(map(type, values)):
+    if issubclass(cls, LazyValue):
+      return True
+  return False
+
+
+def _ColumnValues(path, items, context):
+  """Returns the value of a substitution for each item of a repeated section.
+
+  The items have been pushed on the context, but not iterated over, so a name
+  that's not in an item is looked up in the enclosing sections, like
+  _NamePath.Lookup does for that row.
+
+  Returns:
+    A sequence, or None if the values can't be looked up this way.
+  """
+  if path is _CURSOR:
+    if isinstance(items, _ColumnTable):
+      return [items[i] for i in xrange(len(items))]
+    if _HasLazyValues(items):
+      return None
+    return items
+  if isinstance(path, _IndexPath):
+    if path.rest:
+      return None
+    return range(1, len(items) + 1)
+
+  first = path.first
+  if isinstance(items, _ColumnTable):
+    values = items.columns.get(first)
+    if values is None:  # The same value for every row
+      return [path.Lookup(context)] * len(items)
+    if isinstance(values, list) and _HasLazyValues(values):
+      return None
+  else:
+    # Only rows that are dictionaries; otherwise do it a row at a time
+    for cls in set(map(type, items)):
+      if not hasattr(cls, 'get') or issubclass(cls, LazyValue):
+        return None
+    try:
+      values = map(operator.itemgetter(first), items)
+    except KeyError:
+      # Rows without the name use the value from the enclosing sections
+      outer = _NamePath(first, first, ()).Lookup(context)
+      values = [item.get(first, outer) for item in items]
+    if _HasLazyValues(values):
+      return None
+  if path.rest:
+    values = [path._LookUpRest(value, context) for value in values]
+  return values
+
+
+def _FormatColumn(values, column_formatters, context):
+  """Applies the column formatters of a substitution.
+
+  Returns:
+    The formatted values, or None if a formatter raised an exception, i.e. the
+    column can't be batched.  See BatchFunction.
+  """
+  for f, args, func_type in column_formatters:
+    try:
+      if func_type == ENHANCED_FUNC:
+        values = f(values, context, args)
+      else:
+        values = f(values)
+    except KeyboardInterrupt:
+      raise
+    except Exception:
+      # Expanding the rows raises the error with the usual details, after the
+      # errors of earlier statements.
+      return None
+  return values
+
+
+def _FormatColumns(block, items, context):
+  """Formats the batched substitutions of a repeated section.
+
+  Returns:
+    A list with the formatted column for each of block.batched, or None if it
+    has to be formatted a row at a time.  None if the list is short or
+    streamed.
+  """
+  if len(items) < _MIN_BATCH_ROWS or isinstance(items, StreamedList):
+    return None
+  columns = []
+  for (path, unused_formatters), column_formatters in block.batched:
+    try:
+      values = _ColumnValues(path, items, context)
+    except EvaluationError:
+      # e.g. UndefinedVariable.  Expanding the row raises it with the usual
+      # details.
+      values = None
+    if values is not None:
+      values = _FormatColumn(values, column_formatters, context)
+    if values is not None and (len(values) != len(items) or None in values):
+      values = None
+    columns.append(values)
+  return columns
+
+
+def _BatchedStatements(block, columns):
+  """Returns the statements of a repeated section, given _FormatColumns()."""
+  cells = {}  # id of _DoSubstitute args -> column
+  for (args, unused_column_formatters), column in zip(block.batched, columns):
+    if column is not None:
+      cells[id(args)] = column
+  statements = []
+  for statement in block.Statements():
+    if not isinstance(statement, basestring):
+      column = cells.get(id(statement[1]))
+      if column is not None:
+        statement = (_DoCell, column)
+    statements.append(statement)
+  return statements
+
+
+def _DoCell(args, context, callback, trace):
+  """A substitution in a repeated section whose column was already formatted."""
+  column = args
+  callback(column[context.stack[-1].index - 1])  # after Next(), so 1-based
+
+
 def _DoRepeatedSection(args, context, callback, trace):
   """{.repeated section foo}"""
 
   block = args
 
-  items = context.PushSection(block.section_name, block.pre_formatters)
+  items = context.PushPath(block.section_path, block.pre_formatters)
+  if not isinstance(items, list):
+    items = _ToColumnTable(items, context)
   if items:
-    if not isinstance(items, list):
+    if not isinstance(items, (list, _ColumnTable, StreamedList)):
       raise EvaluationError('Expected a list; got %s' % type(items))
 
-    last_index = len(items) - 1
-    statements = block.Statements()
-    alt_statements = block.Statements('alternates with')
-    try:
-      i = 0
-      while True:
-        context.Next()
-        # Execute the statements in the block for every item in the list.
-        # Execute the alternate block on every iteration except the last.  Each
-        # item could be an atom (string, integer, etc.) or a dictionary.
-        _Execute(statements, context, callback, trace)
-        if i != last_index:
-          _Execute(alt_statements, context, callback, trace)
-        i += 1
-    except StopIteration:
-      pass
+    parallel = context.parallel
+    if (parallel and not isinstance(items, StreamedList) and
+        len(items) > parallel.chunk_size):
+      for chunk in _ExpandInParallel(block, context):
+        callback(chunk)
+    else:
+      statements = block.Statements()
+      if block.batched:
+        columns = _FormatColumns(block, items, context)
+        if columns is not None:
+          statements = _BatchedStatements(block, columns)
+      alt_statements = block.Statements('alternates with')
+      try:
+        i = 0
+        while True:
+          context.Next()
+          # Execute the statements in the block for every item in the list.
+          # Execute the alternate block on every iteration except the last.
+          # Each item could be an atom (string, integer, etc.) or a
+          # dictionary.
+          _Execute(statements, context, callback, trace)
+          # len() is checked each time since a StreamedList grows
+          if alt_statements and i != len(items) - 1:
+            _Execute(alt_statements, context, callback, trace)
+          i += 1
+      except StopIteration:
+        pass
 
   else:
-    _Execute(block.Statements('or'), context, callback, trace)
+    or_statements = block.Statements('or')
+    if or_statements:
+      _Execute(or_statements, context, callback, trace)
 
   context.Pop()
 
 
+class _ParallelOptions(object):
+  """Options for Template.execute_parallel()."""
+
+  def __init__(self, pool, processes, chunk_size):
+    self.pool = pool
+    self.processes = processes
+    self.chunk_size = chunk_size
+
+
+# Repeated sections being expanded in parallel: job ID -> (block, context).
+# Worker processes get this by forking.
+_parallel_jobs = {}
+_parallel_job_ids = itertools.count()
+
+
+def _ExpandChunk(args):
+  """Expands items [start, end) of a repeated section, in a worker.
+
+  Returns:
+    The expansion, as a string.
+  """
+  job_id, start, end = args
+  block, context = _parallel_jobs[job_id]
+  context = context.Copy()
+  # Next() will advance to items[start], and @index will be start + 1
+  context.stack.append(_Frame(None, index=start))
+  last_index = len(context.stack[-2].context) - 1
+
+  statements = block.Statements()
+  alt_statements = block.Statements('alternates with')
+  tokens = []
+  for i in xrange(start, end):
+    context.Next()
+    _Execute(statements, context, tokens.append, None)
+    # The separator depends on the index in the whole list, not the chunk
+    if alt_statements and i != last_index:
+      _Execute(alt_statements, context, tokens.append, None)
+  return JoinTokens(tokens)
+
+
+def _ExpandInParallel(block, context):
+  """Expands a repeated section in chunks, using a pool of workers.
+
+  The list has already been pushed on the context.
+
+  Returns:
+    A list of expanded chunks, in order.
+  """
+  options = context.parallel
+  num_items = len(context.stack[-1].context)
+  tasks = []
+  job_id = _parallel_job_ids.next()
+  for start in xrange(0, num_items, options.chunk_size):
+    end = min(start + options.chunk_size, num_items)
+    tasks.append((job_id, start, end))
+
+  _parallel_jobs[job_id] = (block, context)
+  try:
+    if options.processes:
+      # Imported here since it's slow to import and rarely needed.  The pool is
+      # created after the job is registered, so the workers inherit it.
+      import multiprocessing
+      pool = multiprocessing.Pool(options.processes)
+      try:
+        return pool.map(_ExpandChunk, tasks)
+      finally:
+        pool.close()
+        pool.join()
+    else:
+      return list(options.pool.map(_ExpandChunk, tasks))
+  finally:
+    del _parallel_jobs[job_id]
+
+
 def _DoSection(args, context, callback, trace):
   """{.section foo}"""
   block = args
   # If a section present and "true", push the dictionary onto the stack as the
   # new context, and show it
-  if context.PushSection(block.section_name, block.pre_formatters):
+  if context.PushPath(block.section_path, block.pre_formatters):
     _Execute(block.Statements(), context, callback, trace)
     context.Pop()
   else:  # missing or "false" -- show the {.or} section
     context.Pop()
-    _Execute(block.Statements('or'), context, callback, trace)
+    or_statements = block.Statements('or')
+    if or_statements:
+      _Execute(or_statements, context, callback, trace)
 
 
 def _DoPredicates(args, context, callback, trace):
@@ -1658,7 +3597,7 @@ def _DoPredicates(args, context, callback, trace):
   Here we execute the first clause that evaluates to true, and then stop.
   """
   block = args
-  value = context.Lookup('@')
+  value = context.stack[-1].context  # the cursor
   for (predicate, args, func_type), statements in block.clauses:
     if func_type == ENHANCED_FUNC:
       do_clause = predicate(value, context, args)
@@ -1686,16 +3625,14 @@ def _DoSubstitute(args, context, callback, trace):
   as {.template FOO} for templates that operate on the root of the data dict
   rather than a subtree.
   """
-  name, formatters = args
+  path, formatters = args
+  name = path.name
 
-  if name is None:
-    value = context.Root()  # don't use the cursor
-  else:
-    try:
-      value = context.Lookup(name)
-    except TypeError, e:
-      raise EvaluationError(
-          'Error evaluating %r in context %r: %r' % (name, context, e))
+  try:
+    value = path.Lookup(context)
+  except TypeError, e:
+    raise EvaluationError(
+        'Error evaluating %r in context %r: %r' % (name, context, e))
 
   last_index = len(formatters) - 1
   for i, (f, args, formatter_type) in enumerate(formatters):
@@ -1711,7 +3648,7 @@ def _DoSubstitute(args, context, callback, trace):
           # We have more formatters to apply, so explicitly construct 'value'
           tokens = []
           template.execute(value, tokens.append, trace=trace)
-          value = JoinTokens(tokens)
+          value = MarkSafe(JoinTokens(tokens))
 
       elif formatter_type == ENHANCED_FUNC:
         value = f(value, context, args)
@@ -1770,6 +3707,572 @@ def _Execute(statements, context, callback, trace):
         raise
 
 
+# The functions below are the lazy versions of _Execute and the _Do*
+# functions, for Template.tokenstream().  They're generators, so expansion
+# only proceeds as fast as the tokens are consumed.  They must behave exactly
+# like the callback versions; if you change one, change the other.
+
+def _IterSubstitute(args, context, trace):
+  """Lazy version of _DoSubstitute."""
+  path, formatters = args
+  if not context.is_async and (
+      not formatters or formatters[-1][2] != TEMPLATE_FORMATTER):
+    tokens = []
+    _DoSubstitute(args, context, tokens.append, trace)
+    return tokens
+  return _IterFormatters(path, formatters, context, trace)
+
+
+def _IterFormatters(path, formatters, context, trace):
+  """Like _DoSubstitute, but for the cases it doesn't handle.
+
+  - The output of a template formatter is streamed rather than buffered.
+  - In async mode, values and formatter results that are futures are waited
+    on.
+  """
+  name = path.name
+  try:
+    value = path.Lookup(context)
+  except TypeError, e:
+    raise EvaluationError(
+        'Error evaluating %r in context %r: %r' % (name, context, e))
+
+  if context.is_async:
+    future = _GetFuture(value)
+    if future is not None:
+      if not future.done():
+        yield _Await(future)
+      value = future.result()
+
+  last_index = len(formatters) - 1
+  for i, (f, args, formatter_type) in enumerate(formatters):
+    try:
+      if formatter_type == TEMPLATE_FORMATTER:
+        tokens = f.Resolve(context)._IterTokens(
+            value, trace=trace, is_async=context.is_async)
+        if i == last_index:
+          for token in tokens:
+            yield token
+          return  # EARLY RETURN
+        pieces = []
+        for token in tokens:
+          if isinstance(token, _Await):
+            yield token  # Pass it up to _RunAsync
+          else:
+            pieces.append(token)
+        value = MarkSafe(JoinTokens(pieces))
+
+      elif formatter_type == ENHANCED_FUNC:
+        value = f(value, context, args)
+
+      elif formatter_type == SIMPLE_FUNC:
+        value = f(value)
+
+      else:
+        assert False, 'Invalid formatter type %r' % formatter_type
+
+    except (KeyboardInterrupt, EvaluationError):
+      raise
+
+    except Exception, e:
+      if formatter_type == TEMPLATE_FORMATTER:
+        raise
+      raise EvaluationError(
+          'Formatting name %r, value %r with formatter %s raised exception: %r '
+          '-- see e.original_exc_info' % (name, value, f, e),
+          original_exc_info=sys.exc_info())
+
+    if context.is_async:
+      future = _GetFuture(value)
+      if future is not None:
+        if not future.done():
+          yield _Await(future)
+        value = future.result()
+
+  if value is None:
+    raise EvaluationError('Evaluating %r gave None value' % name)
+  yield value
+
+
+def _IterCell(args, context, trace):
+  """Lazy version of _DoCell."""
+  column = args
+  return (column[context.stack[-1].index - 1],)
+
+
+def _IterRepeatedSection(args, context, trace):
+  """Lazy version of _DoRepeatedSection."""
+  block = args
+
+  if context.is_async:
+    value = block.section_path.Lookup(context)
+    future = _GetFuture(value)
+    if future is not None:
+      if not future.done():
+        yield _Await(future)
+      value = future.result()
+    items = context.PushValue(value, block.pre_formatters)
+  else:
+    items = context.PushPath(block.section_path, block.pre_formatters)
+  if not isinstance(items, list):
+    items = _ToColumnTable(items, context)
+  if items:
+    if not isinstance(items, (list, _ColumnTable, StreamedList)):
+      raise EvaluationError('Expected a list; got %s' % type(items))
+
+    statements = block.Statements()
+    # In async mode, values may be futures that are waited on
+    if block.batched and not context.is_async:
+      columns = _FormatColumns(block, items, context)
+      if columns is not None:
+        statements = _BatchedStatements(block, columns)
+    alt_statements = block.Statements('alternates with')
+    try:
+      i = 0
+      while True:
+        context.Next()
+        for token in _Iterate(statements, context, trace):
+          yield token
+        if alt_statements and i != len(items) - 1:
+          for token in _Iterate(alt_statements, context, trace):
+            yield token
+        i += 1
+    except StopIteration:
+      pass
+
+  else:
+    or_statements = block.Statements('or')
+    if or_statements:
+      for token in _Iterate(or_statements, context, trace):
+        yield token
+
+  context.Pop()
+
+
+def _IterSection(args, context, trace):
+  """Lazy version of _DoSection."""
+  block = args
+  if context.is_async:
+    value = block.section_path.Lookup(context)
+    future = _GetFuture(value)
+    if future is not None:
+      if not future.done():
+        yield _Await(future)
+      value = future.result()
+    value = context.PushValue(value, block.pre_formatters)
+  else:
+    value = context.PushPath(block.section_path, block.pre_formatters)
+  if value:
+    for token in _Iterate(block.Statements(), context, trace):
+      yield token
+    context.Pop()
+  else:
+    context.Pop()
+    or_statements = block.Statements('or')
+    if or_statements:
+      for token in _Iterate(or_statements, context, trace):
+        yield token
+
+
+def _IterPredicates(args, context, trace):
+  """Lazy version of _DoPredicates."""
+  block = args
+  value = context.stack[-1].context  # the cursor
+  for (predicate, args, func_type), statements in block.clauses:
+    if func_type == ENHANCED_FUNC:
+      do_clause = predicate(value, context, args)
+    else:
+      do_clause = predicate(value)
+
+    if do_clause:
+      if trace: trace.Push(predicate)
+      for token in _Iterate(statements, context, trace):
+        yield token
+      if trace: trace.Pop()
+      break
+
+
+_LAZY_FUNCS = {
+    _DoSubstitute: _IterSubstitute,
+    _DoCell: _IterCell,
+    _DoRepeatedSection: _IterRepeatedSection,
+    _DoSection: _IterSection,
+    _DoPredicates: _IterPredicates,
+    }
+
+
+def _Iterate(statements, context, trace):
+  """Lazy version of _Execute.  Yields tokens instead of calling a callback."""
+  if trace:
+    trace.exec_depth += 1
+  for i, statement in enumerate(statements):
+    if isinstance(statement, basestring):
+      yield statement
+      continue
+    try:
+      func, args = statement
+      lazy_func = _LAZY_FUNCS.get(func)
+      if lazy_func is None:
+        # Not one of ours; buffer its output
+        tokens = []
+        func(args, context, tokens.append, trace)
+      else:
+        tokens = lazy_func(args, context, trace)
+      for token in tokens:
+        yield token
+    except UndefinedVariable, e:
+      start = max(0, i-3)
+      end = i+3
+      e.near = statements[start:end]
+      e.trace = trace
+      raise
+
+
+class _Await(object):
+  """Yielded by the lazy functions in async mode, to wait on a future."""
+
+  def __init__(self, future):
+    self.future = future
+
+
+def _GetFuture(value):
+  """In async mode, returns the future to wait on for a value, or None."""
+  if isinstance(value, AsyncValue):
+    return value.Start()
+  if hasattr(value, 'add_done_callback'):
+    return value
+  return None
+
+
+def _RunAsync(tokens, callback, done):
+  """Drives a lazy expansion in async mode, without blocking on futures.
+
+  When the expansion yields an _Await, we stop, and continue when the future is
+  done.
+  """
+  def Step(unused_future=None):
+    try:
+      for token in tokens:
+        if isinstance(token, _Await):
+          token.future.add_done_callback(Step)
+          return
+        callback(token)
+    except Exception:
+      exc_info = sys.exc_info()
+    else:
+      exc_info = None
+    done(exc_info)
+
+  Step()
+
+
+def _Coalesce(tokens, chunk_size):
+  """Joins tokens into chunks of at least chunk_size characters."""
+  chunk = []
+  size = 0
+  for token in tokens:
+    chunk.append(token)
+    size += len(token)
+    if size >= chunk_size:
+      yield JoinTokens(chunk)
+      chunk = []
+      size = 0
+  if chunk:
+    yield JoinTokens(chunk)
+
+
+class _CodeGenerator(object):
+  """Translates a compiled program tree into Python source.
+
+  This is the 'codegen' engine.  Each list of statements (a section body, an
+  {.or} clause, a predicate clause) becomes one generated function with the
+  same signature as _Execute, minus the statements.  Literals, lookups and
+  formatter calls are inlined, so expansion doesn't go through the _Do*
+  dispatch at all.
+
+  The generated code must behave exactly like _Execute and the _Do* functions,
+  including errors and Trace bookkeeping.  If you change one, change the other.
+
+  Objects referenced by the generated code (literal strings, names, formatter
+  functions) are passed in through the namespace rather than embedded in the
+  source, so we never have to worry about repr() of unicode or byte strings.
+  """
+
+  def __init__(self):
+    self.namespace = {
+        'EvaluationError': EvaluationError,
+        'UndefinedVariable': UndefinedVariable,
+        'JoinTokens': JoinTokens,
+        '_ColumnTable': _ColumnTable,
+        '_ToColumnTable': _ToColumnTable,
+        '_FormatColumns': _FormatColumns,
+        'StreamedList': StreamedList,
+        'MarkSafe': MarkSafe,
+        'sys': sys,
+        }
+    self.functions = []  # source of each generated function
+    self.num_consts = 0
+    self.num_blocks = 0
+
+  def _Const(self, obj):
+    """Returns the name of a new global in the generated code bound to obj."""
+    name = '_k%d' % self.num_consts
+    self.num_consts += 1
+    self.namespace[name] = obj
+    return name
+
+  def _Call(self, block_name):
+    if block_name is None:  # empty block
+      return 'pass'
+    return '%s(context, callback, trace)' % block_name
+
+  def Block(self, statements, batched=()):
+    """Generates a function for a list of statements.
+
+    Args:
+      batched: _RepeatedSection.batched, if these are its statements.  Then
+          the function takes the result of _FormatColumns too.
+
+    Returns:
+      The name of the generated function.
+    """
+    name = '_b%d' % self.num_blocks
+    self.num_blocks += 1
+    statements_name = self._Const(statements)
+    # id of _DoSubstitute args -> index in the result of _FormatColumns
+    column_indices = dict(
+        (id(args), k) for k, (args, unused) in enumerate(batched))
+
+    if batched:
+      signature = 'context, callback, trace, columns'
+    else:
+      signature = 'context, callback, trace'
+    lines = [
+        'def %s(%s):' % (name, signature),
+        '  if trace: trace.exec_depth += 1',
+        ]
+    for i, statement in enumerate(statements):
+      if isinstance(statement, basestring):
+        lines.append('  callback(%s)' % self._Const(statement))
+        continue
+
+      func, args = statement
+      body = []
+      if func is _DoSubstitute and id(args) in column_indices:
+        # Like _DoCell, if the column was formatted
+        substitute = []
+        self._Substitute(args, substitute)
+        body.extend([
+            'column = columns and columns[%d]' % column_indices[id(args)],
+            'if column is not None:',
+            '  callback(column[context.stack[-1].index - 1])',
+            'else:',
+            ])
+        body.extend('  ' + line for line in substitute)
+      elif func is _DoSubstitute:
+        self._Substitute(args, body)
+      elif func is _DoSection:
+        self._Section(args, body)
+      elif func is _DoRepeatedSection:
+        self._RepeatedSection(args, body)
+      elif func is _DoPredicates:
+        self._Predicates(args, body)
+      elif func is _DoDef:
+        continue  # Nothing to do at runtime; see _DoDef
+      else:
+        # Not one of ours; call it the way _Execute does
+        body.append('%s(%s, context, callback, trace)' %
+                    (self._Const(func), self._Const(args)))
+
+      # Show context for statements, like _Execute
+      lines.append('  try:')
+      lines.extend('    ' + line for line in body)
+      lines.extend([
+          '  except UndefinedVariable, e:',
+          '    e.near = %s[%d:%d]' % (statements_name, max(0, i-3), i+3),
+          '    e.trace = trace',
+          '    raise',
+          ])
+
+    self.functions.append('\n'.join(lines))
+    return name
+
+  def _ClauseBlock(self, statements):
+    """Like Block, but returns None if there are no statements.
+
+    The runtime doesn't execute empty clauses at all.
+    """
+    if not statements:
+      return None
+    return self.Block(statements)
+
+  def _Substitute(self, args, out):
+    """Appends lines equivalent to _DoSubstitute."""
+    path, formatters = args
+    name_const = self._Const(path.name)
+
+    if path is _CURSOR:
+      out.append('value = context.stack[-1].context')
+    elif path is _ROOT:
+      out.append('value = context.root')
+    else:
+      out.extend([
+          'try:',
+          '  value = %s.Lookup(context)' % self._Const(path),
+          'except TypeError, e:',
+          '  raise EvaluationError(',
+          "      'Error evaluating %%r in context %%r: %%r' %% "
+          "(%s, context, e))" % name_const,
+          ])
+
+    last_index = len(formatters) - 1
+    for i, (f, f_args, formatter_type) in enumerate(formatters):
+      f_const = self._Const(f)
+
+      if formatter_type == TEMPLATE_FORMATTER:
+        # Exceptions from templates aren't wrapped
+        if i == last_index:
+          out.append(
+              '%s.Resolve(context).execute(value, callback, trace=trace)'
+              % f_const)
+          return  # Don't call the callback
+        out.extend([
+            'tokens = []',
+            '%s.Resolve(context).execute(value, tokens.append, trace=trace)'
+            % f_const,
+            'value = MarkSafe(JoinTokens(tokens))',
+            ])
+        continue
+
+      if formatter_type == ENHANCED_FUNC:
+        call = '%s(value, context, %s)' % (f_const, self._Const(f_args))
+      elif formatter_type == SIMPLE_FUNC:
+        call = '%s(value)' % f_const
+      else:
+        raise AssertionError('Invalid formatter type %r' % formatter_type)
+
+      out.extend([
+          'try:',
+          '  value = %s' % call,
+          'except (KeyboardInterrupt, EvaluationError):',
+          '  raise',
+          'except Exception, e:',
+          '  raise EvaluationError(',
+          "      'Formatting name %%r, value %%r with formatter %%s raised "
+          "exception: %%r -- see e.original_exc_info' %% "
+          "(%s, value, %s, e)," % (name_const, f_const),
+          '      original_exc_info=sys.exc_info())',
+          ])
+
+    out.extend([
+        'if value is None:',
+        "  raise EvaluationError('Evaluating %%r gave None value' %% %s)"
+        % name_const,
+        'callback(value)',
+        ])
+
+  def _Section(self, block, out):
+    """Appends lines equivalent to _DoSection."""
+    default_block = self.Block(block.Statements())
+    or_block = self._ClauseBlock(block.Statements('or'))
+    out.extend([
+        'if context.PushPath(%s, %s):' % (
+            self._Const(block.section_path),
+            self._Const(block.pre_formatters)),
+        '  ' + self._Call(default_block),
+        '  context.Pop()',
+        'else:',
+        '  context.Pop()',
+        '  ' + self._Call(or_block),
+        ])
+
+  def _RepeatedSection(self, block, out):
+    """Appends lines equivalent to _DoRepeatedSection."""
+    default_block = self.Block(block.Statements(), block.batched)
+    alt_block = self._ClauseBlock(block.Statements('alternates with'))
+    or_block = self._ClauseBlock(block.Statements('or'))
+    if block.batched:
+      # Not 'columns', which may be a parameter of the enclosing block
+      format_columns = [
+          '  section_columns = _FormatColumns(%s, items, context)'
+          % self._Const(block),
+          ]
+      call_default = ('%s(context, callback, trace, section_columns)'
+                      % default_block)
+    else:
+      format_columns = []
+      call_default = self._Call(default_block)
+    if alt_block is None:
+      alternate = []
+    else:
+      alternate = [
+          '      if i != len(items) - 1:',
+          '        ' + self._Call(alt_block),
+          ]
+    out.extend([
+        'items = context.PushPath(%s, %s)' % (
+            self._Const(block.section_path),
+            self._Const(block.pre_formatters)),
+        'if not isinstance(items, list):',
+        '  items = _ToColumnTable(items, context)',
+        'if items:',
+        '  if not isinstance(items, (list, _ColumnTable, StreamedList)):',
+        "    raise EvaluationError('Expected a list; got %s' % type(items))",
+        ] + format_columns + [
+        '  try:',
+        '    i = 0',
+        '    while True:',
+        '      context.Next()',
+        '      ' + call_default,
+        ] + alternate + [
+        '      i += 1',
+        '  except StopIteration:',
+        '    pass',
+        'else:',
+        '  ' + self._Call(or_block),
+        'context.Pop()',
+        ])
+
+  def _Predicates(self, block, out):
+    """Appends lines equivalent to _DoPredicates."""
+    out.append('value = context.stack[-1].context')
+    keyword = 'if'
+    for (predicate, p_args, func_type), statements in block.clauses:
+      p_const = self._Const(predicate)
+      if func_type == ENHANCED_FUNC:
+        call = '%s(value, context, %s)' % (p_const, self._Const(p_args))
+      else:
+        call = '%s(value)' % p_const
+      clause_block = self.Block(statements)
+      out.extend([
+          '%s %s:' % (keyword, call),
+          '  if trace: trace.Push(%s)' % p_const,
+          '  ' + self._Call(clause_block),
+          '  if trace: trace.Pop()',
+          ])
+      keyword = 'elif'
+
+  def Source(self):
+    return '\n\n'.join(self.functions) + '\n'
+
+
+def _GenerateCode(program):
+  """Compile a program tree into a native Python function.
+
+  Args:
+    program: The root _Section of a compiled template
+
+  Returns:
+    A function render(context, callback, trace) which has the same effect as
+    _Execute(program.Statements(), context, callback, trace).
+  """
+  gen = _CodeGenerator()
+  root_name = gen.Block(program.Statements())
+  code = compile(gen.Source(), '<jsontemplate codegen>', 'exec')
+  exec code in gen.namespace
+  return gen.namespace[root_name]
+
+
 def expand(template_str, dictionary, **kwargs):
   """Free function to expands a template string with a data dictionary.
 
@@ -0,0 +1,254 @@
+#!/usr/bin/python -S
+"""
+analysis.py
+
+Static analysis of compiled templates.
+
+Analyze() lists the data paths that a template can read, without expanding it.
+This is useful for building projections, so that backends only fetch and
+serialize the fields that are rendered:
+
+  req = analysis.Analyze(t)
+  req.paths     # set(['title', 'rows.*.name', 'name'])
+  req.tested    # set(['rows'])
+  req.iterated  # set(['rows'])
+
+Paths are dotted, and '*' stands for every item of a list.  The empty string is
+the whole data dictionary.
+
+Since names are looked up the scope stack, a name can come from more than one
+place.  For {name} inside {.repeated section rows}, both 'rows.*.name' and
+'name' are listed.
+
+{.define} sub-templates and {x|template NAME} references are followed, using
+the template's group.
+
+The paths are a superset of what's read, so a projection built from them can be
+expanded.  Formatters and predicates that take a context may look up any name,
+so unless they're known (e.g. AbsUrl reads 'base-url'), the whole scope is
+listed for them: every enclosing section, up to the whole data dictionary.
+"""
+
+__author__ = 'Andy Chu'
+
+
+import _jsontemplate as jsontemplate
+
+
+class Scope(object):
+  """A section or template in the program, i.e. a new cursor."""
+
+  def __init__(self, path, repeated=False, template=None):
+    self.path = path  # dotted path of the cursor, or None if unknown
+    self.repeated = repeated  # True if the cursor is each item of path
+    self.template = template  # For the root scope of a referenced template
+    self.names = set()  # Names substituted in this scope, as written
+    self.children = []
+
+  def __repr__(self):
+    return '<Scope %r%s>' % (self.path, self.repeated and ' (repeated)' or '')
+
+
+class Requirements(object):
+  """The result of Analyze()."""
+
+  def __init__(self, root):
+    self.root = root  # Scope tree
+    self.paths = set()  # Values that may be read in full
+    self.tested = set()  # Values whose truth is tested (sections, predicates)
+    self.iterated = set()  # Lists in repeated sections
+
+
+def _Join(path):
+  return '.'.join(path)
+
+
+# Functions that take a context, but don't look up names in it
+_NO_LOOKUPS = set([
+    jsontemplate._Pluralize, jsontemplate._Cycle, jsontemplate._Strftime,
+    jsontemplate._SortBy, jsontemplate._Slice, jsontemplate._TemplateExists,
+    ] + jsontemplate._SECTION_VIEWS.values())
+
+# Functions that take a context -> names they look up
+_LOOKUPS = {
+    jsontemplate._AbsUrl: ['base-url'],
+    }
+
+
+class _Analyzer(object):
+
+  def __init__(self, root):
+    self.req = Requirements(root)
+    self.template_stack = []  # To detect recursion
+    self.visited = set()  # (template, prefix) pairs already analyzed
+
+  def Template(self, template, group, frames, scope):
+    """
+    Args:
+      frames: Path tuple for each frame on the stack that names can be looked up
+          in, from the bottom.  None means the shape of the data is unknown.
+    """
+    prefix = frames[-1]
+    if template in self.template_stack:
+      # Recursive template; we can't enumerate the paths, so read it all.
+      if prefix is not None:
+        self.req.paths.add(_Join(prefix))
+      return
+    key = (id(template), prefix)
+    if key in self.visited:
+      return
+    self.visited.add(key)
+
+    self.template_stack.append(template)
+    self.Statements(template._program.Statements(), group, frames, scope)
+    self.template_stack.pop()
+
+  def _Candidates(self, name, frames):
+    """Returns the paths that a name may be found at."""
+    if name == '@':
+      top = frames[-1]
+      return top is not None and [top] or []
+    parts = tuple(name.split('.'))
+    if parts[0] == '@index':
+      return []
+    return [frame + parts for frame in reversed(frames) if frame is not None]
+
+  def _Read(self, name, frames):
+    for path in self._Candidates(name, frames):
+      self.req.paths.add(_Join(path))
+
+  def _ContextReads(self, func, func_type, frames):
+    """Records what a formatter or predicate that takes a context may read."""
+    # PureFunction formatters remember the type of the function they wrap
+    func_type = getattr(func, 'func_type', func_type)
+    if func_type != jsontemplate.ENHANCED_FUNC or func in _NO_LOOKUPS:
+      return
+    names = _LOOKUPS.get(func)
+    if names is not None:
+      for name in names:
+        self._Read(name, frames)
+      return
+    # Unknown, so it could read anything in scope
+    for frame in frames:
+      if frame is not None:
+        self.req.paths.add(_Join(frame))
+
+  def _Resolve(self, ref, group):
+    if ref.template:
+      return ref.template
+    return group.get(ref.name)
+
+  def Statements(self, statements, group, frames, scope):
+    for statement in statements:
+      if isinstance(statement, basestring):
+        continue
+      func, args = statement
+      if func is jsontemplate._DoSubstitute:
+        self.Substitution(args, group, frames, scope)
+      elif func in (jsontemplate._DoSection, jsontemplate._DoRepeatedSection):
+        self.Section(args, func is jsontemplate._DoRepeatedSection, group,
+                     frames, scope)
+      elif func is jsontemplate._DoPredicates:
+        self.Predicates(args, group, frames, scope)
+      # _DoDef does nothing at runtime
+
+  def Substitution(self, args, group, frames, scope):
+    path, formatters = args
+    if path is jsontemplate._ROOT:  # {.template FOO}
+      candidates = [frames[0]]
+    else:
+      scope.names.add(path.name)
+      candidates = self._Candidates(path.name, frames)
+
+    if formatters and formatters[0][2] == jsontemplate.TEMPLATE_FORMATTER:
+      template = self._Resolve(formatters[0][0], group)
+      if template is not None:
+        # The value is the data dictionary for the other template
+        for candidate in candidates:
+          sub_scope = Scope(_Join(candidate), template=template)
+          scope.children.append(sub_scope)
+          self.Template(template, template.group, [candidate], sub_scope)
+        for f, f_args, func_type in formatters[1:]:
+          self._ContextReads(f, func_type, frames)
+        return
+
+    for candidate in candidates:
+      self.req.paths.add(_Join(candidate))
+    for f, f_args, func_type in formatters:
+      self._ContextReads(f, func_type, frames)
+
+  def Section(self, block, repeated, group, frames, scope):
+    # Section names are only looked up in the top frame
+    top = frames[-1]
+    name = block.section_name
+    if top is None:
+      path = None
+    elif name == '@':
+      path = top
+    else:
+      path = top + (name,)
+
+    if path is not None:
+      self.req.tested.add(_Join(path))
+      if repeated:
+        self.req.iterated.add(_Join(path))
+
+    for f, f_args, func_type in block.pre_formatters:
+      self._ContextReads(f, func_type, frames)
+    if block.pre_formatters:
+      # The formatters change the shape of the data, so read it all
+      if path is not None:
+        self.req.paths.add(_Join(path))
+      cursor = None
+    elif repeated:
+      cursor = path is not None and path + ('*',) or None
+    else:
+      cursor = path
+
+    sub_scope = Scope(path is not None and _Join(path) or None,
+                      repeated=repeated)
+    scope.children.append(sub_scope)
+    self.Statements(block.Statements(), group, frames + [cursor], sub_scope)
+    self.Statements(block.Statements('alternates with'), group,
+                    frames + [cursor], sub_scope)
+    # {.or} is expanded after the value of a section is popped, but the empty
+    # list of a repeated section is still pushed.
+    if repeated:
+      or_frames = frames + [path]
+    else:
+      or_frames = frames
+    self.Statements(block.Statements('or'), group, or_frames, scope)
+
+  def Predicates(self, block, group, frames, scope):
+    for (predicate, args, func_type), statements in block.clauses:
+      if predicate in (jsontemplate._TestAttribute, jsontemplate._IsDebugMode):
+        if predicate is jsontemplate._IsDebugMode:
+          name = 'debug'
+        else:
+          name = args[0]
+        for path in self._Candidates(name, frames):
+          self.req.tested.add(_Join(path))
+      elif predicate not in (jsontemplate._AlwaysTrue,
+                             jsontemplate._TemplateExists):
+        # Other predicates look at the cursor
+        if frames[-1] is not None:
+          self.req.paths.add(_Join(frames[-1]))
+        self._ContextReads(predicate, func_type, frames)
+      self.Statements(statements, group, frames, scope)
+
+
+def Analyze(template, group=None):
+  """Lists the data paths that a template can read.
+
+  Args:
+    template: A Template instance
+    group: Template group to resolve references with, like the argument to
+        Template.execute().  By default it's the template's own group.
+
+  Returns:
+    A Requirements instance.
+  """
+  root = Scope('', template=template)
+  analyzer = _Analyzer(root)
+  analyzer.Template(template, group or template.group, [()], root)
+  return analyzer.req
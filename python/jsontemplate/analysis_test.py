@@ -0,0 +1,132 @@
+#!/usr/bin/python -S
+"""
+analysis_test.py: Tests for analysis.py
+"""
+
+__author__ = 'Andy Chu'
+
+
+import os
+import sys
+
+if __name__ == '__main__':
+  # for jsontemplate and pan, respectively
+  sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+  sys.path.insert(0, os.path.join(os.path.dirname(__file__), '../..'))
+
+from jsontemplate import analysis  # module under test
+from jsontemplate import _jsontemplate as jsontemplate
+import taste
+from taste import util
+
+B = util.BlockStr
+
+
+class AnalyzeTest(taste.Test):
+
+  def testSections(self):
+    t = jsontemplate.Template(B("""
+        {title|html} {@index}
+        {.section user}
+          {name} {address.city}
+        {.or}
+          {login-url}
+        {.end}
+        {.repeated section rows}
+          {@} {id}
+        {.alternates with}
+          {separator}
+        {.end}
+        {.if test debug}{debug-info}{.end}
+        {.repeated section items | pairs}{@key}{.end}
+        """))
+    req = analysis.Analyze(t)
+    self.verify.Equal(req.paths, set([
+        'title',
+        'user.name', 'name', 'user.address.city', 'address.city',
+        'login-url',
+        'rows.*', 'rows.*.id', 'id', 'rows.*.separator', 'separator',
+        'debug-info',
+        'items',
+        # Inside the pairs section, names could also come from the root
+        '@key',
+        ]))
+    self.verify.Equal(req.tested, set(['user', 'rows', 'debug', 'items']))
+    self.verify.Equal(req.iterated, set(['rows', 'items']))
+
+    user, rows, items = req.root.children
+    self.verify.Equal(user.path, 'user')
+    self.verify.Equal(user.names, set(['name', 'address.city']))
+    self.verify.Equal((rows.path, rows.repeated), ('rows', True))
+    self.verify.Equal(items.path, 'items')
+
+  def testTemplates(self):
+    t = jsontemplate.Template(B("""
+        {.define ROW}
+        {name}
+        {.end}
+        {.define BODY}
+        {.repeated section rows}{@|template ROW}{.end}
+        {.end}
+        {.template BODY}
+        {.section owner}{@|template ROW}{.end}
+        {.section unused}{@|template MISSING}{.end}
+        """))
+    req = analysis.Analyze(t)
+    self.verify.Equal(req.paths, set([
+        'rows.*.name', 'owner.name', 'unused']))
+
+    # Formatters after the template can read the enclosing scope
+    row = jsontemplate.Template('{a}')
+    t = jsontemplate.Template(
+        '{.section s}{x|template ROW|Fancy}{.end}',
+        more_formatters={'Fancy': lambda value, context, args: value})
+    jsontemplate.MakeTemplateGroup({'ROW': row, 'T': t})
+    req = analysis.Analyze(t)
+    self.verify.Equal(req.paths, set(['s.x.a', 'x.a', 's', '']))
+
+  def testRecursion(self):
+    t = jsontemplate.Template(B("""
+        {name}
+        {.repeated section children}
+          {@|template SELF}
+        {.end}
+        """))
+    req = analysis.Analyze(t)
+    self.verify.Equal(req.paths, set(['name', 'children.*']))
+    self.verify.Equal(req.iterated, set(['children']))
+
+  def testGroup(self):
+    row = jsontemplate.Template('{a} {b}')
+    t = jsontemplate.Template('{.repeated section rows}{@|template ROW}{.end}')
+    jsontemplate.MakeTemplateGroup({'ROW': row, 'T': t})
+    req = analysis.Analyze(t)
+    self.verify.Equal(req.paths, set(['rows.*.a', 'rows.*.b']))
+
+  def testFunctionsThatTakeContexts(self):
+    t = jsontemplate.Template('{.repeated section links}{url|AbsUrl}{.end}')
+    req = analysis.Analyze(t)
+    self.verify.Equal(req.paths, set([
+        'links.*.url', 'url', 'links.*.base-url', 'base-url']))
+    data = {'base-url': 'http://example.com/', 'links': [{'url': 'a'}],
+            'unused': 1}
+    projection = {'base-url': data['base-url'], 'links': data['links']}
+    self.verify.Equal(t.expand(projection), 'http://example.com/a')
+
+    # Unknown ones could read anything in scope
+    t = jsontemplate.Template(
+        '{.section a}{b|Fancy}{.end}',
+        more_formatters={'Fancy': lambda value, context, args: value})
+    req = analysis.Analyze(t)
+    self.verify.Equal(req.paths, set(['a.b', 'b', 'a', '']))
+
+    # But not simple ones, even if they're wrapped
+    t = jsontemplate.Template(
+        '{.section a}{b|fancy}{.end}',
+        more_formatters={'fancy': jsontemplate.PureFunction(lambda x: x)})
+    req = analysis.Analyze(t)
+    self.verify.Equal(req.paths, set(['a.b', 'b']))
+
+
+if __name__ == '__main__':
+  taste.RunThisModule()
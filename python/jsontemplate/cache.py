@@ -0,0 +1,174 @@
+#!/usr/bin/python -S
+"""
+cache.py
+
+A persistent cache of compiled templates, for processes that compile many
+templates at startup.
+
+Usage:
+
+  c = cache.DiskCache('/var/cache/myapp/jsont')
+  t = jsontemplate.FromFile(f, compile_cache=c)
+  t = jsontemplate.Template(s, compile_cache=c, meta='[]')
+
+What's stored is a record of the program, not the program itself, since the
+program contains formatter functions.  On a hit, the record is replayed into a
+new program without tokenizing or parsing the template.  Formatters and
+predicates are looked up as usual, so changing them doesn't invalidate the
+cache.
+
+The key is a hash of the template string, the compile options (meta,
+format-char, default-formatter, whitespace), the record format and the Python
+version.  Other Template options like undefined-str only affect expansion.
+"""
+
+__author__ = 'Andy Chu'
+
+
+import hashlib
+import marshal
+import os
+import sys
+import tempfile
+
+
+# Bump this when the _ProgramBuilder interface changes, so old records are
+# ignored.
+FORMAT_VERSION = 1
+
+_MAGIC = 'jsont-cache'
+_SUFFIX = '.jsontc'
+
+
+def Digest(key):
+  """Returns a hex digest for a key from _CompileWithCache."""
+  template_str, options = key
+  h = hashlib.sha1()
+  # marshal output isn't portable across Python versions, and unicode and byte
+  # string templates give programs of different types.
+  h.update(repr((FORMAT_VERSION, sys.version_info[:2],
+                 type(template_str).__name__, options)))
+  if isinstance(template_str, unicode):
+    template_str = template_str.encode('utf-8')
+  h.update(template_str)
+  return h.hexdigest()
+
+
+class DiskCache(object):
+  """Stores compiled template records in a directory, one file per template.
+
+  - Files are written to a temporary file and renamed, so readers never see a
+    partial file, even with several processes sharing the directory.
+  - Unreadable or stale files are treated as misses and removed.
+  - When the total size exceeds max_bytes, the least recently used files are
+    removed.
+  """
+
+  def __init__(self, directory, max_bytes=64 * 1024 * 1024):
+    self.directory = directory
+    self.max_bytes = max_bytes
+    self.size = None  # total bytes on disk, computed lazily
+    # Public counters, for monitoring
+    self.hits = 0
+    self.misses = 0
+
+    if not os.path.isdir(directory):
+      os.makedirs(directory)
+
+  def _Path(self, digest):
+    return os.path.join(self.directory, digest + _SUFFIX)
+
+  def _Remove(self, path):
+    try:
+      os.remove(path)
+    except OSError:
+      pass  # Another process may have removed it
+
+  def Get(self, key):
+    digest = Digest(key)
+    path = self._Path(digest)
+    try:
+      f = open(path, 'rb')
+    except IOError:
+      self.misses += 1
+      return None
+    try:
+      try:
+        magic, file_digest, value = marshal.load(f)
+      finally:
+        f.close()
+    except (EOFError, ValueError, TypeError):
+      magic = None
+
+    if magic != _MAGIC or file_digest != digest:
+      self._Remove(path)
+      self.misses += 1
+      return None
+
+    try:
+      os.utime(path, None)  # For least-recently-used eviction
+    except OSError:
+      pass
+    self.hits += 1
+    return value
+
+  def Put(self, key, value):
+    digest = Digest(key)
+    data = marshal.dumps((_MAGIC, digest, value))
+
+    path = self._Path(digest)
+    try:
+      old_size = os.stat(path).st_size  # We're replacing this file
+    except OSError:
+      old_size = 0
+
+    fd, temp_path = tempfile.mkstemp(suffix='.tmp', dir=self.directory)
+    try:
+      try:
+        os.write(fd, data)
+      finally:
+        os.close(fd)
+      if sys.platform == 'win32':
+        self._Remove(path)  # rename doesn't overwrite on Windows
+      os.rename(temp_path, path)
+    except OSError:
+      self._Remove(temp_path)
+      return
+
+    if self.size is None:
+      self.size = sum(size for _, size, _ in self._Entries())
+    else:
+      self.size += len(data) - old_size
+    if self.size > self.max_bytes:
+      self.Evict()
+
+  def _Entries(self):
+    """Returns a list of (mtime, size, path) for files in the cache."""
+    entries = []
+    for name in os.listdir(self.directory):
+      if not name.endswith(_SUFFIX):
+        continue
+      path = os.path.join(self.directory, name)
+      try:
+        st = os.stat(path)
+      except OSError:
+        continue
+      entries.append((st.st_mtime, st.st_size, path))
+    return entries
+
+  def Evict(self):
+    """Remove least recently used files until we're under the size limit."""
+    entries = self._Entries()
+    entries.sort()
+    size = sum(s for _, s, _ in entries)
+    for _, s, path in entries:
+      if size <= self.max_bytes:
+        break
+      self._Remove(path)
+      size -= s
+    self.size = size
+
+  def Clear(self):
+    for _, _, path in self._Entries():
+      self._Remove(path)
+    self.size = 0
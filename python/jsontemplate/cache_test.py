@@ -0,0 +1,133 @@
+#!/usr/bin/python -S
+"""
+cache_test.py: Tests for cache.py
+"""
+
+__author__ = 'Andy Chu'
+
+
+import os
+import shutil
+import sys
+import tempfile
+
+if __name__ == '__main__':
+  # for jsontemplate and pan, respectively
+  sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+  sys.path.insert(0, os.path.join(os.path.dirname(__file__), '../..'))
+
+from jsontemplate import cache  # module under test
+from jsontemplate import _jsontemplate as jsontemplate
+import taste
+
+
+TEMPLATE = """\
+{.section person}
+  {name|upper} {.if test admin}(admin){.end}
+{.or}
+  nobody
+{.end}
+{.repeated section items}{@}{.alternates with}, {.end}
+"""
+
+
+class DiskCacheTest(taste.Test):
+
+  def setUp(self):
+    self.directory = tempfile.mkdtemp()
+    self.cache = cache.DiskCache(self.directory)
+
+  def tearDown(self):
+    shutil.rmtree(self.directory)
+
+  def testHitAndMiss(self):
+    data = {'person': {'name': 'andy', 'admin': True}, 'items': [1, 2]}
+    expected = jsontemplate.Template(TEMPLATE).expand(data)
+
+    t = jsontemplate.Template(TEMPLATE, compile_cache=self.cache)
+    self.verify.Equal(self.cache.misses, 1)
+    self.verify.Equal(t.expand(data), expected)
+
+    # A new instance, e.g. after a restart
+    c = cache.DiskCache(self.directory)
+    t = jsontemplate.Template(TEMPLATE, compile_cache=c)
+    self.verify.Equal((c.hits, c.misses), (1, 0))
+    self.verify.Equal(t.expand(data), expected)
+
+    # Different options are a different key
+    t = jsontemplate.Template(TEMPLATE, compile_cache=c, whitespace='strip-line')
+    self.verify.Equal((c.hits, c.misses), (1, 1))
+
+  def testFromString(self):
+    s = 'meta: []\n\nHello [name]\n'
+    jsontemplate.FromString(s, compile_cache=self.cache)
+    t = jsontemplate.FromString(s, compile_cache=self.cache)
+    self.verify.Equal(self.cache.hits, 1)
+    self.verify.Equal(t.expand({'name': 'World'}), 'Hello World\n')
+
+  def testUnicode(self):
+    jsontemplate.Template(u'\xb5 {a}', compile_cache=self.cache)
+    t = jsontemplate.Template(u'\xb5 {a}', compile_cache=self.cache)
+    self.verify.Equal(self.cache.hits, 1)
+    self.verify.Equal(t.expand({'a': 1}), u'\xb5 1')
+
+    # The byte string version is a different key
+    jsontemplate.Template('\xc2\xb5 {a}', compile_cache=self.cache)
+    self.verify.Equal(self.cache.hits, 1)
+
+  def testFormattersAreLookedUpAgain(self):
+    jsontemplate.Template('{a|foo}', compile_cache=self.cache,
+                          more_formatters={'foo': lambda x: 'FOO'})
+    t = jsontemplate.Template('{a|foo}', compile_cache=self.cache,
+                              more_formatters={'foo': lambda x: 'BAR'})
+    self.verify.Equal(self.cache.hits, 1)
+    self.verify.Equal(t.expand({'a': 1}), 'BAR')
+
+    # Errors are raised on a hit too
+    self.verify.Raises(
+        jsontemplate.BadFormatter,
+        jsontemplate.Template, '{a|foo}', compile_cache=self.cache)
+
+  def testCorruptFile(self):
+    jsontemplate.Template('{a}', compile_cache=self.cache)
+    for name in os.listdir(self.directory):
+      f = open(os.path.join(self.directory, name), 'wb')
+      f.write('garbage')
+      f.close()
+
+    t = jsontemplate.Template('{a}', compile_cache=self.cache)
+    self.verify.Equal(self.cache.misses, 2)
+    self.verify.Equal(t.expand({'a': 1}), '1')
+
+  def testEviction(self):
+    c = cache.DiskCache(self.directory, max_bytes=1)
+    jsontemplate.Template('{a}', compile_cache=c)
+    jsontemplate.Template('{b}', compile_cache=c)
+    # Every file is bigger than the limit
+    self.verify.Equal(len(os.listdir(self.directory)), 0)
+    self.verify.Equal(c.size, 0)
+
+    c = cache.DiskCache(self.directory)
+    jsontemplate.Template('{a}', compile_cache=c)
+    jsontemplate.Template('{b}', compile_cache=c)
+    self.verify.Equal(len(os.listdir(self.directory)), 2)
+    c.max_bytes = c.size - 1
+    c.Evict()
+    self.verify.Equal(len(os.listdir(self.directory)), 1)
+
+    c.Clear()
+    self.verify.Equal(os.listdir(self.directory), [])
+
+  def testOverwriteKeepsSize(self):
+    key = ('{a}', ())
+    self.cache.Put(key, 'a' * 100)
+    size = self.cache.size
+    for i in xrange(3):
+      self.cache.Put(key, 'b' * 100)
+    self.verify.Equal(self.cache.size, size)
+    self.verify.Equal(
+        self.cache.size, sum(s for _, s, _ in self.cache._Entries()))
+
+
+if __name__ == '__main__':
+  taste.RunThisModule()
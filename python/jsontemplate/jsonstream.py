@@ -0,0 +1,210 @@
+#!/usr/bin/python -S
+"""
+jsonstream.py
+
+Parses a JSON document incrementally, so that a huge array in it can be expanded
+by a template without loading the whole document.
+
+Usage:
+
+  data = jsonstream.Load(sys.stdin, path='results.items')
+  t.execute_to(data, sys.stdout)
+
+The array at the path becomes a jsontemplate.StreamedList.  Its items are parsed
+as the {.repeated section} reaches them, and they're not kept, so memory use
+depends on the size of one item, not the whole array.
+
+Object members that come before the array are available when Load() returns.
+Members after it are added once the array has been read, so they can be used
+after the repeated section, but not before it.
+
+Each item is parsed with the json module's decoder; this module only scans the
+objects enclosing the array.
+"""
+
+__author__ = 'Andy Chu'
+
+
+import re
+try:
+  import json
+except ImportError:
+  import simplejson as json
+
+import _jsontemplate as jsontemplate
+
+
+DEFAULT_CHUNK_SIZE = 64 * 1024
+
+_WHITESPACE_RE = re.compile(r'[ \t\n\r]*')
+
+
+class ParseError(ValueError):
+  """The input isn't valid JSON."""
+
+
+class _Reader(object):
+  """Reads JSON values from a file, a chunk at a time."""
+
+  def __init__(self, f, chunk_size):
+    self.f = f
+    self.chunk_size = chunk_size
+    self.buf = ''
+    self.pos = 0
+    self.offset = 0  # Position of buf in the input, for errors
+    self.eof = False
+    self.streaming = False  # Set when we return a StreamedList
+    self.decoder = json.JSONDecoder()
+
+  def Error(self, msg):
+    raise ParseError('%s at byte %d' % (msg, self.offset + self.pos))
+
+  def _Fill(self, size):
+    """Reads more input, dropping what's been parsed.
+
+    Returns:
+      False at the end of the input.
+    """
+    if self.eof:
+      return False
+    data = self.f.read(size)
+    if not data:
+      self.eof = True
+      return False
+    self.offset += self.pos
+    self.buf = self.buf[self.pos:] + data
+    self.pos = 0
+    return True
+
+  def Peek(self):
+    """Skips whitespace and returns the next character, or '' at the end."""
+    while True:
+      self.pos = _WHITESPACE_RE.match(self.buf, self.pos).end()
+      if self.pos < len(self.buf):
+        return self.buf[self.pos]
+      if not self._Fill(self.chunk_size):
+        return ''
+
+  def Expect(self, chars):
+    """Consumes one of the given characters, and returns it."""
+    c = self.Peek()
+    if not c or c not in chars:
+      self.Error('Expected %s' % ' or '.join(repr(ch) for ch in chars))
+    self.pos += 1
+    return c
+
+  def ExpectEnd(self):
+    if self.Peek():
+      self.Error('Extra data')
+
+  def Value(self):
+    """Parses a complete JSON value."""
+    self.Peek()
+    size = self.chunk_size
+    while True:
+      try:
+        value, end = self.decoder.raw_decode(self.buf, self.pos)
+      except ValueError, e:
+        # The value may be incomplete.  Read more, in bigger chunks each time so
+        # a big value isn't parsed too many times.
+        if not self._Fill(size):
+          self.Error('Invalid JSON value (%s)' % e)
+        size *= 2
+        continue
+      # A number could continue in the next chunk
+      if end == len(self.buf) and self._Fill(size):
+        continue
+      self.pos = end
+      return value
+
+
+def _ParseMembers(reader, obj, stop_at=None, first=True):
+  """Parses the members of an object into obj.
+
+  Args:
+    first: True if we're right after the opening brace, False if we're after
+      a member.
+    stop_at: If this key is found, stop after its colon.
+
+  Returns:
+    True if we stopped at the key, False if we reached the end of the object.
+  """
+  if first and reader.Peek() == '}':
+    reader.Expect('}')
+    return False
+  while True:
+    if not first and reader.Expect(',}') == '}':
+      return False
+    first = False
+    key = reader.Value()
+    if not isinstance(key, basestring):
+      reader.Error('Expected an object key')
+    reader.Expect(':')
+    if key == stop_at:
+      return True
+    obj[key] = reader.Value()
+
+
+def _IterArray(reader, objects):
+  """Yields the items of an array, then parses the rest of the document.
+
+  Args:
+    objects: The objects enclosing the array, outermost first.
+  """
+  if reader.Peek() == ']':
+    reader.Expect(']')
+  else:
+    while True:
+      yield reader.Value()
+      if reader.Expect(',]') == ']':
+        break
+  for obj in reversed(objects):
+    _ParseMembers(reader, obj, first=False)
+  reader.ExpectEnd()
+
+
+def _Parse(reader, names, objects):
+  """Parses a value, streaming the array at the path 'names' within it."""
+  c = reader.Peek()
+  if not names:
+    if c != '[':
+      return reader.Value()
+    reader.Expect('[')
+    reader.streaming = True
+    return jsontemplate.StreamedList(_IterArray(reader, objects))
+
+  if c != '{':
+    return reader.Value()
+  reader.Expect('{')
+  obj = {}
+  if _ParseMembers(reader, obj, stop_at=names[0]):
+    objects.append(obj)
+    obj[names[0]] = _Parse(reader, names[1:], objects)
+    if not reader.streaming:  # The path doesn't lead to an array
+      objects.pop()
+      _ParseMembers(reader, obj, first=False)
+  return obj
+
+
+def Load(f, path=None, chunk_size=DEFAULT_CHUNK_SIZE):
+  """Parses a JSON document from a file, streaming the array at a path.
+
+  Args:
+    f: A file to read from.
+    path: The path of the array to stream, like 'results.items'.  If None, the
+      document itself should be an array.
+    chunk_size: Number of bytes to read at a time.
+
+  Returns:
+    The document, with the array replaced by a StreamedList.  If there's no
+    array at the path, the whole document is parsed as usual.
+
+  Raises:
+    ParseError, possibly while the array is being expanded.
+  """
+  names = path.split('.') if path else []
+  reader = _Reader(f, chunk_size)
+  value = _Parse(reader, names, [])
+  if not reader.streaming:
+    reader.ExpectEnd()
+  return value
@@ -0,0 +1,126 @@
+#!/usr/bin/python -S
+"""
+jsonstream_test.py: Tests for jsonstream.py
+"""
+
+__author__ = 'Andy Chu'
+
+
+import os
+import StringIO
+import sys
+try:
+  import json
+except ImportError:
+  import simplejson as json
+
+if __name__ == '__main__':
+  # for jsontemplate and pan, respectively
+  sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+  sys.path.insert(0, os.path.join(os.path.dirname(__file__), '../..'))
+
+from jsontemplate import jsonstream  # module under test
+from jsontemplate import _jsontemplate as jsontemplate
+import taste
+
+
+DOC = """\
+{"title": "Logs", "meta": {"n": [1, 2]},
+ "results": {"count": 3,
+             "items": [ {"id": 1, "msg": "a\\u00b5"}, 12345, -1.5e3,
+                        "x", true, null, [] ],
+             "next": "later"},
+ "footer": "end"}
+"""
+
+
+class LoadTest(taste.Test):
+
+  def testChunkBoundaries(self):
+    expected = json.loads(DOC)
+    items = expected['results']['items']
+    for chunk_size in xrange(1, 12):
+      data = jsonstream.Load(StringIO.StringIO(DOC), path='results.items',
+                             chunk_size=chunk_size)
+      self.verify.Equal(data['title'], 'Logs')
+      self.verify.Equal(data['results']['count'], 3)
+      # These come after the array
+      self.verify.Equal(data['results'].get('next'), None)
+      self.verify.Equal(data.get('footer'), None)
+
+      streamed = data['results']['items']
+      self.verify.IsTrue(isinstance(streamed, jsontemplate.StreamedList))
+      self.verify.Equal([streamed[i] for i in xrange(len(items))], items)
+      self.verify.Equal(len(streamed), len(items))
+      data['results']['items'] = items
+      self.verify.Equal(data, expected)
+
+  def testTopLevelArray(self):
+    for s, expected in [('[1, 2, 3]', [1, 2, 3]), (' [ ] ', []), ('[[]]', [[]])]:
+      items = jsonstream.Load(StringIO.StringIO(s), chunk_size=2)
+      self.verify.Equal(list(items.iterator), expected)
+
+  def testNotAnArray(self):
+    for path in ['title', 'results.count', 'missing', 'meta.n.x']:
+      data = jsonstream.Load(StringIO.StringIO(DOC), path=path, chunk_size=5)
+      self.verify.Equal(data, json.loads(DOC))
+    data = jsonstream.Load(StringIO.StringIO('"foo"'))
+    self.verify.Equal(data, 'foo')
+
+  def testErrors(self):
+    for s in ['[1, 2', '{"a": [1 2]}', '{"a": [1,]}', '{"a": [1]', '{"a": [1]} x',
+              '{1: 2}']:
+      def Expand():
+        data = jsonstream.Load(StringIO.StringIO(s), path='a', chunk_size=3)
+        list(data['a'].iterator)
+      self.verify.Raises(jsonstream.ParseError, Expand)
+
+  def testExpand(self):
+    template_str = """\
+{title}
+{.section results}
+{.repeated section items}
+{@index}: {@|str}
+{.alternates with}
+--
+{.or}
+none
+{.end}
+{next}
+{.end}
+{footer}
+"""
+    for engine in ('interpreter', 'codegen'):
+      t = jsontemplate.Template(template_str, engine=engine)
+      expected = t.expand(json.loads(DOC))
+      data = jsonstream.Load(StringIO.StringIO(DOC), path='results.items')
+      self.verify.Equal(t.expand(data), expected)
+
+    data = jsonstream.Load(StringIO.StringIO(DOC), path='results.items')
+    self.verify.Equal(''.join(t.tokenstream(data)), expected)
+
+    data = jsonstream.Load(StringIO.StringIO('{"results": {"items": []}}'),
+                           path='results.items')
+    t = jsontemplate.Template(
+        '{.section results}{.repeated section items}{@}{.or}none{.end}{.end}')
+    self.verify.Equal(t.expand(data), 'none')
+
+  def testIncremental(self):
+    s = '[%s]' % ', '.join(['"%s"' % ('x' * 100)] * 1000)
+    f = StringIO.StringIO(s)
+    t = jsontemplate.Template('{.repeated section @}{@}\n{.end}')
+    tokens = t.tokenstream(jsonstream.Load(f, chunk_size=1024))
+    self.verify.Equal(tokens.next(), 'x' * 100)
+    self.verify.IsTrue(f.tell() < 2048)
+    self.verify.Equal(len(list(tokens)), 1999)
+    self.verify.Equal(f.tell(), len(s))
+
+  def testReadOnce(self):
+    t = jsontemplate.Template(
+        '{.repeated section @}{@}{.end}{.repeated section @}{@}{.end}')
+    data = jsonstream.Load(StringIO.StringIO('[1, 2]'))
+    self.verify.Raises(jsontemplate.EvaluationError, t.expand, data)
+
+
+if __name__ == '__main__':
+  taste.RunThisModule()
@@ -6,7 +6,10 @@ jsontemplate_unittest.py
 __author__ = 'Andy Chu'
 
 
+import io
+import multiprocessing.pool
 import os
+import StringIO
 import sys
 try:
   import json
@@ -75,6 +78,40 @@ text
                             {'foo': ['a', 'b', 'c']})
     self.verify.Equal('{ .repeated section foo}', s)  # ignored
 
+  def testTokenPositions(self):
+    tokens = list(jsontemplate._Tokenize(
+        'Hello\n  {.section a}\n{b} and {c|html}\n{.end}\n', '{', '}', 'smart'))
+    self.verify.Equal(tokens, [
+        (jsontemplate.LITERAL_TOKEN, 'Hello\n', 1, 1),
+        (jsontemplate.SECTION_TOKEN, 'a', 2, 3),
+        (jsontemplate.SUBST_TOKEN, 'b', 3, 1),
+        (jsontemplate.LITERAL_TOKEN, ' and ', 3, 4),
+        (jsontemplate.SUBST_TOKEN, 'c|html', 3, 9),
+        (jsontemplate.LITERAL_TOKEN, '\n', 3, 17),
+        (jsontemplate.END_TOKEN, None, 4, 1),
+        ])
+
+  def testStripLine(self):
+    tokens = list(jsontemplate._Tokenize(
+        '  a  \n {b} \n\n {.OPTION strip-line}\n  c\n{.END}\n  d\n', '{', '}',
+        'smart'))
+    self.verify.Equal(
+        [t[1] for t in tokens],
+        ['  a  \n', ' ', 'b', ' \n', '\n', 'c', '  d\n'])
+
+    tokens = list(jsontemplate._Tokenize(
+        '  a  \n {b} \n c \r\n', '{', '}', 'strip-line'))
+    self.verify.Equal([t[1] for t in tokens], ['a', 'b', 'c'])
+
+  def testErrorPosition(self):
+    try:
+      jsontemplate.Template('a\nb {c|nonexistent}')
+    except jsontemplate.BadFormatter, e:
+      self.verify.Equal((e.line, e.column), (2, 3))
+      self.verify.In('(line 2, column 3)', str(e))
+    else:
+      raise AssertionError('Expected BadFormatter')
+
   def testSectionRegex(self):
 
     # Section names are required
@@ -171,6 +208,49 @@ class ScopedContextTest(taste.Test):
     s = jsontemplate._ScopedContext([], '')
     self.verify.Raises(StopIteration, s.Next)
 
+  def testFramesAreReused(self):
+    s = jsontemplate._ScopedContext({'a': [1, 2], 'b': {}}, '')
+    s.PushSection('a', [])
+    s.Next()
+    frames = s.stack[:]
+    s.Next()
+    self.verify.Raises(StopIteration, s.Next)
+    s.Pop()
+    s.PushSection('b', [])
+    self.verify.IsTrue(s.stack[-1] in frames)
+
+  def testContextsAreReused(self):
+    t = jsontemplate.Template('{.repeated section a}{@}{b}{.end}')
+    self.verify.Raises(jsontemplate.UndefinedVariable, t.expand, {'a': [1]})
+    self.verify.Equal(len(t._free_contexts), 1)
+    context = t._free_contexts[0]
+    self.verify.Equal(t.expand({'a': [1, 2], 'b': 'x'}), '1x2x')
+    self.verify.IsTrue(t._free_contexts[0] is context)
+    # The data isn't referenced between expansions
+    self.verify.Equal(context.root, None)
+    self.verify.Equal([f.context for f in context.stack], [None])
+
+  def testPaths(self):
+    self.verify.IsTrue(jsontemplate._ParsePath('@') is jsontemplate._CURSOR)
+    path = jsontemplate._ParsePath('foo.bar.baz')
+    self.verify.Equal((path.first, path.rest), ('foo', ('bar', 'baz')))
+    path = jsontemplate._ParsePath('@index')
+    self.verify.IsTrue(isinstance(path, jsontemplate._IndexPath))
+
+    data = {'a': {'b': 1}, 'list': [{'c': 2}]}
+    s = jsontemplate._ScopedContext(data, None)
+    self.verify.Equal(jsontemplate._ParsePath('a.b').Lookup(s), 1)
+    self.verify.Raises(jsontemplate.UndefinedVariable,
+                       jsontemplate._ParsePath('@index').Lookup, s)
+    s.PushSection('list', [])
+    s.Next()
+    # Names are looked up the stack, skipping the list
+    self.verify.Equal(jsontemplate._ParsePath('a.b').Lookup(s), 1)
+    self.verify.Equal(jsontemplate._ParsePath('c').Lookup(s), 2)
+    self.verify.Equal(jsontemplate._ParsePath('@index').Lookup(s), 1)
+    self.verify.Raises(jsontemplate.UndefinedVariable,
+                       jsontemplate._ParsePath('a.x').Lookup, s)
+
 
 class InternalTemplateTest(taste.Test):
   """Tests that can only be run internally."""
@@ -757,5 +837,820 @@ class StylesTest(taste.Test):
         """), s)
 
 
+class CodeGenTest(taste.Test):
+  """The 'codegen' engine should behave exactly like the interpreter."""
+
+  TEMPLATE = B("""
+      {title|html}
+      {.section person}
+        {name} {.if test admin}(admin){.or}(user){.end}
+      {.or}
+        nobody
+      {.end}
+      {.repeated section items | reverse}
+        {@index}: {@}
+      {.alternates with}
+        --
+      {.end}
+      """)
+
+  def testSameOutput(self):
+    data = {
+        'title': '<Hi>',
+        'person': {'name': 'Andy', 'admin': True},
+        'items': ['a', 'b', 'c'],
+        }
+    interp = jsontemplate.Template(self.TEMPLATE)
+    codegen = jsontemplate.Template(self.TEMPLATE, engine='codegen')
+    self.verify.Equal(interp.expand(data), codegen.expand(data))
+    data = {'title': '', 'items': []}
+    self.verify.Equal(interp.expand(data), codegen.expand(data))
+
+    # Function is generated once
+    render = codegen._render
+    codegen.expand(data)
+    self.verify.IsTrue(render is codegen._render)
+
+  def testTrace(self):
+    data = {'title': 't', 'items': ['a', 'b']}
+    traces = []
+    for engine in ('interpreter', 'codegen'):
+      trace = jsontemplate.Trace()
+      t = jsontemplate.Template(self.TEMPLATE, engine=engine)
+      t.expand(data, trace=trace)
+      traces.append(trace.exec_depth)
+    self.verify.Equal(traces[0], traces[1])
+
+  def testUndefinedVariable(self):
+    t = jsontemplate.Template('a {b} {.section c}{d}{.end}', engine='codegen')
+    try:
+      t.expand({'b': 1, 'c': {'e': 2}})
+    except jsontemplate.UndefinedVariable, e:
+      self.verify.Equal(e.near, ['a ', t._program.Statements()[1], ' ',
+                                 t._program.Statements()[3]])
+    else:
+      raise AssertionError('Expected UndefinedVariable')
+
+  def testDefinesAndStyles(self):
+    body = jsontemplate.Template(B("""
+        {.define TITLE}
+        Definition of '{word}'
+        {.end}
+        """), engine='codegen')
+    style = jsontemplate.Template('<title>{.template TITLE}</title>')
+    self.verify.Equal(body.group['TITLE'].engine, 'codegen')
+    self.verify.Equal(body.expand({'word': 'hi'}, style=style),
+                      "<title>Definition of 'hi'\n</title>")
+
+  def testBadEngine(self):
+    self.verify.Raises(
+        jsontemplate.ConfigurationError, jsontemplate.Template, '', engine='x')
+
+  def testFromString(self):
+    t = jsontemplate.FromString('meta: <>\n\n<a>', engine='codegen')
+    self.verify.Equal(t.engine, 'codegen')
+    self.verify.Equal(t.expand({'a': 1}), '1')
+
+
+class OptimizerTest(taste.Test):
+
+  def testMergeLiterals(self):
+    template_str = B("""
+        <ul>
+          {.repeated section items}
+          <li>{@}{.space}</li>
+          {.end}
+        </ul>
+        """)
+    t = jsontemplate.Template(template_str)
+    statements = t._program.Statements()
+    self.verify.Equal(statements[0], '<ul>\n')
+    self.verify.Equal(len(statements), 3)
+    section = statements[1][1]
+    self.verify.Equal(section.Statements()[2], ' </li>\n')
+    self.verify.Equal(
+        t.optimizer_stats,
+        {'statements_before': 7, 'statements_after': 6,
+         'literals_before': 5, 'literals_after': 4})
+
+    unoptimized = jsontemplate.Template(template_str, optimize=False)
+    self.verify.Equal(unoptimized.optimizer_stats, None)
+    data = {'items': [1, 2]}
+    self.verify.Equal(t.expand(data), unoptimized.expand(data))
+
+  def testStaticTemplate(self):
+    t = jsontemplate.Template('a\n{.meta-left}b{.meta-right}\n')
+    self.verify.Equal(t._static_text, 'a\n{b}\n')
+    self.verify.Equal(t.expand({}), 'a\n{b}\n')
+
+    t = jsontemplate.Template('{# comment}')
+    self.verify.Equal(t._static_text, '')
+    self.verify.Equal(t.expand({}), '')
+
+    # The program is still executed when tracing
+    trace = jsontemplate.Trace()
+    t.expand({}, trace=trace)
+    self.verify.Equal(trace.exec_depth, 1)
+
+  def testEmptyClauses(self):
+    template_str = '{.repeated section a}{@}{.alternates with}{.or}{.end}'
+    t = jsontemplate.Template(template_str)
+    self.verify.Equal(t._program.Statements()[0][1].statements.keys(),
+                      ['default'])
+    self.verify.Equal(t.expand({'a': [1, 2]}), '12')
+    t = jsontemplate.Template(template_str, engine='codegen')
+    self.verify.Equal(t.expand({'a': [1, 2]}), '12')
+
+  def testDefines(self):
+    t = jsontemplate.Template(B("""
+        {.define TITLE}
+        Hello
+          {name}
+        {.end}
+        {.template TITLE}
+        """))
+    self.verify.Equal(len(t._program.Statements()), 1)
+    self.verify.Equal(t.expand({'name': 'Andy'}), 'Hello\n  Andy\n')
+
+  def testMixedLiterals(self):
+    # Unicode and byte strings aren't merged
+    t = jsontemplate.Template(u'a {.meta-left}')
+    self.verify.Equal(t._static_text, None)
+    self.verify.Equal(len(t._program.Statements()), 2)
+    self.verify.Equal(t.expand({}), u'a {')
+
+
+class TokenStreamTest(taste.Test):
+
+  def testLazy(self):
+    class Items(list):
+      """Records how far expansion got."""
+      def __init__(self, n):
+        list.__init__(self, range(n))
+        self.accessed = []
+      def __getitem__(self, i):
+        self.accessed.append(i)
+        return list.__getitem__(self, i)
+
+    items = Items(1000)
+    t = jsontemplate.Template('{.repeated section items}{@}\n{.end}')
+    tokens = t.tokenstream({'items': items})
+    self.verify.Equal(tokens.next(), '0')
+    self.verify.Equal(tokens.next(), '\n')
+    self.verify.Equal(items.accessed, [0])
+    self.verify.Equal(
+        ''.join(tokens), ''.join('%d\n' % i for i in range(1, 1000)))
+
+  def testChunkSize(self):
+    t = jsontemplate.Template('{.repeated section items}{@}{.end}')
+    chunks = list(t.tokenstream({'items': ['ab'] * 10}, chunk_size=5))
+    self.verify.Equal(chunks, ['ababab'] * 3 + ['ab'])
+
+    t = jsontemplate.Template('static')
+    self.verify.Equal(list(t.tokenstream({}, chunk_size=5)), ['static'])
+    self.verify.Equal(list(t.tokenstream({})), ['static'])
+
+  def testTemplatesAreStreamed(self):
+    row = jsontemplate.Template('{@}\n')
+    body = jsontemplate.Template(
+        '<{.repeated section rows}{@|template ROW}{.end}>')
+    page = jsontemplate.Template('[{.template BODY}]')
+    jsontemplate.MakeTemplateGroup({'ROW': row, 'BODY': body, 'PAGE': page})
+    tokens = list(page.tokenstream({'rows': [1, 2]}))
+    self.verify.Equal(tokens, ['[', '<', '1', '\n', '2', '\n', '>', ']'])
+
+  def testUndefinedVariable(self):
+    t = jsontemplate.Template('a {b} {.section c}{d}{.end}')
+    tokens = t.tokenstream({'b': 1, 'c': {'e': 2}})
+    self.verify.Equal(tokens.next(), 'a ')
+    try:
+      list(tokens)
+    except jsontemplate.UndefinedVariable, e:
+      self.verify.Equal(e.near, t._program.Statements()[0:4])
+    else:
+      raise AssertionError('Expected UndefinedVariable')
+
+
+class TokenBufferTest(taste.Test):
+
+  def testExecuteTo(self):
+    t = jsontemplate.Template('{.repeated section items}{@},{.end}')
+    data = {'items': range(100)}
+    expected = t.expand(data)
+
+    out = StringIO.StringIO()
+    t.execute_to(data, out, buffer_size=50)
+    self.verify.Equal(out.getvalue(), expected)
+
+    # Blocks are written, not tokens
+    buf = jsontemplate.TokenBuffer(out, buffer_size=50)
+    t.execute(data, buf.write)
+    self.verify.Equal(buf.num_writes, 5)  # 200 tokens, 290 characters
+    self.verify.IsTrue(buf.tokens)  # Not written until flush()
+    buf.flush()
+    self.verify.Equal(buf.num_writes, 6)
+    buf.flush()
+    self.verify.Equal(buf.num_writes, 6)
+
+  def testByteBuffer(self):
+    t = jsontemplate.Template(u'\xb5 {a} {b}')
+    out = io.BytesIO()
+    t.execute_to({'a': u'\xb5', 'b': '\xc2\xb5'}, out, encoding='utf-8')
+    self.verify.Equal(out.getvalue(), '\xc2\xb5 \xc2\xb5 \xc2\xb5')
+
+    out = io.BytesIO()
+    buf = jsontemplate.ByteBuffer(out, buffer_size=4)
+    for token in ['ab', 'cd', 'e']:
+      buf.write(token)
+    self.verify.Equal((out.getvalue(), buf.num_writes), ('abcd', 1))
+    buf.flush()
+    self.verify.Equal((out.getvalue(), buf.num_writes), ('abcde', 2))
+
+
+class _Future(object):
+  """Minimal future, like concurrent.futures.Future."""
+
+  def __init__(self):
+    self.callbacks = []
+    self.value = None
+    self.is_done = False
+
+  def add_done_callback(self, fn):
+    if self.is_done:
+      fn(self)
+    else:
+      self.callbacks.append(fn)
+
+  def done(self):
+    return self.is_done
+
+  def result(self):
+    if isinstance(self.value, Exception):
+      raise self.value
+    return self.value
+
+  def SetResult(self, value):
+    self.value = value
+    self.is_done = True
+    for fn in self.callbacks:
+      fn(self)
+
+
+class AsyncTest(taste.Test):
+
+  def setUp(self):
+    self.results = []
+
+  def Done(self, result, exc_info):
+    self.results.append((result, exc_info))
+
+  def testFutures(self):
+    t = jsontemplate.Template(
+        '{title} {.section user}{name}{.end} {.repeated section items}{@}{.end}')
+    title = _Future()
+    user = _Future()
+    started = []
+    def FetchItems():
+      started.append(True)
+      f = _Future()
+      f.SetResult([1, 2])  # Already done
+      return f
+
+    data = {'title': title, 'user': user,
+            'items': jsontemplate.AsyncValue(FetchItems)}
+    t.expand_async(data, self.Done)
+    self.verify.Equal(self.results, [])
+    self.verify.Equal(started, [])
+    title.SetResult('T')
+    self.verify.Equal(self.results, [])
+    user.SetResult({'name': 'andy'})
+    self.verify.Equal(self.results, [('T andy 12', None)])
+    self.verify.Equal(started, [True])
+
+  def testNotReached(self):
+    def Fetch():
+      raise AssertionError('Should not be called')
+
+    t = jsontemplate.Template('{.section a}{b}{.or}none{.end}')
+    data = {'b': jsontemplate.AsyncValue(Fetch)}
+    t.expand_async(data, self.Done)
+    self.verify.Equal(self.results, [('none', None)])
+
+  def testFormattersAndTemplates(self):
+    future = _Future()
+    t = jsontemplate.Template(
+        '{a|fetch} {a|template A|upper}',
+        more_formatters={'fetch': lambda x: future, 'upper': str.upper})
+    a = jsontemplate.Template(
+        '<{@|fetch}>', more_formatters={'fetch': lambda x: future})
+    jsontemplate.MakeTemplateGroup({'T': t, 'A': a})
+    t.expand_async({'a': 1}, self.Done)
+    self.verify.Equal(self.results, [])
+    future.SetResult('x')
+    self.verify.Equal(self.results, [('x <X>', None)])
+
+  def testError(self):
+    t = jsontemplate.Template('{a}')
+    future = _Future()
+    t.expand_async({'a': future}, self.Done)
+    future.SetResult(ValueError('backend'))
+    result, exc_info = self.results[0]
+    self.verify.Equal(result, None)
+    self.verify.Equal(exc_info[0], ValueError)
+
+    del self.results[:]
+    t.expand_async({}, self.Done)
+    self.verify.Equal(self.results[0][1][0], jsontemplate.UndefinedVariable)
+
+
+class ParallelTest(taste.Test):
+
+  TEMPLATE = B("""
+      {.repeated section rows}
+      {@index} {name} {.repeated section tags}{@}{.alternates with},{.end}
+      {.alternates with}
+      --
+      {.end}
+      """)
+
+  def setUp(self):
+    self.data = {'rows': [{'name': 'row%d' % i, 'tags': ['a', 'b']}
+                          for i in range(25)]}
+    self.template = jsontemplate.Template(self.TEMPLATE)
+    self.expected = self.template.expand(self.data)
+
+  def testThreadPool(self):
+    pool = multiprocessing.pool.ThreadPool(3)
+    try:
+      for chunk_size in (1, 7, 24, 25):
+        self.verify.LongStringsEqual(
+            self.template.expand_parallel(
+                self.data, pool=pool, chunk_size=chunk_size),
+            self.expected)
+    finally:
+      pool.close()
+
+  def testProcesses(self):
+    if sys.platform == 'win32':
+      return
+    self.verify.LongStringsEqual(
+        self.template.expand_parallel(self.data, processes=2, chunk_size=10),
+        self.expected)
+
+  def testBadOptions(self):
+    self.verify.Raises(
+        jsontemplate.ConfigurationError, self.template.expand_parallel,
+        self.data)
+
+
+class LazyValueTest(taste.Test):
+
+  def testLazyValues(self):
+    calls = []
+    def Compute(name, value):
+      calls.append(name)
+      return value
+
+    L = jsontemplate.LazyValue
+    data = {
+        'count': L(Compute, 'count', 3),
+        'user': L(Compute, 'user', {'name': L(Compute, 'name', 'andy')}),
+        'related': L(Compute, 'related', [L(Compute, 'item', 'a'), 'b']),
+        'unused': L(Compute, 'unused', 'x'),
+        'hidden': {'expensive': L(Compute, 'expensive', 'x')},
+        }
+    template_str = B("""
+        {count} {count} {user.name}
+        {.section user}{name}{.end}
+        {.repeated section related}{@}{.end}
+        {.if test count}yes{.end}
+        {.section missing}{hidden.expensive}{.end}
+        """)
+    for engine in ('interpreter', 'codegen'):
+      del calls[:]
+      t = jsontemplate.Template(template_str, engine=engine)
+      self.verify.LongStringsEqual(
+          t.expand(data), '3 3 andy\nandy\nab\nyes\n\n')
+      self.verify.Equal(calls, ['count', 'user', 'name', 'related', 'item'])
+
+
+class ColumnTableTest(taste.Test):
+
+  TEMPLATE = B("""
+      {.repeated section rows}
+      {@index} {name} {age}
+      {.alternates with}
+      --
+      {.or}
+      none
+      {.end}
+      """)
+
+  def setUp(self):
+    self.columns = {'name': ['a', 'b', 'c'], 'age': (1, 2, 3)}
+    self.expected = '1 a 1\n--\n2 b 2\n--\n3 c 3\n'
+
+  def testColumns(self):
+    for engine in ('interpreter', 'codegen'):
+      t = jsontemplate.Template(self.TEMPLATE, engine=engine)
+      self.verify.Equal(t.expand({'rows': self.columns}), self.expected)
+      self.verify.Equal(t.expand({'rows': {'name': [], 'age': []}}), 'none\n')
+
+    t = jsontemplate.Template(self.TEMPLATE)
+    self.verify.Equal(
+        ''.join(t.tokenstream({'rows': self.columns})), self.expected)
+    pool = multiprocessing.pool.ThreadPool(2)
+    try:
+      self.verify.Equal(
+          t.expand_parallel({'rows': self.columns}, pool=pool, chunk_size=2),
+          self.expected)
+    finally:
+      pool.close()
+
+  def testStructuredArray(self):
+
+    class FakeDtype(object):
+      names = ('name', 'age')
+
+    class FakeRecordArray(object):
+      """Like a NumPy record array, which we don't want to depend on."""
+      dtype = FakeDtype()
+      def __init__(self, columns):
+        self.columns = columns
+      def __getitem__(self, name):
+        return self.columns[name]
+      def __nonzero__(self):
+        raise ValueError('The truth value of an array is ambiguous')
+
+    t = jsontemplate.Template(self.TEMPLATE)
+    self.verify.Equal(
+        t.expand({'rows': FakeRecordArray(self.columns)}), self.expected)
+
+  def testErrors(self):
+    t = jsontemplate.Template(self.TEMPLATE)
+    self.verify.Raises(jsontemplate.EvaluationError, t.expand,
+                       {'rows': {'name': ['a'], 'age': []}})
+    # Not a table
+    self.verify.Raises(jsontemplate.EvaluationError, t.expand,
+                       {'rows': {'name': 'a'}})
+
+
+class HtmlEscapeTest(taste.Test):
+
+  def testEscape(self):
+    import cgi
+    for s in ['', 'plain', '<a href="x">&amp;</a>', u'\xb5 < \xb5', '"&"' * 50,
+              'x' * 200 + '<']:
+      for quote in (False, True):
+        self.verify.Equal(jsontemplate._HtmlEscape(s, quote=quote),
+                          cgi.escape(s, quote=quote))
+    self.verify.Equal(jsontemplate._Html(3), '3')
+    self.verify.Equal(jsontemplate._Html(None), 'None')
+    self.verify.Equal(jsontemplate._HtmlAttrValue(['"']), "['&quot;']")
+
+  def testSafeStrings(self):
+    t = jsontemplate.Template('{a|html} {a|html-attr-value} {b|html}')
+    data = {'a': jsontemplate.MarkSafe('<b>"x"</b>'),
+            'b': jsontemplate.MarkSafe(u'<i>\xb5</i>')}
+    self.verify.Equal(t.expand(data), u'<b>"x"</b> <b>"x"</b> <i>\xb5</i>')
+    self.verify.IsTrue(
+        isinstance(jsontemplate.MarkSafe(u'x'), jsontemplate.SafeUnicode))
+    s = jsontemplate.MarkSafe('x')
+    self.verify.IsTrue(jsontemplate.MarkSafe(s) is s)
+
+  def testTemplateOutputIsSafe(self):
+    # The output of the template formatter is HTML, so it isn't escaped again
+    for engine in ('interpreter', 'codegen'):
+      t = jsontemplate.Template(
+          '{.define LINK}<a href="{url|html-attr-value}">{name}</a>{.end}'
+          '{@|template LINK|html}', default_formatter='html', engine=engine)
+      data = {'url': '/?a=1&b=2', 'name': '<x>'}
+      expected = '<a href="/?a=1&amp;b=2">&lt;x&gt;</a>'
+      self.verify.Equal(t.expand(data), expected)
+      self.verify.Equal(''.join(t.tokenstream(data)), expected)
+
+
+class ToStringTest(taste.Test):
+
+  def testSameAsPprint(self):
+    import pprint
+    recursive = []
+    recursive.append(recursive)
+    for value in [
+        0, -5, 10**20, 5L, 0.1, 1e300, float('inf'), True, False,
+        [], {}, (1,), [1, 2, [3, {'b': 1, 'a': 2}]], range(40),
+        {'z': range(30)}, {u'\xb5': 'x'}, set([3, 1, 2]), recursive]:
+      self.verify.Equal(jsontemplate._ToString(value), pprint.pformat(value))
+    self.verify.Equal(jsontemplate._ToString(None), 'null')
+    self.verify.Equal(jsontemplate._ToString(u'\xb5'), u'\xb5')
+
+
+class PureFunctionTest(taste.Test):
+
+  def setUp(self):
+    self.calls = []
+
+  def _Upper(self, value):
+    self.calls.append(value)
+    return unicode(value).upper()
+
+  def testProcessScope(self):
+    pure = jsontemplate.PureFunction(self._Upper)
+    data = {'rows': ['a', 'b', 'a', 1, True, 1.0, ['x'], ['x']]}
+    for engine in ('interpreter', 'codegen'):
+      t = jsontemplate.Template(
+          '{.repeated section rows}{@|upper}{.end}',
+          more_formatters={'upper': pure}, engine=engine)
+      self.verify.Equal(t.expand(data), "ABA1TRUE1.0['X']['X']")
+      self.verify.Equal(''.join(t.tokenstream(data)), "ABA1TRUE1.0['X']['X']")
+
+    # 1, True and 1.0 are cached separately; lists aren't cached
+    self.verify.Equal(self.calls, ['a', 'b', 1, True, 1.0] + [['x']] * 8)
+    self.verify.Equal(
+        (pure.hits, pure.misses, pure.uncacheable), (19, 5, 8))
+
+    pure.Clear()
+    jsontemplate.expand('{@|upper}', 'a', more_formatters={'upper': pure})
+    self.verify.Equal(self.calls[-1], 'a')
+
+  def testExpansionScope(self):
+    pure = jsontemplate.PureFunction(self._Upper, scope='expansion')
+    t = jsontemplate.Template(
+        '{.repeated section @}{@|upper}{.end}',
+        more_formatters={'upper': pure})
+    self.verify.Equal(t.expand(['a', 'a']), 'AA')
+    self.verify.Equal(t.expand(['a', 'a']), 'AA')
+    self.verify.Equal(self.calls, ['a', 'a'])
+
+  def testArgsAreInTheKey(self):
+    def Repeat(value, unused_context, args):
+      self.calls.append(value)
+      return value * int(args[0])
+
+    pure = jsontemplate.PureFunction(Repeat, max_size=2)
+
+    class Registry(jsontemplate.FunctionRegistry):
+      def Lookup(self, user_str):
+        name, arg = user_str.split()
+        return pure, [arg]
+
+    t = jsontemplate.Template(
+        '{.repeated section @}{@|repeat 1}{@|repeat 2}{.end}',
+        more_formatters=Registry())
+    self.verify.Equal(t.expand(['a', 'b', 'a']), 'aaabbbaaa')
+    # Only 2 entries are kept
+    self.verify.Equal(self.calls, ['a', 'a', 'b', 'b', 'a', 'a'])
+    self.verify.Equal(len(pure.cache), 2)
+
+  def testBadScope(self):
+    self.verify.Raises(jsontemplate.ConfigurationError,
+                       jsontemplate.PureFunction, self._Upper, scope='page')
+
+
+class RegistryTest(taste.Test):
+
+  def testPrefixRegistry(self):
+    a, b, c = object(), object(), object()
+    r = jsontemplate.PrefixRegistry([('ab', a), ('a', b), ('b', c)])
+    self.verify.Equal(r.Lookup('ab x y'), (a, ['x', 'y']))
+    self.verify.Equal(r.Lookup('a.x'), (b, ['x']))
+    self.verify.Equal(r.Lookup('b'), (c, ()))
+    self.verify.Equal(r.Lookup('c'), (None, ()))
+    self.verify.Equal(r.Lookup(''), (None, ()))
+
+    # An empty prefix matches everything, after the ones before it
+    r = jsontemplate.PrefixRegistry([('ab', a), ('', b)])
+    self.verify.Equal(r.Lookup('ab'), (a, ()))
+    self.verify.Equal(r.Lookup('c-d'), (b, ['-d']))
+
+  def testNoUserFunctions(self):
+    t = jsontemplate.Template(
+        '{.section n}{.if singular}{@|html} item{.end}{.end}',
+        more_formatters=None,
+        more_predicates=None)
+    self.verify.Equal(t.expand({'n': 1}), '1 item')
+
+  def testDefaultsAreShared(self):
+    t1 = jsontemplate.Template('{a|pluralize x y}{a|strftime-gm.%Y}')
+    t2 = jsontemplate.Template('{b|pluralize x y}{b|strftime-gm.%Y}')
+    formatters1 = [s[1][1][0] for s in t1._program.Statements()]
+    formatters2 = [s[1][1][0] for s in t2._program.Statements()]
+    self.verify.IsTrue(formatters1[0][1] is formatters2[0][1])
+    # Formats have caches, so they aren't shared
+    self.verify.IsTrue(formatters1[1][1] is not formatters2[1][1])
+    self.verify.Equal(t1.expand({'a': 0}), 'x1970')
+
+
+class StrftimeTest(taste.Test):
+
+  def testParse(self):
+    parse = jsontemplate._ParseStrftime
+    self.verify.Equal(parse('%Y-%m-%d'), (86400, None))
+    self.verify.Equal(parse('%-d %B %%H'), (86400, None))
+    self.verify.Equal(parse('%H:%M'), (60, None))
+    self.verify.Equal(parse('%d %T'), (60, ['%d %H:%M:', '']))
+    self.verify.Equal(parse('[%S]'), (60, ['[', ']']))
+    self.verify.Equal(parse('%H:%M:%S %Z'), (1, None))
+    self.verify.Equal(parse('%s'), (1, None))
+
+  def testSameAsTimeModule(self):
+    import time
+    timestamps = [0, 0.5, 59.9, 1316546771.124635, -1.5, 2**31 + 0.25]
+    timestamps += range(1316546771, 1316546771 + 200000, 997)
+    for format_str in ['%Y-%m-%d', '%H:%M', '%m-%d-%Y %H:%M:%S', '%T %Z', None]:
+      for to_time_tuple in (time.localtime, time.gmtime):
+        f = jsontemplate._StrftimeFormat(format_str, to_time_tuple)
+        expected = []
+        for t in timestamps:
+          if format_str is None:
+            expected.append(time.asctime(to_time_tuple(t)))
+          else:
+            expected.append(time.strftime(format_str, to_time_tuple(t)))
+        self.verify.Equal(f.FormatColumn(timestamps), expected)
+        # Out of order, so the cache by second is used
+        self.verify.Equal(f.FormatColumn(timestamps[::-1]), expected[::-1])
+
+  def testTable(self):
+    t = jsontemplate.Template(
+        '{.repeated section @}{@|strftime-gm.%Y-%m-%d %H:%M:%S} {.end}')
+    self.verify.Equal(
+        t.expand([1316546771.1, 1316546771.9, 1316546839, 1316546771]),
+        '2011-09-20 19:26:11 2011-09-20 19:26:11 2011-09-20 19:27:19 '
+        '2011-09-20 19:26:11 ')
+
+  def testTimeZoneChange(self):
+    import time
+    old_tz = os.environ.get('TZ')
+    try:
+      os.environ['TZ'] = 'UTC'
+      time.tzset()
+      t1 = jsontemplate.Template('{x|strftime %H:%M}')
+      self.verify.Equal(t1.expand({'x': 1300000000}), '07:06')
+
+      os.environ['TZ'] = 'Asia/Kolkata'
+      time.tzset()
+      t2 = jsontemplate.Template('{x|strftime %H:%M}')
+      self.verify.Equal(t2.expand({'x': 1300000000}), '12:36')
+      self.verify.Equal(t1.expand({'x': 1300000000}), '12:36')
+    finally:
+      if old_tz is None:
+        del os.environ['TZ']
+      else:
+        os.environ['TZ'] = old_tz
+      time.tzset()
+
+
+class SectionViewTest(taste.Test):
+
+  def testComposeSlices(self):
+    x = range(7)
+    slices = [slice(None, None, -1), slice(1, None), slice(-2, 0, -2),
+              slice(5, 2), slice(0, 3), slice(None, None, 3)]
+    for inner in slices:
+      for outer in slices:
+        view = jsontemplate._SliceOfView(
+            jsontemplate._SliceOfView(x, inner), outer)
+        self.verify.Equal(jsontemplate._MaterializeView(view), x[inner][outer])
+
+  def testSortBy(self):
+    rows = [{'a': 1, 'b': 'x'}, {'a': 2, 'b': 'y'}, {'a': 1, 'b': 'z'}]
+    for engine in ('interpreter', 'codegen'):
+      t = jsontemplate.Template(
+          '{.repeated section @|sort-by -a b}{b}{.end}', engine=engine)
+      self.verify.Equal(t.expand(rows), 'yxz')
+    # Not a repeated section, so it makes a list
+    t = jsontemplate.Template('{.section @|sort-by b|reverse}{@|size}{.end}')
+    self.verify.Equal(t.expand(rows), '3')
+
+  def testSlice(self):
+    for engine in ('interpreter', 'codegen'):
+      t = jsontemplate.Template(
+          '{.repeated section @|reverse|slice 1 3}{@}{.end}', engine=engine)
+      self.verify.Equal(t.expand(range(5)), '32')
+    t = jsontemplate.Template('{.repeated section @|slice -2}{@}{.end}')
+    self.verify.Equal(t.expand('abc'), 'bc')
+    self.verify.Raises(
+        jsontemplate.BadFormatter, jsontemplate.Template, '{@|slice a}')
+
+  def testChainedViews(self):
+    # Views are materialized for the functions after them
+    cache = jsontemplate.ViewCache()
+    for engine in ('interpreter', 'codegen'):
+      for view_cache in (None, cache):
+        t = jsontemplate.Template(
+            '{.repeated section a|reverse|pairs}{@key}{.or}EMPTY{.end} '
+            '{.repeated section b|slice 0 2|pairs}{@key}{@value}{.end} '
+            '{.repeated section c|pairs|sort-by -@value}{@key}{.end}',
+            engine=engine, view_cache=view_cache)
+        data = {'a': [], 'b': [1, 0, 5], 'c': {'x': 1, 'y': 2}}
+        self.verify.Equal(t.expand(data), 'EMPTY 0110 yx')
+        self.verify.Equal(''.join(t.tokenstream(data)), 'EMPTY 0110 yx')
+
+  def testViewCache(self):
+    cache = jsontemplate.ViewCache()
+    t = jsontemplate.Template(
+        '{.repeated section x|pairs}{@key}{.end} '
+        '{.repeated section y|sort-by|slice 0 2}{@}{.end}',
+        view_cache=cache)
+    data = {'x': {'b': 1, 'a': 2}, 'y': [3, 1, 2]}
+    self.verify.Equal(t.expand(data), 'ab 12')
+    self.verify.Equal(t.expand(data), 'ab 12')
+    self.verify.Equal((cache.hits, cache.misses), (2, 2))
+
+    # A change in size is noticed
+    data['x']['c'] = 3
+    self.verify.Equal(t.expand(data), 'abc 12')
+    self.verify.Equal(cache.misses, 3)
+
+
+class BatchFunctionTest(taste.Test):
+
+  def testColumnsAreFormattedOnce(self):
+    calls = []
+    def Column(values):
+      calls.append(len(values))
+      return ['<%s>' % v for v in values]
+    formatters = {'angle': jsontemplate.BatchFunction(lambda v: 'row', Column)}
+    data = {'title': 'T', 'rows': [{'n': i} for i in range(5)]}
+    for engine in ('interpreter', 'codegen'):
+      t = jsontemplate.Template(
+          '{.repeated section rows}{n|angle}{title|angle}{.end}',
+          more_formatters=formatters, engine=engine)
+      self.verify.Equal(t.expand(data), '<0><T><1><T><2><T><3><T><4><T>')
+      self.verify.Equal(
+          jsontemplate.JoinTokens(t.tokenstream(data)),
+          '<0><T><1><T><2><T><3><T><4><T>')
+    self.verify.Equal(calls, [5] * 8)
+
+    # Short lists are formatted a row at a time
+    self.verify.Equal(t.expand({'title': 'T', 'rows': [{'n': 1}]}), 'rowrow')
+
+  def testRowAtATime(self):
+    def CantBatch(values):
+      raise jsontemplate.EvaluationError("Can't batch")
+    formatters = {
+        'none': jsontemplate.BatchFunction(str, lambda values: [None]),
+        'raises': jsontemplate.BatchFunction(str, CantBatch),
+        'buggy': jsontemplate.BatchFunction(str, lambda values: 1 / 0),
+        }
+    for name in formatters:
+      t = jsontemplate.Template(
+          '{.repeated section @}{@|%s}{.end}' % name,
+          more_formatters=formatters)
+      self.verify.Equal(t.expand(range(5)), '01234')
+
+    # Errors are raised by the rows, in order, so the undefined variable comes
+    # before the formatter error
+    for n in (3, 4):
+      t = jsontemplate.Template(
+          '{.repeated section rows}{b}{@index|url-param-value}{.end}')
+      self.verify.Raises(
+          jsontemplate.UndefinedVariable, t.expand, {'rows': [{}] * n})
+
+    # Rows that aren't dictionaries with the name
+    t = jsontemplate.Template('{.repeated section rows}{n|html}{.end}')
+    data = {'n': '&', 'rows': [{'n': 1}, {}, {'n': 3}, 4, {'n': 5}]}
+    self.verify.Equal(t.expand(data), '1&amp;3&amp;5')
+
+  def testPureFunction(self):
+    calls = []
+    def Column(values):
+      calls.append(len(values))
+      return ['<%s>' % v for v in values]
+    formatters = {
+        'angle': jsontemplate.BatchFunction(
+            jsontemplate.PureFunction(lambda v: 'row'), Column)}
+    t = jsontemplate.Template(
+        '{.repeated section @}{@|angle}{.end}', more_formatters=formatters)
+    self.verify.Equal(t.expand(range(5)), '<0><1><2><3><4>')
+    self.verify.Equal(calls, [5])
+    # Short lists use the cached row formatter
+    self.verify.Equal(t.expand([1]), 'row')
+
+  def testDefaultFormatters(self):
+    rows = [{'s': '<a&b>', 'f': 1.5, 'q': 'a b', 'l': [1, 2]}] * 3
+    rows.append({'s': jsontemplate.MarkSafe('<i>'), 'f': 2, 'q': 'c', 'l': []})
+    for engine in ('interpreter', 'codegen'):
+      t = jsontemplate.Template(
+          '{.repeated section @}{s|html} {s|htmltag} {f} {f|html} '
+          '{q|url-param-value} {l|size} {@index}|{.end}', engine=engine)
+      self.verify.Equal(
+          t.expand(rows),
+          '&lt;a&amp;b&gt; &lt;a&amp;b&gt; 1.5 1.5 a+b 2 1|'
+          '&lt;a&amp;b&gt; &lt;a&amp;b&gt; 1.5 1.5 a+b 2 2|'
+          '&lt;a&amp;b&gt; &lt;a&amp;b&gt; 1.5 1.5 a+b 2 3|'
+          '<i> <i> 2 2 c 0 4|')
+
+  def testNestedSections(self):
+    # The inner section's columns don't replace the outer section's
+    t = jsontemplate.Template(
+        '{.repeated section @}{.repeated section items}{@|html}{.end}'
+        '{name|html};{.end}', engine='codegen')
+    data = [{'name': 'n%d' % i, 'items': ['<', '>', '&', 'x']}
+            for i in range(4)]
+    self.verify.Equal(
+        t.expand(data), ''.join('&lt;&gt;&amp;xn%d;' % i for i in range(4)))
+
+
 if __name__ == '__main__':
   taste.RunThisModule()
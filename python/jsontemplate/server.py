@@ -0,0 +1,230 @@
+#!/usr/bin/python -S
+"""
+server.py
+
+A long-running process that expands templates for clients on a Unix socket, so
+that each expansion costs a round trip rather than starting Python and
+compiling the template.  'jsont serve' runs the server, and 'jsont --socket'
+is the client.
+
+Protocol: Every message is a 4-byte big-endian length followed by that many
+bytes.  A client connects and sends two messages:
+
+  1. A JSON object naming the template: {"path": "/abs/path.jsont"} or
+     {"template": "Hello {name}"}
+  2. The JSON data, as UTF-8
+
+The server replies with two messages: a status, 'ok' or 'error', and then the
+expansion as UTF-8 or an error message.  Then it closes the connection.
+
+Compiled templates are kept in a TemplateCache.  A template file is compiled
+again when its modification time changes.
+"""
+
+__author__ = 'Andy Chu'
+
+
+import collections
+import errno
+import os
+import socket
+import SocketServer
+import struct
+import threading
+try:
+  import json
+except ImportError:
+  import simplejson as json
+
+import _jsontemplate as jsontemplate
+
+
+_HEADER = struct.Struct('>I')
+
+
+def SendMessage(sock, data):
+  sock.sendall(_HEADER.pack(len(data)))
+  sock.sendall(data)
+
+
+def _ReceiveExactly(sock, num_bytes):
+  chunks = []
+  while num_bytes:
+    chunk = sock.recv(min(num_bytes, 64 * 1024))
+    if not chunk:
+      raise EOFError('Connection closed')
+    chunks.append(chunk)
+    num_bytes -= len(chunk)
+  return ''.join(chunks)
+
+
+def ReceiveMessage(sock):
+  num_bytes, = _HEADER.unpack(_ReceiveExactly(sock, _HEADER.size))
+  return _ReceiveExactly(sock, num_bytes)
+
+
+class TemplateCache(object):
+  """A least-recently-used cache of compiled templates.
+
+  Template files are keyed by path and modification time; template strings by
+  the string.
+  """
+
+  def __init__(self, make_template, max_size=100):
+    """
+    Args:
+      make_template: Function that compiles a template string
+      max_size: Number of templates to keep
+    """
+    self.make_template = make_template
+    self.max_size = max_size
+    self.templates = collections.OrderedDict()  # Least recently used first
+    self.lock = threading.Lock()
+    # Public counters, for monitoring
+    self.hits = 0
+    self.misses = 0
+
+  def _Get(self, key, read_template):
+    with self.lock:
+      t = self.templates.pop(key, None)
+      if t is not None:
+        self.templates[key] = t
+        self.hits += 1
+        return t
+      self.misses += 1
+
+    # Compile without the lock, so other requests aren't held up
+    t = self.make_template(read_template())
+
+    with self.lock:
+      self.templates[key] = t
+      while len(self.templates) > self.max_size:
+        self.templates.popitem(last=False)
+    return t
+
+  def FromFile(self, path):
+    """
+    Raises:
+      EnvironmentError if the file can't be read.
+      CompilationError
+    """
+    def Read():
+      with open(path) as f:
+        return f.read()
+    return self._Get(('path', path, os.stat(path).st_mtime), Read)
+
+  def FromString(self, template_str):
+    return self._Get(('string', template_str), lambda: template_str)
+
+
+def Expand(cache, header, data):
+  """Handles one request.
+
+  Returns:
+    The expansion, as a UTF-8 byte string.
+
+  Raises:
+    ValueError for invalid requests or data.
+    EnvironmentError and jsontemplate.Error.
+  """
+  header = json.loads(header)
+  if not isinstance(header, dict):
+    raise ValueError('Expected a JSON object, got %r' % header)
+  if 'path' in header:
+    t = cache.FromFile(header['path'])
+  elif 'template' in header:
+    t = cache.FromString(header['template'])
+  else:
+    raise ValueError("Expected 'path' or 'template' in %r" % header)
+
+  result = t.expand(json.loads(data))
+  if isinstance(result, unicode):
+    result = result.encode('utf-8')
+  return result
+
+
+class _RequestHandler(SocketServer.BaseRequestHandler):
+
+  def handle(self):
+    sock = self.request
+    try:
+      header = ReceiveMessage(sock)
+      data = ReceiveMessage(sock)
+    except EOFError:
+      return  # The client went away
+    try:
+      result = Expand(self.server.cache, header, data)
+    except (ValueError, EnvironmentError, jsontemplate.Error), e:
+      status, result = 'error', str(e)
+    else:
+      status = 'ok'
+    SendMessage(sock, status)
+    SendMessage(sock, result)
+
+
+class Server(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+  """Expands templates for clients, one thread per connection."""
+
+  daemon_threads = True
+
+  def __init__(self, socket_path, make_template, cache_size=100):
+    _RemoveStaleSocket(socket_path)
+    SocketServer.UnixStreamServer.__init__(self, socket_path, _RequestHandler)
+    self.socket_path = socket_path
+    self.cache = TemplateCache(make_template, max_size=cache_size)
+
+  def server_close(self):
+    SocketServer.UnixStreamServer.server_close(self)
+    try:
+      os.remove(self.socket_path)
+    except OSError:
+      pass
+
+
+def _RemoveStaleSocket(socket_path):
+  """Removes a socket file left by a server that died.
+
+  Raises:
+    RuntimeError if a server is listening on it.
+  """
+  if not os.path.exists(socket_path):
+    return
+  sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+  try:
+    sock.connect(socket_path)
+  except socket.error, e:
+    if e.errno != errno.ECONNREFUSED:
+      raise
+    os.remove(socket_path)
+  else:
+    raise RuntimeError('A server is already listening on %s' % socket_path)
+  finally:
+    sock.close()
+
+
+def Request(socket_path, header, data):
+  """Sends a request to a server.
+
+  Args:
+    header: A dictionary naming the template; see above.
+    data: The JSON data, as a byte string.
+
+  Returns:
+    The expansion, as a UTF-8 byte string.
+
+  Raises:
+    RuntimeError if the server returned an error.
+    socket.error if it's not running.
+  """
+  sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+  try:
+    sock.connect(socket_path)
+    SendMessage(sock, json.dumps(header))
+    SendMessage(sock, data)
+    status = ReceiveMessage(sock)
+    result = ReceiveMessage(sock)
+  finally:
+    sock.close()
+  if status != 'ok':
+    raise RuntimeError(result)
+  return result
@@ -0,0 +1,133 @@
+#!/usr/bin/python -S
+"""
+server_test.py: Tests for server.py
+"""
+
+__author__ = 'Andy Chu'
+
+
+import os
+import shutil
+import socket
+import sys
+import tempfile
+import threading
+
+if __name__ == '__main__':
+  # for jsontemplate and pan, respectively
+  sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+  sys.path.insert(0, os.path.join(os.path.dirname(__file__), '../..'))
+
+from jsontemplate import server  # module under test
+from jsontemplate import _jsontemplate as jsontemplate
+import taste
+
+
+class TemplateCacheTest(taste.Test):
+
+  def setUp(self):
+    self.directory = tempfile.mkdtemp()
+    self.path = os.path.join(self.directory, 'hello.jsont')
+    self.compiled = []
+
+  def tearDown(self):
+    shutil.rmtree(self.directory)
+
+  def _MakeTemplate(self, template_str):
+    self.compiled.append(template_str)
+    return jsontemplate.Template(template_str)
+
+  def _WriteTemplate(self, template_str, mtime):
+    f = open(self.path, 'w')
+    f.write(template_str)
+    f.close()
+    os.utime(self.path, (mtime, mtime))
+
+  def testFiles(self):
+    cache = server.TemplateCache(self._MakeTemplate)
+    self._WriteTemplate('Hello {name}', 1000)
+    t = cache.FromFile(self.path)
+    self.verify.IsTrue(cache.FromFile(self.path) is t)
+    self.verify.Equal((cache.hits, cache.misses), (1, 1))
+
+    # Modified
+    self._WriteTemplate('Bye {name}', 2000)
+    self.verify.Equal(cache.FromFile(self.path).expand({'name': 'x'}), 'Bye x')
+    self.verify.Equal(len(self.compiled), 2)
+
+    os.remove(self.path)
+    self.verify.Raises(OSError, cache.FromFile, self.path)
+
+  def testEviction(self):
+    cache = server.TemplateCache(self._MakeTemplate, max_size=2)
+    cache.FromString('a')
+    cache.FromString('b')
+    cache.FromString('a')
+    cache.FromString('c')  # b is evicted
+    cache.FromString('a')
+    self.verify.Equal(self.compiled, ['a', 'b', 'c'])
+    cache.FromString('b')
+    self.verify.Equal(self.compiled, ['a', 'b', 'c', 'b'])
+
+
+class ServerTest(taste.Test):
+
+  def setUp(self):
+    self.directory = tempfile.mkdtemp()
+    self.socket_path = os.path.join(self.directory, 'jsont.sock')
+    self.server = server.Server(self.socket_path, jsontemplate.Template)
+    self.thread = threading.Thread(target=self.server.serve_forever)
+    self.thread.start()
+
+  def tearDown(self):
+    self.server.shutdown()
+    self.thread.join()
+    self.server.server_close()
+    shutil.rmtree(self.directory)
+
+  def testRequests(self):
+    path = os.path.join(self.directory, 'hello.jsont')
+    f = open(path, 'w')
+    f.write('Hello {name}\n')
+    f.close()
+
+    self.verify.Equal(
+        server.Request(self.socket_path, {'path': path}, '{"name": "World"}'),
+        'Hello World\n')
+    self.verify.Equal(
+        server.Request(self.socket_path, {'path': path}, '{"name": "\\u00b5"}'),
+        'Hello \xc2\xb5\n')
+    self.verify.Equal(
+        server.Request(self.socket_path, {'template': '{@|html}'}, '"<"'),
+        '&lt;')
+    self.verify.Equal(self.server.cache.hits, 1)
+
+    # Errors are returned to the client, and the server keeps going
+    for header, data in [
+        ({'path': os.path.join(self.directory, 'missing')}, '{}'),
+        ({'template': '{.section a}'}, '{}'),
+        ({'template': '{a}'}, '{}'),
+        ({'template': '{a}'}, '{'),
+        ({}, '{}'),
+        ]:
+      self.verify.Raises(
+          RuntimeError, server.Request, self.socket_path, header, data)
+    self.verify.Equal(
+        server.Request(self.socket_path, {'template': '{a}'}, '{"a": 1}'), '1')
+
+  def testOneServerPerSocket(self):
+    self.verify.Raises(
+        RuntimeError, server.Server, self.socket_path, jsontemplate.Template)
+
+  def testStaleSocket(self):
+    path = os.path.join(self.directory, 'stale.sock')
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.bind(path)
+    sock.close()  # Not listening
+    s = server.Server(path, jsontemplate.Template)
+    s.server_close()
+    self.verify.IsTrue(not os.path.exists(path))
+
+
+if __name__ == '__main__':
+  taste.RunThisModule()
@@ -37,6 +37,7 @@ import base_verifier  # TODO: Move this into a package
 
 import jsontemplate  # module under *direct* test
 from jsontemplate import formatters
+from jsontemplate import _jsontemplate
 
 
 class InternalTemplateVerifier(base_verifier.JsonTemplateVerifier):
@@ -69,6 +70,45 @@ class InternalTemplateVerifier(base_verifier.JsonTemplateVerifier):
     self.Raises(exception, jsontemplate.Template, *args, **kwargs)
 
 
+class CodeGenVerifier(InternalTemplateVerifier):
+  """Verifies template behavior in-process, with the 'codegen' engine."""
+
+  def Expansion(
+      self, template_def, dictionary, expected, ignore_whitespace=False,
+      ignore_all_whitespace=False, all_formatters=False):
+    template_def.kwargs['engine'] = 'codegen'
+    InternalTemplateVerifier.Expansion(
+        self, template_def, dictionary, expected,
+        ignore_whitespace=ignore_whitespace,
+        ignore_all_whitespace=ignore_all_whitespace,
+        all_formatters=all_formatters)
+    del template_def.kwargs['engine']
+
+  def EvaluationError(self, exception, template_def, data_dict):
+    template_def.kwargs['engine'] = 'codegen'
+    InternalTemplateVerifier.EvaluationError(
+        self, exception, template_def, data_dict)
+    del template_def.kwargs['engine']
+
+
+class StreamingVerifier(InternalTemplateVerifier):
+  """Verifies template behavior in-process, with Template.tokenstream()."""
+
+  def Expansion(
+      self, template_def, dictionary, expected, ignore_whitespace=False,
+      ignore_all_whitespace=False, all_formatters=False):
+    if all_formatters:
+      template_def.kwargs['more_formatters'] = formatters.PythonPercentFormat
+
+    template = jsontemplate.Template(*template_def.args, **template_def.kwargs)
+    right = _jsontemplate.JoinTokens(list(template.tokenstream(dictionary)))
+    self.LongStringsEqual(expected, right, ignore_whitespace=ignore_whitespace)
+
+  def EvaluationError(self, exception, template_def, data_dict):
+    template = jsontemplate.Template(*template_def.args, **template_def.kwargs)
+    self.Raises(exception, list, template.tokenstream(data_dict))
+
+
 class ExternalVerifier(base_verifier.JsonTemplateVerifier):
   """Verifies template behavior in an external process."""
 